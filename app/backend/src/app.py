@@ -1,4 +1,5 @@
 import logging
+import multiprocessing
 import signal
 import sys
 
@@ -14,8 +15,14 @@ from sqlalchemy.sql import text
 from couchers import config
 from couchers.db import apply_migrations, session_scope
 from couchers.jobs.worker import start_jobs_scheduler, start_jobs_worker
-from couchers.metrics import create_prometheus_server, main_process_registry
-from couchers.server import create_main_server, create_media_server
+from couchers.metrics import clear_multiprocess_metrics, create_prometheus_server, main_process_registry
+from couchers.server import (
+    create_main_server,
+    create_media_server,
+    start_main_aio_server,
+    start_main_server_processes,
+    wait_for_main_server_processes,
+)
 from dummy_data import add_dummy_data
 
 config.check_config()
@@ -46,6 +53,7 @@ if config.config["SENTRY_ENABLED"]:
     )
 
 # used to export metrics
+clear_multiprocess_metrics()
 create_prometheus_server(main_process_registry, 8000)
 
 
@@ -76,9 +84,17 @@ if config.config["ADD_DUMMY_DATA"]:
 
 logger.info(f"Starting")
 
+api_processes = None
+
 if config.config["ROLE"] in ["api", "all"]:
-    server = create_main_server(port=1751)
-    server.start()
+    if config.config["API_PROCESSES"] > 1:
+        # this forks, so needs to happen before we create any other gRPC servers
+        api_processes = start_main_server_processes(port=1751, num_processes=config.config["API_PROCESSES"])
+    elif config.config["GRPC_SERVER_MODE"] == "aio":
+        start_main_aio_server(port=1751)
+    else:
+        server = create_main_server(port=1751)
+        server.start()
     media_server = create_media_server(port=1753)
     media_server.start()
     logger.info(f"Serving on 1751 (secure) and 1753 (media)")
@@ -89,6 +105,15 @@ if config.config["ROLE"] in ["scheduler", "all"]:
 if config.config["ROLE"] in ["worker", "all"]:
     worker = start_jobs_worker()
 
+if api_processes:
+    logger.info("App waiting for API processes...")
+    wait_for_main_server_processes(api_processes)
+    logger.critical("An API process died, exiting")
+    # stop the jobs processes as well, so the whole app gets restarted
+    for process in multiprocessing.active_children():
+        process.terminate()
+    sys.exit(1)
+
 logger.info("App waiting for signal...")
 
 signal.pause()
@@ -0,0 +1,83 @@
+"""
+Benchmarks that are too slow or too noisy for the test suite. Run them with
+
+    python benchmarks.py [name ...]
+
+which runs all of them if no names are given.
+"""
+import asyncio
+import sys
+from time import perf_counter, perf_counter_ns
+
+import grpc
+from google.protobuf import empty_pb2
+
+from couchers.interceptors import AuthValidatorInterceptor
+from proto import gis_pb2_grpc
+from tests.test_fixtures import generate_user
+from tests.test_server import create_aio_test_server, create_sync_test_server
+
+
+def auth_interceptor_overhead():
+    # per-call cost of the auth interceptor itself, i.e. without the db lookup of a session, by calling an open rpc
+    # without credentials
+    interceptor = AuthValidatorInterceptor()
+    handler = grpc.unary_unary_rpc_method_handler(lambda request, context: empty_pb2.Empty())
+
+    class HandlerCallDetails:
+        method = "/org.couchers.resources.Resources/GetTermsOfService"
+        invocation_metadata = (("user-agent", "grpc-python"), ("x-forwarded-for", "127.0.0.1"))
+
+    details = HandlerCallDetails()
+    continuation = lambda handler_call_details: handler
+
+    n = 10000
+    start = perf_counter_ns()
+    for _ in range(n):
+        interceptor.intercept_service(continuation, details)
+    per_call = (perf_counter_ns() - start) / n
+    print(f"AuthValidatorInterceptor overhead: {per_call:.0f} ns/call")
+
+
+def sync_vs_aio_server():
+    # throughput of the two servers on the same burst of concurrent GIS calls, this creates a user in the configured
+    # database
+    _, token = generate_user()
+    metadata = (("cookie", f"couchers-sesh={token}"),)
+    num_calls = 200
+
+    async def burst(port):
+        async with grpc.aio.secure_channel(f"localhost:{port}", grpc.local_channel_credentials()) as channel:
+            gis = gis_pb2_grpc.GISStub(channel)
+            start = perf_counter()
+            await asyncio.gather(*(gis.GetCommunities(empty_pb2.Empty(), metadata=metadata) for _ in range(num_calls)))
+            return perf_counter() - start
+
+    sync_server, sync_port = create_sync_test_server()
+    sync_server.start()
+    try:
+        sync_duration = asyncio.run(burst(sync_port))
+    finally:
+        sync_server.stop(None).wait()
+
+    async def run_aio():
+        server, port = create_aio_test_server()
+        await server.start()
+        try:
+            return await burst(port)
+        finally:
+            await server.stop(None)
+
+    aio_duration = asyncio.run(run_aio())
+
+    print(f"sync: {num_calls / sync_duration:.0f} calls/s, aio: {num_calls / aio_duration:.0f} calls/s")
+
+
+BENCHMARKS = {
+    "auth_interceptor_overhead": auth_interceptor_overhead,
+    "sync_vs_aio_server": sync_vs_aio_server,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
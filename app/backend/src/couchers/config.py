@@ -14,6 +14,10 @@ CONFIG_OPTIONS = [
     # Whether we're `api` mode (answering API queries) or `scheduler` (scheduling background jobs), or `worker`
     # (servicing background jobs). Can also be set to `all` to do all three simultaneously
     ("ROLE", ["api", "scheduler", "worker", "all"], "all"),
+    # Whether the main API server is the thread pool based grpc.server (`sync`) or grpc.aio (`aio`)
+    ("GRPC_SERVER_MODE", ["sync", "aio"], "sync"),
+    # Number of processes serving the main API, they all listen on the same port with SO_REUSEPORT
+    ("API_PROCESSES", int, "1"),
     # Version string
     ("VERSION", str, "unknown"),
     # Base URL
@@ -22,6 +26,10 @@ CONFIG_OPTIONS = [
     ("COOKIE_DOMAIN", str),
     # SQLAlchemy database connection string
     ("DATABASE_CONNECTION_STRING", str),
+    # Comma separated SQLAlchemy connection strings of read replicas, read-only sessions go to these if set
+    ("DATABASE_REPLICA_CONNECTION_STRINGS", str, ""),
+    # Replicas further than this many seconds behind the primary are not used
+    ("DATABASE_REPLICA_MAX_LAG", float, "5.0"),
     # Whether to try adding dummy data
     ("ADD_DUMMY_DATA", bool),
     # Donations
@@ -60,6 +68,20 @@ CONFIG_OPTIONS = [
     ("MAILCHIMP_API_KEY", str),
     ("MAILCHIMP_DC", str),
     ("MAILCHIMP_LIST_ID", str),
+    # Base URL of the Mailchimp API, defaults to the one for MAILCHIMP_DC
+    ("MAILCHIMP_BASE_URL", str, ""),
+    # Maximum number of batches of users sent to Mailchimp at the same time
+    ("MAILCHIMP_CONCURRENCY", int, "4"),
+    # Number of days of raw API call logs to keep, older logs are rolled up into hourly aggregates and dropped
+    ("API_CALLS_RETENTION_DAYS", int, "30"),
+    # Fraction of successful API calls whose request and response bodies are logged, failed calls are always logged
+    ("API_CALLS_LOG_SAMPLE_RATE", float, "1.0"),
+    # Request and response bodies larger than this many bytes are not logged
+    ("API_CALLS_LOG_MAX_BYTES", int, "65536"),
+    # Log the SQL of every call that runs more than this many queries, 0 to turn off
+    ("API_CALLS_LOG_QUERIES_THRESHOLD", int, "0"),
+    # Number of users handled per transaction when sending out onboarding emails
+    ("ONBOARDING_EMAILS_CHUNK_SIZE", int, "500"),
     # Whether we're in test
     ("IN_TEST", bool, "0"),
 ]
@@ -119,6 +141,9 @@ def check_config():
         if config["IN_TEST"]:
             raise Exception("IN_TEST while not DEV")
 
+    if config["API_PROCESSES"] > 1 and not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        raise Exception("PROMETHEUS_MULTIPROC_DIR must be set to collect metrics from several API processes")
+
     if config["ENABLE_DONATIONS"]:
         if (
             not config["STRIPE_API_KEY"]
@@ -21,3 +21,34 @@ SMS_CODE_LIFETIME = timedelta(hours=24)
 SMS_CODE_ATTEMPTS = 3
 
 EMAIL_TOKEN_VALIDITY = timedelta(hours=48)
+
+# how long to keep finished background jobs (and their payloads) around for debugging before purging them
+BACKGROUND_JOB_COMPLETED_RETENTION = timedelta(days=7)
+BACKGROUND_JOB_FAILED_RETENTION = timedelta(days=90)
+
+# number of users added to the mailing list per Mailchimp API call, Mailchimp accepts at most 500
+MAILCHIMP_BATCH_SIZE = 500
+
+# number of days ahead of time to create daily partitions of the API call logs
+API_CALLS_PARTITIONS_AHEAD = 7
+
+# how often to check how far behind each read replica is, see couchers.db.get_replica_engine
+REPLICA_LAG_CHECK_INTERVAL = timedelta(seconds=5)
+
+# in-process cache of users' friend lists, see couchers.db.get_friend_ids
+FRIEND_IDS_CACHE_SIZE = 10000
+FRIEND_IDS_CACHE_TTL = timedelta(seconds=60)
+
+# weights of the parts of the user search relevance score, each part is between 0 and 1
+USER_RANKING_ACTIVITY_WEIGHT = 0.4
+USER_RANKING_HOSTING_WEIGHT = 0.3
+USER_RANKING_REFERENCES_WEIGHT = 0.3
+# only used when searching in an area
+USER_RANKING_DISTANCE_WEIGHT = 0.3
+
+# time since last active at which the activity part of the score halves
+USER_RANKING_ACTIVITY_HALF_LIFE = timedelta(days=7)
+# number of references at which the references part of the score maxes out
+USER_RANKING_MAX_REFERENCES = 10
+# distance at which the distance part of the score halves, in m
+USER_RANKING_DISTANCE_SCALE = 10000
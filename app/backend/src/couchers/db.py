@@ -1,25 +1,25 @@
 import functools
 import logging
 import os
-from contextlib import contextmanager
+import random
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from time import monotonic, perf_counter_ns
 
 from alembic import command
 from alembic.config import Config
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm.session import Session
 from sqlalchemy.pool import NullPool
-from sqlalchemy.sql import and_, func, literal, or_
+from sqlalchemy.sql import func, literal, text
 
 from couchers import config
-from couchers.models import (
-    Cluster,
-    ClusterRole,
-    ClusterSubscription,
-    FriendRelationship,
-    FriendStatus,
-    Node,
-    TimezoneArea,
-)
+from couchers.constants import FRIEND_IDS_CACHE_SIZE, FRIEND_IDS_CACHE_TTL, REPLICA_LAG_CHECK_INTERVAL
+from couchers.models import Cluster, ClusterRole, ClusterSubscription, Friendship, Node, TimezoneArea
 from couchers.sql import couchers_select as select
 
 logger = logging.getLogger(__name__)
@@ -38,8 +38,63 @@ def apply_migrations():
         os.chdir(cwd)
 
 
-@functools.lru_cache
-def _get_base_engine():
+class QueryStats:
+    """
+    The queries run within a track_queries block
+    """
+
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        # total time spent waiting on the database, in ms
+        self.duration = 0.0
+        # rows returned by SELECTs (and RETURNING clauses) as reported by the driver, not rows touched by writes
+        self.rows = 0
+        # the SQL of every query, only kept if asked for since it's a bit expensive
+        self.statements = [] if keep_statements else None
+
+
+# set while serving a call, see couchers.interceptors.TracingInterceptor
+_query_stats = ContextVar("query_stats", default=None)
+
+
+@contextmanager
+def track_queries(keep_statements=False):
+    """
+    Counts the queries run on this thread (or task) within this block, yields a QueryStats that's filled in as they run
+    """
+    stats = QueryStats(keep_statements)
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the execution context rather than the connection, so nothing is left behind if the statement fails and
+    # after_cursor_execute never runs
+    context._query_start = perf_counter_ns()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _query_stats.get()
+    if stats is None:
+        return
+    stats.count += 1
+    stats.duration += (perf_counter_ns() - context._query_start) / 1e6
+    if cursor.description is not None:
+        stats.rows += max(cursor.rowcount, 0)
+    if stats.statements is not None:
+        stats.statements.append(statement)
+
+
+def _track_queries_on(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+
+def _create_engine(connection_string):
     if config.config["IN_TEST"]:
         poolclass = NullPool
     else:
@@ -47,25 +102,145 @@ def _get_base_engine():
     # `future` enables SQLalchemy 2.0 behaviour
     # `pool_pre_ping` checks that the connections in the pool are alive before using them, which avoids the "server
     # closed the connection unexpectedly" errors
-    return create_engine(
-        config.config["DATABASE_CONNECTION_STRING"], future=True, pool_pre_ping=True, poolclass=poolclass
+    return _track_queries_on(create_engine(connection_string, future=True, pool_pre_ping=True, poolclass=poolclass))
+
+
+@functools.lru_cache
+def _get_base_engine():
+    return _create_engine(config.config["DATABASE_CONNECTION_STRING"])
+
+
+@functools.lru_cache
+def _get_replica_engines():
+    return tuple(
+        _create_engine(connection_string.strip())
+        for connection_string in config.config["DATABASE_REPLICA_CONNECTION_STRINGS"].split(",")
+        if connection_string.strip()
     )
 
 
-def get_engine(isolation_level=None):
+def dispose_engines():
     """
-    Creates an engine with the given isolation level.
+    Drops the connection pools inherited from the parent process after fork(), so this process opens its own
+    connections
+    """
+    _get_base_engine().dispose()
+    for engine in _get_replica_engines():
+        engine.dispose()
+    _get_async_engine.cache_clear()
+    _get_async_replica_engines.cache_clear()
+
+
+# replication lag in seconds, 0 if the database is not a replica or has replayed everything it has received
+_REPLICA_LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+# replica engine -> (monotonic time of next check, whether it was usable at the last check)
+_replica_status = {}
+_replica_status_lock = threading.Lock()
+
+
+def _cached_replica_status(engine):
+    """
+    Whether the replica was usable at its last check, or None if it's due to be checked again
+    """
+    with _replica_status_lock:
+        status = _replica_status.get(engine)
+    if status and status[0] > monotonic():
+        return status[1]
+    return None
+
+
+def _record_replica_status(engine, lag):
+    """
+    Records whether the replica is usable given its lag (None if it couldn't be checked) until the next check
+    """
+    usable = lag is not None and lag <= config.config["DATABASE_REPLICA_MAX_LAG"]
+    if lag is not None and not usable:
+        logger.warning(f"Replica {engine.url!r} is {lag} seconds behind, not using it")
+    with _replica_status_lock:
+        _replica_status[engine] = (monotonic() + REPLICA_LAG_CHECK_INTERVAL.total_seconds(), usable)
+    return usable
+
+
+def _replica_is_usable(engine):
+    """
+    Whether the replica is reachable and at most DATABASE_REPLICA_MAX_LAG seconds behind, checked at most once every
+    REPLICA_LAG_CHECK_INTERVAL
     """
-    # creates a shallow copy with the given isolation level
-    if not isolation_level:
+    usable = _cached_replica_status(engine)
+    if usable is not None:
+        return usable
+
+    try:
+        with engine.connect() as conn:
+            lag = conn.execute(_REPLICA_LAG_QUERY).scalar_one()
+    except Exception as e:
+        logger.warning(f"Couldn't check replica {engine.url!r}, not using it: {e}")
+        lag = None
+
+    return _record_replica_status(engine, lag)
+
+
+def get_replica_engine():
+    """
+    Picks a random read replica that isn't too far behind, or falls back to the primary if there is none
+    """
+    replicas = [engine for engine in _get_replica_engines() if _replica_is_usable(engine)]
+    if not replicas:
         return _get_base_engine()
-    else:
-        return _get_base_engine().execution_options(isolation_level=isolation_level)
+    return random.choice(replicas)
+
+
+def get_engine(isolation_level=None, readonly=False):
+    """
+    Creates an engine with the given isolation level.
+
+    Read-only engines run every transaction as READ ONLY, on a replica if there is a usable one.
+    """
+    options = {}
+    if isolation_level:
+        options["isolation_level"] = isolation_level
+    if readonly:
+        options["postgresql_readonly"] = True
+    engine = get_replica_engine() if readonly else _get_base_engine()
+    # creates a shallow copy with the given options
+    return engine.execution_options(**options) if options else engine
+
+
+# set while serving a method marked read_only in the proto, see couchers.interceptors.ReadOnlyInterceptor
+_readonly_sessions = ContextVar("readonly_sessions", default=False)
 
 
 @contextmanager
-def session_scope(isolation_level=None):
-    session = Session(get_engine(isolation_level=isolation_level), future=True)
+def readonly_sessions():
+    """
+    Makes session_scope default to read-only sessions within this block
+    """
+    token = _readonly_sessions.set(True)
+    try:
+        yield
+    finally:
+        _readonly_sessions.reset(token)
+
+
+@contextmanager
+def session_scope(isolation_level=None, readonly=None):
+    """
+    A session that commits at the end of the block, or rolls back if it raised.
+
+    Read-only sessions can't write, and are served from a read replica if one is configured, see get_engine. If
+    `readonly` is not given, sessions are read-only within a readonly_sessions block.
+    """
+    if readonly is None:
+        readonly = _readonly_sessions.get()
+    session = Session(get_engine(isolation_level=isolation_level, readonly=readonly), future=True)
     try:
         yield session
         session.commit()
@@ -76,28 +251,146 @@ def session_scope(isolation_level=None):
         session.close()
 
 
+def _create_async_engine(connection_string):
+    # the asyncio layer talks to the same databases through asyncpg, it's only used by the grpc.aio server
+    url = make_url(connection_string).set(drivername="postgresql+asyncpg")
+    if config.config["IN_TEST"]:
+        poolclass = NullPool
+    else:
+        poolclass = None
+    engine = create_async_engine(url, future=True, pool_pre_ping=True, poolclass=poolclass)
+    # cursor events only exist on the sync engine underneath, asyncpg calls still run through it on a greenlet
+    _track_queries_on(engine.sync_engine)
+    return engine
+
+
+@functools.lru_cache
+def _get_async_engine():
+    return _create_async_engine(config.config["DATABASE_CONNECTION_STRING"])
+
+
+@functools.lru_cache
+def _get_async_replica_engines():
+    return tuple(
+        _create_async_engine(connection_string.strip())
+        for connection_string in config.config["DATABASE_REPLICA_CONNECTION_STRINGS"].split(",")
+        if connection_string.strip()
+    )
+
+
+async def _async_replica_is_usable(engine):
+    """
+    The asyncio version of _replica_is_usable
+    """
+    usable = _cached_replica_status(engine)
+    if usable is not None:
+        return usable
+
+    try:
+        async with engine.connect() as conn:
+            lag = (await conn.execute(_REPLICA_LAG_QUERY)).scalar_one()
+    except Exception as e:
+        logger.warning(f"Couldn't check replica {engine.url!r}, not using it: {e}")
+        lag = None
+
+    return _record_replica_status(engine, lag)
+
+
+async def get_async_replica_engine():
+    """
+    The asyncio version of get_replica_engine
+    """
+    replicas = [engine for engine in _get_async_replica_engines() if await _async_replica_is_usable(engine)]
+    if not replicas:
+        return _get_async_engine()
+    return random.choice(replicas)
+
+
+@asynccontextmanager
+async def async_session_scope(readonly=None):
+    """
+    The asyncio version of session_scope, for servicers running on the grpc.aio server. Read-only sessions go to a
+    read replica in the same way.
+    """
+    if readonly is None:
+        readonly = _readonly_sessions.get()
+    if readonly:
+        engine = (await get_async_replica_engine()).execution_options(postgresql_readonly=True)
+    else:
+        engine = _get_async_engine()
+    session = AsyncSession(engine, future=True)
+    try:
+        yield session
+        await session.commit()
+    except:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
 def are_friends(session, context, other_user):
     return (
         session.execute(
-            select(FriendRelationship)
-            .where_users_column_visible(context, FriendRelationship.from_user_id)
-            .where_users_column_visible(context, FriendRelationship.to_user_id)
-            .where(
-                or_(
-                    and_(
-                        FriendRelationship.from_user_id == context.user_id, FriendRelationship.to_user_id == other_user
-                    ),
-                    and_(
-                        FriendRelationship.from_user_id == other_user, FriendRelationship.to_user_id == context.user_id
-                    ),
-                )
-            )
-            .where(FriendRelationship.status == FriendStatus.accepted)
+            select(Friendship)
+            .where_users_column_visible(context, Friendship.friend_id)
+            .where(Friendship.user_id == context.user_id)
+            .where(Friendship.friend_id == other_user)
         ).scalar_one_or_none()
         is not None
     )
 
 
+# user_id -> (expiry, sorted tuple of friend ids), in least recently used order
+_friend_ids_cache = OrderedDict()
+_friend_ids_cache_lock = threading.Lock()
+
+
+def get_friend_ids(session, user_id):
+    """
+    Gets the sorted ids of all friends of this user, including invisible ones, cached in-process.
+
+    Friendships are never removed, so a stale entry can only be missing some new friends. Entries expire after
+    FRIEND_IDS_CACHE_TTL so that changes made in other processes show up, and are dropped straight away by
+    invalidate_friend_ids in this one.
+    """
+    with _friend_ids_cache_lock:
+        cached = _friend_ids_cache.get(user_id)
+        if cached and cached[0] > monotonic():
+            _friend_ids_cache.move_to_end(user_id)
+            return cached[1]
+
+    friend_ids = tuple(
+        session.execute(
+            select(Friendship.friend_id).where(Friendship.user_id == user_id).order_by(Friendship.friend_id)
+        )
+        .scalars()
+        .all()
+    )
+
+    with _friend_ids_cache_lock:
+        _friend_ids_cache[user_id] = (monotonic() + FRIEND_IDS_CACHE_TTL.total_seconds(), friend_ids)
+        _friend_ids_cache.move_to_end(user_id)
+        while len(_friend_ids_cache) > FRIEND_IDS_CACHE_SIZE:
+            _friend_ids_cache.popitem(last=False)
+
+    return friend_ids
+
+
+def invalidate_friend_ids(*user_ids):
+    with _friend_ids_cache_lock:
+        for user_id in user_ids:
+            _friend_ids_cache.pop(user_id, None)
+
+
+def clear_friend_ids_cache():
+    """
+    Drops all cached friend lists, e.g. when the database is recreated in tests
+    """
+    with _friend_ids_cache_lock:
+        _friend_ids_cache.clear()
+
+
 def get_parent_node_at_location(session, shape):
     """
     Finds the smallest node containing the shape.
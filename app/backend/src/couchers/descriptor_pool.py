@@ -4,6 +4,12 @@ from pathlib import Path
 from google.protobuf import descriptor_pb2, descriptor_pool
 
 
+@functools.lru_cache
+def _get_file_descriptor_set():
+    with open(Path(__file__).parent / ".." / "proto" / "descriptors.pb", "rb") as descriptor_set_f:
+        return descriptor_pb2.FileDescriptorSet.FromString(descriptor_set_f.read())
+
+
 @functools.lru_cache
 def get_descriptor_pool():
     """
@@ -14,8 +20,18 @@ def get_descriptor_pool():
     from proto import annotations_pb2  # noqa
 
     pool = descriptor_pool.DescriptorPool()
-    with open(Path(__file__).parent / ".." / "proto" / "descriptors.pb", "rb") as descriptor_set_f:
-        desc = descriptor_pb2.FileDescriptorSet.FromString(descriptor_set_f.read())
-    for file_descriptor in desc.file:
+    for file_descriptor in _get_file_descriptor_set().file:
         pool.Add(file_descriptor)
     return pool
+
+
+def get_service_descriptors():
+    """
+    Returns the descriptors of all services defined in our proto API
+    """
+    pool = get_descriptor_pool()
+    return [
+        service
+        for file_descriptor in _get_file_descriptor_set().file
+        for service in pool.FindFileByName(file_descriptor.name).services_by_name.values()
+    ]
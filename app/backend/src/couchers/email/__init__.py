@@ -5,7 +5,7 @@ import yaml
 from jinja2 import Environment, FileSystemLoader
 
 from couchers import config
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import queue_job, queue_job_in_session
 from couchers.models import BackgroundJobType
 from proto.internal import jobs_pb2
 
@@ -78,7 +78,7 @@ def _render_email(template_file, template_args={}):
     return frontmatter, plain, html
 
 
-def queue_email(sender_name, sender_email, recipient, subject, plain, html):
+def _email_job(sender_name, sender_email, recipient, subject, plain, html):
     payload = jobs_pb2.SendEmailPayload(
         sender_name=sender_name,
         sender_email=sender_email,
@@ -87,15 +87,25 @@ def queue_email(sender_name, sender_email, recipient, subject, plain, html):
         plain=plain,
         html=html,
     )
-    queue_job(
-        job_type=BackgroundJobType.send_email,
-        payload=payload,
-    )
+    return BackgroundJobType.send_email, payload
+
+
+def queue_email(sender_name, sender_email, recipient, subject, plain, html, session=None):
+    """
+    Queues an email to be sent by the background worker.
+
+    If `session` is given, the job is added in that session and commits along with the caller's transaction.
+    """
+    job_type, payload = _email_job(sender_name, sender_email, recipient, subject, plain, html)
+    if session:
+        queue_job_in_session(session, job_type=job_type, payload=payload)
+    else:
+        queue_job(job_type=job_type, payload=payload)
 
 
-def enqueue_email_from_template(recipient, template_file, template_args={}):
+def _email_args_from_template(recipient, template_file, template_args):
     frontmatter, plain, html = _render_email(template_file, template_args)
-    queue_email(
+    return (
         config.NOTIFICATION_EMAIL_SENDER,
         config.config["NOTIFICATION_EMAIL_ADDRESS"],
         recipient,
@@ -103,3 +113,14 @@ def enqueue_email_from_template(recipient, template_file, template_args={}):
         plain,
         html,
     )
+
+
+def email_job_from_template(recipient, template_file, template_args={}):
+    """
+    Renders a template into a (job_type, payload) tuple suitable for couchers.jobs.enqueue.queue_jobs
+    """
+    return _email_job(*_email_args_from_template(recipient, template_file, template_args))
+
+
+def enqueue_email_from_template(recipient, template_file, template_args={}, session=None):
+    queue_email(*_email_args_from_template(recipient, template_file, template_args), session=session)
@@ -49,6 +49,9 @@ def create_cluster(
         content=DEFAULT_PAGE_CONTENT,
     )
     session.add(page_version)
+    session.flush()
+    # pick up the current version set by the trigger on page_versions
+    session.refresh(main_page)
     cluster.cluster_subscriptions.append(
         ClusterSubscription(
             user_id=creator_user_id,
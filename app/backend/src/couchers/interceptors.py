@@ -1,17 +1,26 @@
 import logging
 import os
-from copy import deepcopy
+import random
+from inspect import isawaitable, iscoroutinefunction
 from time import perf_counter_ns
 from traceback import format_exception
+from types import MappingProxyType
 
 import grpc
 import sentry_sdk
+from google.protobuf.message import Message
 from sqlalchemy.sql import func
 
 from couchers import errors
-from couchers.db import session_scope
-from couchers.descriptor_pool import get_descriptor_pool
-from couchers.metrics import servicer_duration_histogram
+from couchers.config import config
+from couchers.db import async_session_scope, readonly_sessions, session_scope, track_queries
+from couchers.descriptor_pool import get_service_descriptors
+from couchers.metrics import (
+    servicer_db_duration_histogram,
+    servicer_duration_histogram,
+    servicer_queries_histogram,
+    servicer_rows_histogram,
+)
 from couchers.models import APICall, User, UserSession
 from couchers.sql import couchers_select as select
 from couchers.utils import parse_api_key, parse_session_cookie
@@ -22,38 +31,45 @@ LOG_VERBOSE_PB = "LOG_VERBOSE_PB" in os.environ
 logger = logging.getLogger(__name__)
 
 
-def _try_get_and_update_user_details(token, is_api_key):
+def _get_and_update_user_details(session, token, is_api_key):
     """
-    Tries to get session and user info corresponding to this token.
+    Gets session and user info corresponding to this token in the given session.
 
     Also updates the user last active time, token last active time, and increments API call count.
     """
-    if not token:
+    result = session.execute(
+        select(User, UserSession)
+        .join(User, User.id == UserSession.user_id)
+        .where(UserSession.token == token)
+        .where(UserSession.is_valid)
+        .where(UserSession.is_api_key == is_api_key)
+    ).one_or_none()
+
+    if not result:
         return None
+    else:
+        user, user_session = result
 
-    with session_scope() as session:
-        result = session.execute(
-            select(User, UserSession)
-            .join(User, User.id == UserSession.user_id)
-            .where(UserSession.token == token)
-            .where(UserSession.is_valid)
-            .where(UserSession.is_api_key == is_api_key)
-        ).one_or_none()
-
-        if not result:
-            return None
-        else:
-            user, user_session = result
+        # update user last active time
+        user.last_active = func.now()
+
+        # let's update the token
+        user_session.last_seen = func.now()
+        user_session.api_calls += 1
+        session.flush()
 
-            # update user last active time
-            user.last_active = func.now()
+        return user.id, user.is_jailed, user.is_superuser
 
-            # let's update the token
-            user_session.last_seen = func.now()
-            user_session.api_calls += 1
-            session.flush()
 
-            return user.id, user.is_jailed, user.is_superuser
+def _try_get_and_update_user_details(token, is_api_key):
+    """
+    Tries to get session and user info corresponding to this token, see _get_and_update_user_details
+    """
+    if not token:
+        return None
+
+    with session_scope() as session:
+        return _get_and_update_user_details(session, token, is_api_key)
 
 
 def abort_handler(message, status_code):
@@ -67,78 +83,119 @@ def unauthenticated_handler(message="Unauthorized", status_code=grpc.StatusCode.
     return abort_handler(message, status_code)
 
 
-class AuthValidatorInterceptor(grpc.ServerInterceptor):
+# these don't depend on the call, so they can be shared
+_unimplemented_handler = abort_handler(
+    "API call does not exist. Please refresh and try again.", grpc.StatusCode.UNIMPLEMENTED
+)
+_internal_auth_error_handler = abort_handler("Internal authentication error.", grpc.StatusCode.INTERNAL)
+
+
+def _get_auth_levels():
     """
-    Extracts a session token from a cookie, and authenticates a user with that.
+    Maps the full method name, e.g. "/org.couchers.api.core.API/GetUser", to the auth level of its service.
 
-    Sets context.user_id and context.token if authenticated, otherwise
-    terminates the call with an UNAUTHENTICATED error code.
+    This is computed once up front so that on each call we only need a dict lookup instead of parsing the method name
+    and digging through the descriptor pool
+    """
+    auth_levels = MappingProxyType(
+        {
+            f"/{service.full_name}/{method.name}": service.GetOptions().Extensions[annotations_pb2.auth_level]
+            for service in get_service_descriptors()
+            for method in service.methods
+        }
+    )
+
+    assert set(auth_levels.values()) <= {
+        annotations_pb2.AUTH_LEVEL_UNKNOWN,
+        annotations_pb2.AUTH_LEVEL_OPEN,
+        annotations_pb2.AUTH_LEVEL_JAILED,
+        annotations_pb2.AUTH_LEVEL_SECURE,
+        annotations_pb2.AUTH_LEVEL_ADMIN,
+    }
+
+    return auth_levels
+
+
+class _Rejected(Exception):
+    """
+    Raised while authenticating a call that should be answered with `handler` instead of going to the servicer
     """
 
-    def __init__(self):
-        self._pool = get_descriptor_pool()
+    def __init__(self, handler):
+        self.handler = handler
 
-    def intercept_service(self, continuation, handler_call_details):
-        method = handler_call_details.method
-        # method is of the form "/org.couchers.api.core.API/GetUser"
-        _, service_name, method_name = method.split("/")
 
-        try:
-            service_options = self._pool.FindServiceByName(service_name).GetOptions()
-        except KeyError:
-            return abort_handler(
-                "API call does not exist. Please refresh and try again.", grpc.StatusCode.UNIMPLEMENTED
-            )
+def _get_credentials(auth_levels, handler_call_details):
+    """
+    Returns the auth level of the method and the (token, is_api_key) of the session the call came with
+    """
+    auth_level = auth_levels.get(handler_call_details.method)
 
-        auth_level = service_options.Extensions[annotations_pb2.auth_level]
+    if auth_level is None:
+        raise _Rejected(_unimplemented_handler)
 
-        # if unknown auth level, then it wasn't set and something's wrong
-        if auth_level == annotations_pb2.AUTH_LEVEL_UNKNOWN:
-            return abort_handler("Internal authentication error.", grpc.StatusCode.INTERNAL)
+    # if unknown auth level, then it wasn't set and something's wrong
+    if auth_level == annotations_pb2.AUTH_LEVEL_UNKNOWN:
+        raise _Rejected(_internal_auth_error_handler)
 
-        assert auth_level in [
-            annotations_pb2.AUTH_LEVEL_OPEN,
-            annotations_pb2.AUTH_LEVEL_JAILED,
-            annotations_pb2.AUTH_LEVEL_SECURE,
-            annotations_pb2.AUTH_LEVEL_ADMIN,
-        ]
+    headers = dict(handler_call_details.invocation_metadata)
 
-        headers = dict(handler_call_details.invocation_metadata)
+    if "cookie" in headers and "authorization" in headers:
+        # for security reasons, only one of "cookie" or "authorization" can be present
+        raise _Rejected(unauthenticated_handler('Both "cookie" and "authorization" in request'))
+    elif "cookie" in headers:
+        # the session token is passed in cookies, i.e. in the `cookie` header
+        return auth_level, parse_session_cookie(headers), False
+    elif "authorization" in headers:
+        # the session token is passed in the `authorization` header
+        return auth_level, parse_api_key(headers), True
+    else:
+        # no session found
+        return auth_level, None, False
 
-        if "cookie" in headers and "authorization" in headers:
-            # for security reasons, only one of "cookie" or "authorization" can be present
-            return unauthenticated_handler('Both "cookie" and "authorization" in request')
-        elif "cookie" in headers:
-            # the session token is passed in cookies, i.e. in the `cookie` header
-            token = parse_session_cookie(headers)
-            is_api_key = False
-            res = _try_get_and_update_user_details(token, is_api_key)
-        elif "authorization" in headers:
-            # the session token is passed in the `authorization` header
-            token = parse_api_key(headers)
-            is_api_key = True
-            res = _try_get_and_update_user_details(token, is_api_key)
-        else:
-            # no session found
-            token = None
-            is_api_key = False
-            res = None
-
-        # if no session was found and this isn't an open service, fail
-        if not token or not res:
-            if auth_level != annotations_pb2.AUTH_LEVEL_OPEN:
-                return unauthenticated_handler()
-            user_id = None
-        else:
-            # a valid user session was found
-            user_id, is_jailed, is_superuser = res
 
-            if auth_level == annotations_pb2.AUTH_LEVEL_ADMIN and not is_superuser:
-                return unauthenticated_handler("Permission denied", grpc.StatusCode.PERMISSION_DENIED)
+def _check_access(auth_level, token, res):
+    """
+    Checks that the session found for the call (`res` from _try_get_and_update_user_details) may call a method with
+    this auth level, returns the user id
+    """
+    # if no session was found and this isn't an open service, fail
+    if not token or not res:
+        if auth_level != annotations_pb2.AUTH_LEVEL_OPEN:
+            raise _Rejected(unauthenticated_handler())
+        return None
+
+    # a valid user session was found
+    user_id, is_jailed, is_superuser = res
 
-            # if the user is jailed and this is isn't an open or jailed service, fail
-            if is_jailed and auth_level not in [annotations_pb2.AUTH_LEVEL_OPEN, annotations_pb2.AUTH_LEVEL_JAILED]:
-                return unauthenticated_handler("Permission denied")
+    if auth_level == annotations_pb2.AUTH_LEVEL_ADMIN and not is_superuser:
+        raise _Rejected(unauthenticated_handler("Permission denied", grpc.StatusCode.PERMISSION_DENIED))
+
+    # if the user is jailed and this is isn't an open or jailed service, fail
+    if is_jailed and auth_level not in [annotations_pb2.AUTH_LEVEL_OPEN, annotations_pb2.AUTH_LEVEL_JAILED]:
+        raise _Rejected(unauthenticated_handler("Permission denied"))
+
+    return user_id
+
+
+class AuthValidatorInterceptor(grpc.ServerInterceptor):
+    """
+    Extracts a session token from a cookie, and authenticates a user with that.
+
+    Sets context.user_id and context.token if authenticated, otherwise
+    terminates the call with an UNAUTHENTICATED error code.
+    """
+
+    def __init__(self):
+        self._auth_levels = _get_auth_levels()
+
+    def intercept_service(self, continuation, handler_call_details):
+        try:
+            auth_level, token, is_api_key = _get_credentials(self._auth_levels, handler_call_details)
+            res = _try_get_and_update_user_details(token, is_api_key)
+            user_id = _check_access(auth_level, token, res)
+        except _Rejected as e:
+            return e.handler
 
         handler = continuation(handler_call_details)
         user_aware_function = handler.unary_unary
@@ -177,6 +234,120 @@ class ManualAuthValidatorInterceptor(grpc.ServerInterceptor):
         return continuation(handler_call_details)
 
 
+class ReadOnlyInterceptor(grpc.ServerInterceptor):
+    """
+    Serves methods marked with the read_only option in the proto with read-only database sessions, which go to a read
+    replica if one is configured.
+
+    This needs to be the innermost interceptor, so that only the servicer itself runs with read-only sessions.
+    """
+
+    def __init__(self):
+        self._read_only_methods = frozenset(
+            f"/{service.full_name}/{method.name}"
+            for service in get_service_descriptors()
+            for method in service.methods
+            if method.GetOptions().Extensions[annotations_pb2.read_only]
+        )
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+
+        if not handler or handler_call_details.method not in self._read_only_methods:
+            return handler
+
+        prev_func = handler.unary_unary
+
+        def read_only_function(req, context):
+            with readonly_sessions():
+                return prev_func(req, context)
+
+        return grpc.unary_unary_rpc_method_handler(
+            read_only_function,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+
+# message full name -> tuple of sensitive fields, see _get_sensitive_fields
+_sensitive_fields_cache = {}
+
+
+def _submessage_type(field):
+    """
+    The message type held in this field, or the value type for maps, or None if it doesn't hold messages
+    """
+    if not field.message_type:
+        return None
+    if field.message_type.GetOptions().map_entry:
+        return field.message_type.fields_by_name["value"].message_type
+    return field.message_type
+
+
+def _has_sensitive_fields(descriptor):
+    """
+    Whether this message type or any message type reachable from it has fields marked sensitive
+    """
+    seen = set()
+    to_visit = [descriptor]
+    while to_visit:
+        current = to_visit.pop()
+        if current.full_name in seen:
+            continue
+        seen.add(current.full_name)
+        for field in current.fields:
+            if field.GetOptions().Extensions[annotations_pb2.sensitive]:
+                return True
+            submessage_type = _submessage_type(field)
+            if submessage_type:
+                to_visit.append(submessage_type)
+    return False
+
+
+def _get_sensitive_fields(descriptor):
+    """
+    Returns a tuple of (field name, nested, container) for the fields of this message type that need to be stripped
+    before logging. `nested` is None if the field itself is marked sensitive, otherwise it is the descriptor of the
+    submessage type that has sensitive fields somewhere inside it. `container` is "map" for maps of submessages, and
+    "message" for singular or repeated submessages.
+
+    This only looks at the descriptors once per message type. Only finished results go in the cache, so concurrent
+    calls at worst work it out twice, and recursive message types are handled by _has_sensitive_fields.
+    """
+    sensitive_fields = _sensitive_fields_cache.get(descriptor.full_name)
+    if sensitive_fields is not None:
+        return sensitive_fields
+
+    sensitive_fields = []
+    for field in descriptor.fields:
+        if field.GetOptions().Extensions[annotations_pb2.sensitive]:
+            sensitive_fields.append((field.name, None, None))
+            continue
+        submessage_type = _submessage_type(field)
+        if submessage_type and _has_sensitive_fields(submessage_type):
+            container = "map" if field.message_type.GetOptions().map_entry else "message"
+            sensitive_fields.append((field.name, submessage_type, container))
+
+    sensitive_fields = tuple(sensitive_fields)
+    _sensitive_fields_cache[descriptor.full_name] = sensitive_fields
+    return sensitive_fields
+
+
+def _clear_sensitive_fields(proto, sensitive_fields):
+    for name, nested, container in sensitive_fields:
+        if nested is None:
+            proto.ClearField(name)
+        elif container == "map":
+            for item in getattr(proto, name).values():
+                _clear_sensitive_fields(item, _get_sensitive_fields(nested))
+        elif isinstance(getattr(proto, name), Message):
+            if proto.HasField(name):
+                _clear_sensitive_fields(getattr(proto, name), _get_sensitive_fields(nested))
+        else:
+            for item in getattr(proto, name):
+                _clear_sensitive_fields(item, _get_sensitive_fields(nested))
+
+
 class TracingInterceptor(grpc.ServerInterceptor):
     """
     Measures and logs the time it takes to service each incoming call.
@@ -184,36 +355,64 @@ class TracingInterceptor(grpc.ServerInterceptor):
 
     def _sanitized_bytes(self, proto):
         """
-        Remove fields marked sensitive and return serialized bytes
+        Remove fields marked sensitive and return serialized bytes, or None if the message is too big to log
         """
         if not proto:
             return None
-        new_proto = deepcopy(proto)
-        for name, descriptor in new_proto.DESCRIPTOR.fields_by_name.items():
-            if descriptor.GetOptions().Extensions[annotations_pb2.sensitive]:
-                new_proto.ClearField(name)
+        if proto.ByteSize() > config["API_CALLS_LOG_MAX_BYTES"]:
+            return None
+        data = proto.SerializeToString()
+        sensitive_fields = _get_sensitive_fields(proto.DESCRIPTOR)
+        if not sensitive_fields:
+            return data
+        # only the few message types that carry sensitive fields pay for a copy, and we don't want to touch the message
+        # that's being handed back to grpc
+        new_proto = type(proto).FromString(data)
+        _clear_sensitive_fields(new_proto, sensitive_fields)
         return new_proto.SerializeToString()
 
-    def _observe_in_histogram(self, method, status_code, exception_type, duration):
+    def _track_queries(self):
+        # only hang on to the SQL if we might log it
+        return track_queries(keep_statements=config["API_CALLS_LOG_QUERIES_THRESHOLD"] > 0)
+
+    def _observe_in_histogram(self, method, status_code, exception_type, duration, query_stats):
         servicer_duration_histogram.labels(method, status_code, exception_type).observe(duration)
+        servicer_queries_histogram.labels(method).observe(query_stats.count)
+        servicer_db_duration_histogram.labels(method).observe(query_stats.duration)
+        servicer_rows_histogram.labels(method).observe(query_stats.rows)
+
+    def _api_call(self, method, status_code, duration, user_id, is_api_key, request, response, traceback, query_stats):
+        # always keep the bodies of failed calls, but only a sample of successful ones
+        if traceback or random.random() < config["API_CALLS_LOG_SAMPLE_RATE"]:
+            req_bytes = self._sanitized_bytes(request)
+            res_bytes = self._sanitized_bytes(response)
+        else:
+            req_bytes = None
+            res_bytes = None
+        logger.debug(f"{user_id=}, {method=}, {duration=} ms, queries={query_stats.count}")
+        threshold = config["API_CALLS_LOG_QUERIES_THRESHOLD"]
+        if threshold and query_stats.count > threshold:
+            statements = "\n".join(query_stats.statements)
+            logger.warning(
+                f"{method} ran {query_stats.count} queries taking {query_stats.duration:.1f} ms:\n{statements}"
+            )
+        return APICall(
+            is_api_key=is_api_key,
+            method=method,
+            status_code=status_code,
+            duration=duration,
+            user_id=user_id,
+            request=req_bytes,
+            response=res_bytes,
+            traceback=traceback,
+            query_count=query_stats.count,
+            query_duration=query_stats.duration,
+            query_rows=query_stats.rows,
+        )
 
-    def _store_log(self, method, status_code, duration, user_id, is_api_key, request, response, traceback):
-        req_bytes = self._sanitized_bytes(request)
-        res_bytes = self._sanitized_bytes(response)
+    def _store_log(self, *args):
         with session_scope() as session:
-            session.add(
-                APICall(
-                    is_api_key=is_api_key,
-                    method=method,
-                    status_code=status_code,
-                    duration=duration,
-                    user_id=user_id,
-                    request=req_bytes,
-                    response=res_bytes,
-                    traceback=traceback,
-                )
-            )
-        logger.debug(f"{user_id=}, {method=}, {duration=} ms")
+            session.add(self._api_call(*args))
 
     def intercept_service(self, continuation, handler_call_details):
         handler = continuation(handler_call_details)
@@ -223,13 +422,14 @@ class TracingInterceptor(grpc.ServerInterceptor):
         def tracing_function(request, context):
             try:
                 start = perf_counter_ns()
-                res = prev_func(request, context)
+                with self._track_queries() as query_stats:
+                    res = prev_func(request, context)
                 finished = perf_counter_ns()
                 duration = (finished - start) / 1e6  # ms
                 user_id = getattr(context, "user_id", None)
                 is_api_key = getattr(context, "is_api_key", None)
-                self._store_log(method, None, duration, user_id, is_api_key, request, res, None)
-                self._observe_in_histogram(method, "", "", duration)
+                self._store_log(method, None, duration, user_id, is_api_key, request, res, None, query_stats)
+                self._observe_in_histogram(method, "", "", duration, query_stats)
             except Exception as e:
                 finished = perf_counter_ns()
                 duration = (finished - start) / 1e6  # ms
@@ -237,8 +437,8 @@ class TracingInterceptor(grpc.ServerInterceptor):
                 traceback = "".join(format_exception(type(e), e, e.__traceback__))
                 user_id = getattr(context, "user_id", None)
                 is_api_key = getattr(context, "is_api_key", None)
-                self._store_log(method, code, duration, user_id, is_api_key, request, None, traceback)
-                self._observe_in_histogram(method, code or "", type(e).__name__, duration)
+                self._store_log(method, code, duration, user_id, is_api_key, request, None, traceback, query_stats)
+                self._observe_in_histogram(method, code or "", type(e).__name__, duration, query_stats)
 
                 if not code:
                     sentry_sdk.set_tag("context", "servicer")
@@ -286,3 +486,224 @@ class ErrorSanitizationInterceptor(grpc.ServerInterceptor):
             request_deserializer=handler.request_deserializer,
             response_serializer=handler.response_serializer,
         )
+
+
+class _AioContext:
+    """
+    grpc.aio hands servicers Cython context objects that can't take new attributes, and the one given to synchronous
+    handlers has no code(). This wraps them so that interceptors and servicers can use them like the contexts of the
+    sync server.
+    """
+
+    def __init__(self, context):
+        self._context = context
+        self._code = None
+
+    @classmethod
+    def wrap(cls, context):
+        return context if isinstance(context, cls) else cls(context)
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def abort(self, code, details=""):
+        self._code = code
+        res = self._context.abort(code, details)
+        if isawaitable(res):
+            return res
+        # aborting from a sync handler on grpc.aio returns, but our servicers rely on abort() raising like it does on the
+        # sync server
+        raise grpc.aio.AbortError()
+
+    def set_code(self, code):
+        self._code = code
+        self._context.set_code(code)
+
+    def code(self):
+        return self._code
+
+
+def _aio_handler(handler, sync_function, async_function):
+    """
+    Wraps the handler with `async_function` if it's a coroutine, otherwise with `sync_function`, which grpc.aio runs on
+    its thread pool
+    """
+    return grpc.unary_unary_rpc_method_handler(
+        async_function if iscoroutinefunction(handler.unary_unary) else sync_function,
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer,
+    )
+
+
+async def _try_get_and_update_user_details_async(token, is_api_key):
+    """
+    The asyncio version of _try_get_and_update_user_details
+    """
+    if not token:
+        return None
+
+    async with async_session_scope(readonly=False) as session:
+        # the same ORM code, run on the asyncio session's connection
+        return await session.run_sync(_get_and_update_user_details, token, is_api_key)
+
+
+class AioAuthValidatorInterceptor(grpc.aio.ServerInterceptor):
+    """
+    AuthValidatorInterceptor for the grpc.aio server
+    """
+
+    def __init__(self):
+        self._auth_levels = _get_auth_levels()
+
+    async def intercept_service(self, continuation, handler_call_details):
+        try:
+            auth_level, token, is_api_key = _get_credentials(self._auth_levels, handler_call_details)
+            res = await _try_get_and_update_user_details_async(token, is_api_key)
+            user_id = _check_access(auth_level, token, res)
+        except _Rejected as e:
+            return e.handler
+
+        handler = await continuation(handler_call_details)
+        user_aware_function = handler.unary_unary
+
+        def set_user(context):
+            context = _AioContext.wrap(context)
+            context.user_id = user_id
+            context.token = token
+            context.is_api_key = is_api_key
+            return context
+
+        def user_unaware_function(req, context):
+            return user_aware_function(req, set_user(context))
+
+        async def async_user_unaware_function(req, context):
+            return await user_aware_function(req, set_user(context))
+
+        return _aio_handler(handler, user_unaware_function, async_user_unaware_function)
+
+
+class AioReadOnlyInterceptor(ReadOnlyInterceptor, grpc.aio.ServerInterceptor):
+    """
+    ReadOnlyInterceptor for the grpc.aio server
+    """
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+
+        if not handler or handler_call_details.method not in self._read_only_methods:
+            return handler
+
+        prev_func = handler.unary_unary
+
+        # sync handlers run on a thread pool, so the context variable needs to be set on that thread
+        def read_only_function(req, context):
+            with readonly_sessions():
+                return prev_func(req, context)
+
+        async def async_read_only_function(req, context):
+            with readonly_sessions():
+                return await prev_func(req, context)
+
+        return _aio_handler(handler, read_only_function, async_read_only_function)
+
+
+class AioTracingInterceptor(TracingInterceptor, grpc.aio.ServerInterceptor):
+    """
+    TracingInterceptor for the grpc.aio server
+    """
+
+    async def _store_log_async(self, *args):
+        async with async_session_scope(readonly=False) as session:
+            session.add(self._api_call(*args))
+
+    def _on_success(self, method, duration, request, context, res, query_stats):
+        user_id = getattr(context, "user_id", None)
+        is_api_key = getattr(context, "is_api_key", None)
+        self._observe_in_histogram(method, "", "", duration, query_stats)
+        return (method, None, duration, user_id, is_api_key, request, res, None, query_stats)
+
+    def _on_error(self, method, duration, request, context, e, query_stats):
+        code = getattr(context.code(), "name", None)
+        traceback = "".join(format_exception(type(e), e, e.__traceback__))
+        user_id = getattr(context, "user_id", None)
+        is_api_key = getattr(context, "is_api_key", None)
+        self._observe_in_histogram(method, code or "", type(e).__name__, duration, query_stats)
+
+        if not code:
+            sentry_sdk.set_tag("context", "servicer")
+            sentry_sdk.set_tag("method", method)
+            sentry_sdk.capture_exception(e)
+
+        return (method, code, duration, user_id, is_api_key, request, None, traceback, query_stats)
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        prev_func = handler.unary_unary
+        method = handler_call_details.method
+
+        def tracing_function(request, context):
+            context = _AioContext.wrap(context)
+            start = perf_counter_ns()
+            try:
+                with self._track_queries() as query_stats:
+                    res = prev_func(request, context)
+            except Exception as e:
+                duration = (perf_counter_ns() - start) / 1e6
+                self._store_log(*self._on_error(method, duration, request, context, e, query_stats))
+                raise e
+            duration = (perf_counter_ns() - start) / 1e6
+            self._store_log(*self._on_success(method, duration, request, context, res, query_stats))
+            return res
+
+        async def async_tracing_function(request, context):
+            context = _AioContext.wrap(context)
+            start = perf_counter_ns()
+            try:
+                # the context variable follows the call into the greenlets SQLAlchemy runs asyncpg on
+                with self._track_queries() as query_stats:
+                    res = await prev_func(request, context)
+            except Exception as e:
+                duration = (perf_counter_ns() - start) / 1e6
+                await self._store_log_async(*self._on_error(method, duration, request, context, e, query_stats))
+                raise e
+            duration = (perf_counter_ns() - start) / 1e6
+            await self._store_log_async(*self._on_success(method, duration, request, context, res, query_stats))
+            return res
+
+        return _aio_handler(handler, tracing_function, async_tracing_function)
+
+
+class AioErrorSanitizationInterceptor(grpc.aio.ServerInterceptor):
+    """
+    ErrorSanitizationInterceptor for the grpc.aio server, this needs to go first too
+    """
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        prev_func = handler.unary_unary
+
+        def sanitizing_function(req, context):
+            context = _AioContext.wrap(context)
+            try:
+                return prev_func(req, context)
+            except Exception as e:
+                if context.code():
+                    logger.warning(f"RPC error: {context.code()}")
+                    raise e
+                logger.exception(e)
+                logger.info(f"Probably an unknown error! Sanitizing...")
+                context.abort(grpc.StatusCode.INTERNAL, errors.UNKNOWN_ERROR)
+
+        async def async_sanitizing_function(req, context):
+            context = _AioContext.wrap(context)
+            try:
+                return await prev_func(req, context)
+            except Exception as e:
+                if context.code():
+                    logger.warning(f"RPC error: {context.code()}")
+                    raise e
+                logger.exception(e)
+                logger.info(f"Probably an unknown error! Sanitizing...")
+                await context.abort(grpc.StatusCode.INTERNAL, errors.UNKNOWN_ERROR)
+
+        return _aio_handler(handler, sanitizing_function, async_sanitizing_function)
@@ -4,13 +4,17 @@ from google.protobuf import empty_pb2
 
 from couchers.jobs.handlers import (
     process_add_users_to_email_list,
+    process_check_thread_counts,
     process_enforce_community_membership,
+    process_maintain_api_call_logs,
+    process_purge_background_jobs,
     process_purge_login_tokens,
     process_send_email,
     process_send_message_notifications,
     process_send_onboarding_emails,
     process_send_reference_reminders,
     process_send_request_notifications,
+    process_update_user_ranking_features,
 )
 from couchers.models import BackgroundJobType
 from proto.internal import jobs_pb2
@@ -25,6 +29,10 @@ JOBS = {
     BackgroundJobType.send_request_notifications: (empty_pb2.Empty, process_send_request_notifications),
     BackgroundJobType.enforce_community_membership: (empty_pb2.Empty, process_enforce_community_membership),
     BackgroundJobType.send_reference_reminders: (empty_pb2.Empty, process_send_reference_reminders),
+    BackgroundJobType.purge_background_jobs: (empty_pb2.Empty, process_purge_background_jobs),
+    BackgroundJobType.maintain_api_call_logs: (empty_pb2.Empty, process_maintain_api_call_logs),
+    BackgroundJobType.update_user_ranking_features: (empty_pb2.Empty, process_update_user_ranking_features),
+    BackgroundJobType.check_thread_counts: (empty_pb2.Empty, process_check_thread_counts),
 }
 
 SCHEDULE = [
@@ -35,4 +43,8 @@ SCHEDULE = [
     (BackgroundJobType.send_request_notifications, timedelta(minutes=3)),
     (BackgroundJobType.enforce_community_membership, timedelta(minutes=15)),
     (BackgroundJobType.send_reference_reminders, timedelta(hours=1)),
+    (BackgroundJobType.purge_background_jobs, timedelta(hours=24)),
+    (BackgroundJobType.maintain_api_call_logs, timedelta(hours=24)),
+    (BackgroundJobType.update_user_ranking_features, timedelta(hours=1)),
+    (BackgroundJobType.check_thread_counts, timedelta(hours=24)),
 ]
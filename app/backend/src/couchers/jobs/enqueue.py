@@ -4,18 +4,50 @@ Background jobs
 
 import logging
 
+from sqlalchemy.sql import insert
+
 from couchers.db import session_scope
 from couchers.models import BackgroundJob, BackgroundJobType
 
 logger = logging.getLogger(__name__)
 
 
+def _job_values(job_type: BackgroundJobType, payload, max_tries=None):
+    return {
+        "job_type": job_type,
+        "payload": payload.SerializeToString(),
+        # every row of a multi-row INSERT needs the same columns, so fill in the model default by hand
+        "max_tries": max_tries if max_tries is not None else BackgroundJob.max_tries.default.arg,
+    }
+
+
+def queue_jobs_in_session(session, jobs):
+    """
+    Queues many jobs with one multi-row INSERT in the caller's session, so the jobs are committed (or rolled back)
+    atomically with whatever else happens in that transaction.
+
+    `jobs` is an iterable of (job_type, payload) or (job_type, payload, max_tries) tuples. Returns the list of new job
+    ids.
+    """
+    values = [_job_values(*job) for job in jobs]
+    if not values:
+        return []
+    return session.execute(insert(BackgroundJob).values(values).returning(BackgroundJob.id)).scalars().all()
+
+
+def queue_jobs(jobs):
+    """
+    Queues many jobs in their own transaction, see queue_jobs_in_session
+    """
+    with session_scope() as session:
+        return queue_jobs_in_session(session, jobs)
+
+
+def queue_job_in_session(session, job_type: BackgroundJobType, payload, max_tries=None):
+    (job_id,) = queue_jobs_in_session(session, [(job_type, payload, max_tries)])
+    return job_id
+
+
 def queue_job(job_type: BackgroundJobType, payload, max_tries=None):
     with session_scope() as session:
-        job = BackgroundJob(
-            job_type=job_type,
-            payload=payload.SerializeToString(),
-            max_tries=max_tries,
-        )
-        session.add(job)
-        return job.id
+        return queue_job_in_session(session, job_type, payload, max_tries)
@@ -3,30 +3,55 @@ Background job servicers
 """
 
 import logging
-from datetime import timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
 
 import requests
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import aliased
-from sqlalchemy.sql import and_, delete, func, literal, or_, union_all
+from sqlalchemy.sql import and_, case, delete, func, literal, or_, text, union_all, update
 
 from couchers import config, email, urls
+from couchers.constants import (
+    API_CALLS_PARTITIONS_AHEAD,
+    BACKGROUND_JOB_COMPLETED_RETENTION,
+    BACKGROUND_JOB_FAILED_RETENTION,
+    MAILCHIMP_BATCH_SIZE,
+    USER_RANKING_ACTIVITY_HALF_LIFE,
+    USER_RANKING_ACTIVITY_WEIGHT,
+    USER_RANKING_HOSTING_WEIGHT,
+    USER_RANKING_MAX_REFERENCES,
+    USER_RANKING_REFERENCES_WEIGHT,
+)
 from couchers.db import session_scope
 from couchers.email.dev import print_dev_email
 from couchers.email.smtp import send_smtp_email
+from couchers.jobs.enqueue import queue_jobs_in_session
+from couchers.metrics import job_rows_counter
 from couchers.models import (
+    APICall,
+    APICallRollup,
+    BackgroundJob,
+    BackgroundJobState,
+    Comment,
     GroupChat,
     GroupChatSubscription,
+    HostingStatus,
     HostRequest,
     LoginToken,
     Message,
     MessageType,
     Reference,
+    Reply,
+    Thread,
     User,
+    UserRankingFeatures,
 )
-from couchers.servicers.blocking import are_blocked
+from couchers.servicers.blocking import blocked_between
 from couchers.sql import couchers_select as select
-from couchers.tasks import enforce_community_memberships, send_onboarding_email, send_reference_reminder_email
-from couchers.utils import now
+from couchers.tasks import enforce_community_memberships, onboarding_email_job, reference_reminder_email_job
+from couchers.utils import now, today, utc
 
 logger = logging.getLogger(__name__)
 
@@ -56,6 +81,155 @@ def process_purge_login_tokens(payload):
         )
 
 
+def process_purge_background_jobs(payload):
+    """
+    Deletes finished background jobs (and their payloads, which can be whole rendered emails) once they are past their
+    retention window, so the job queue doesn't grow without bound
+    """
+    logger.info(f"Purging old background jobs")
+    batch_size = 10000
+    with session_scope() as session:
+        while True:
+            purgeable_ids = (
+                select(BackgroundJob.id)
+                .where(
+                    or_(
+                        and_(
+                            BackgroundJob.state == BackgroundJobState.completed,
+                            BackgroundJob.queued < now() - BACKGROUND_JOB_COMPLETED_RETENTION,
+                        ),
+                        and_(
+                            BackgroundJob.state == BackgroundJobState.failed,
+                            BackgroundJob.queued < now() - BACKGROUND_JOB_FAILED_RETENTION,
+                        ),
+                    )
+                )
+                .limit(batch_size)
+            )
+            # delete in batches to keep transactions short, the first run may have a lot of catching up to do
+            deleted = session.execute(
+                delete(BackgroundJob)
+                .where(BackgroundJob.id.in_(purgeable_ids.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            session.commit()
+            logger.info(f"Purged {deleted} background jobs")
+            if deleted < batch_size:
+                break
+
+
+def _api_calls_partition_name(day):
+    return f"api_calls_p{day:%Y%m%d}"
+
+
+def _day_bounds(day):
+    start = datetime.combine(day, time(0, 0), tzinfo=utc)
+    return start, start + timedelta(days=1)
+
+
+def _create_api_calls_partition(session, day):
+    """
+    Creates the daily partition of logging.api_calls for the given (UTC) day if it doesn't exist yet
+    """
+    start, end = _day_bounds(day)
+    # postgres refuses to create a partition if the default partition already has rows that would belong in it, in
+    # which case those rows just stay in the default partition until they expire
+    if session.execute(
+        text("SELECT EXISTS (SELECT 1 FROM logging.api_calls_default WHERE time >= :start AND time < :end)"),
+        {"start": start, "end": end},
+    ).scalar_one():
+        logger.warning(f"Not creating API call log partition for {day}, default partition has rows for it")
+        return
+    session.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS logging.{_api_calls_partition_name(day)} PARTITION OF logging.api_calls "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    )
+
+
+def _api_calls_partition_days(session):
+    """
+    Returns the days for which there is currently a daily partition of logging.api_calls
+    """
+    names = session.execute(
+        text(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            JOIN pg_namespace ON pg_namespace.oid = parent.relnamespace
+            WHERE pg_namespace.nspname = 'logging' AND parent.relname = 'api_calls'
+            """
+        )
+    ).scalars()
+    return [datetime.strptime(name, "api_calls_p%Y%m%d").date() for name in names if name != "api_calls_default"]
+
+
+def _roll_up_api_calls(session, start, end):
+    """
+    Computes hourly per-method aggregates of the API calls between start and end into logging.api_call_rollups
+    """
+    hour = func.date_trunc("hour", APICall.time).label("hour")
+    rollups = (
+        select(
+            hour,
+            APICall.method,
+            func.count(),
+            func.count().filter(APICall.status_code != None),
+            func.percentile_cont(0.5).within_group(APICall.duration),
+            func.percentile_cont(0.95).within_group(APICall.duration),
+            func.percentile_cont(0.99).within_group(APICall.duration),
+        )
+        .where(APICall.time >= start)
+        .where(APICall.time < end)
+        .group_by("hour", APICall.method)
+    )
+    columns = ["hour", "method", "count", "error_count", "duration_p50", "duration_p95", "duration_p99"]
+    stmt = insert(APICallRollup).from_select(columns, rollups)
+    # if we died half way through last time, just recompute those hours
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["hour", "method"], set_={column: stmt.excluded[column] for column in columns[2:]}
+    )
+    session.execute(stmt)
+
+
+def process_maintain_api_call_logs(payload):
+    """
+    Creates upcoming daily partitions of the API call logs, and rolls up then drops the ones past the retention period
+    """
+    logger.info(f"Maintaining API call log partitions")
+
+    with session_scope() as session:
+        for days_ahead in range(API_CALLS_PARTITIONS_AHEAD + 1):
+            _create_api_calls_partition(session, today() + timedelta(days=days_ahead))
+            session.commit()
+
+        cutoff = today() - timedelta(days=config.config["API_CALLS_RETENTION_DAYS"])
+
+        expired_days = {day for day in _api_calls_partition_days(session) if day < cutoff}
+
+        # anything that ended up in the default partition expires the same way
+        oldest_default = session.execute(text("SELECT min(time) FROM logging.api_calls_default")).scalar_one()
+        if oldest_default:
+            day = oldest_default.astimezone(utc).date()
+            while day < cutoff:
+                expired_days.add(day)
+                day += timedelta(days=1)
+
+        for day in sorted(expired_days):
+            logger.info(f"Rolling up and dropping API call logs for {day}")
+            start, end = _day_bounds(day)
+            _roll_up_api_calls(session, start, end)
+            session.execute(text(f"DROP TABLE IF EXISTS logging.{_api_calls_partition_name(day)}"))
+            session.execute(
+                text("DELETE FROM logging.api_calls_default WHERE time >= :start AND time < :end"),
+                {"start": start, "end": end},
+            )
+            session.commit()
+
+
 def process_send_message_notifications(payload):
     """
     Sends out email notifications for messages that have been unseen for a long enough time
@@ -113,10 +287,10 @@ def process_send_message_notifications(payload):
             ).all()
 
             user.last_notified_message_id = max(message.id for _, message, _ in unseen_messages)
-            session.commit()
 
             total_unseen_message_count = sum(count for _, _, count in unseen_messages)
 
+            # queued in this session so the email and the notification marker are committed together
             email.enqueue_email_from_template(
                 user.email,
                 "unseen_messages",
@@ -128,7 +302,9 @@ def process_send_message_notifications(payload):
                     ],
                     "group_chats_link": urls.messages_link(),
                 },
+                session=session,
             )
+            session.commit()
 
 
 def process_send_request_notifications(payload):
@@ -166,7 +342,6 @@ def process_send_request_notifications(payload):
 
         for user, host_request, max_message_id in surfing_reqs:
             user.last_notified_request_message_id = max(user.last_notified_request_message_id, max_message_id)
-            session.commit()
 
             email.enqueue_email_from_template(
                 user.email,
@@ -176,11 +351,12 @@ def process_send_request_notifications(payload):
                     "host_request": host_request,
                     "host_request_link": urls.host_request_link_guest(),
                 },
+                session=session,
             )
+            session.commit()
 
         for user, host_request, max_message_id in hosting_reqs:
             user.last_notified_request_message_id = max(user.last_notified_request_message_id, max_message_id)
-            session.commit()
 
             email.enqueue_email_from_template(
                 user.email,
@@ -190,46 +366,70 @@ def process_send_request_notifications(payload):
                     "host_request": host_request,
                     "host_request_link": urls.host_request_link_host(),
                 },
+                session=session,
             )
+            session.commit()
 
 
-def process_send_onboarding_emails(payload):
+def _send_onboarding_emails_in_chunks(email_number, *criteria):
     """
-    Sends out onboarding emails
+    Sends onboarding email number `email_number` to all visible users matching `criteria`.
+
+    Users are walked in keyset-paginated chunks of ONBOARDING_EMAILS_CHUNK_SIZE, each chunk in its own transaction, so
+    a large backlog neither builds up a huge identity map nor holds one long transaction open.
     """
-    logger.info(f"Sending out onboarding emails")
+    chunk_size = config.config["ONBOARDING_EMAILS_CHUNK_SIZE"]
+    last_user_id = 0
 
-    with session_scope() as session:
-        # first onboarding email
-        users = (
-            session.execute(select(User).where(User.is_visible).where(User.onboarding_emails_sent == 0)).scalars().all()
-        )
+    while True:
+        with session_scope() as session:
+            users = (
+                session.execute(
+                    select(User)
+                    .where(User.is_visible)
+                    .where(*criteria)
+                    .where(User.id > last_user_id)
+                    .order_by(User.id)
+                    .limit(chunk_size)
+                )
+                .scalars()
+                .all()
+            )
 
-        for user in users:
-            send_onboarding_email(user, email_number=1)
-            user.onboarding_emails_sent = 1
-            user.last_onboarding_email_sent = now()
-            session.commit()
+            if not users:
+                return
 
-        # second onboarding email
-        # sent after a week if the user has no profile or their "about me" section is less than 20 characters long
-        users = (
+            user_ids = [user.id for user in users]
+            queue_jobs_in_session(session, [onboarding_email_job(user, email_number) for user in users])
             session.execute(
-                select(User)
-                .where(User.is_visible)
-                .where(User.onboarding_emails_sent == 1)
-                .where(now() - User.last_onboarding_email_sent > timedelta(days=7))
-                .where(User.has_completed_profile == False)
+                update(User)
+                .where(User.id.in_(user_ids))
+                .values(onboarding_emails_sent=email_number, last_onboarding_email_sent=func.now())
+                .execution_options(synchronize_session=False)
             )
-            .scalars()
-            .all()
-        )
 
-        for user in users:
-            send_onboarding_email(user, email_number=2)
-            user.onboarding_emails_sent = 2
-            user.last_onboarding_email_sent = now()
-            session.commit()
+        logger.info(f"Queued onboarding email {email_number} for {len(user_ids)} users up to user #{user_ids[-1]}")
+        job_rows_counter.labels("send_onboarding_emails", f"onboarding{email_number}").inc(len(user_ids))
+        last_user_id = user_ids[-1]
+
+
+def process_send_onboarding_emails(payload):
+    """
+    Sends out onboarding emails
+    """
+    logger.info(f"Sending out onboarding emails")
+
+    # first onboarding email
+    _send_onboarding_emails_in_chunks(1, User.onboarding_emails_sent == 0)
+
+    # second onboarding email
+    # sent after a week if the user has no profile or their "about me" section is less than 20 characters long
+    _send_onboarding_emails_in_chunks(
+        2,
+        User.onboarding_emails_sent == 1,
+        now() - User.last_onboarding_email_sent > timedelta(days=7),
+        User.has_completed_profile == False,
+    )
 
 
 def process_send_reference_reminders(payload):
@@ -272,7 +472,8 @@ def process_send_reference_reminders(payload):
                 .where(Reference.id == None)
                 .where(HostRequest.can_write_reference)
                 .where(HostRequest.surfer_sent_reference_reminders < reminder_no)
-                .where(HostRequest.end_time + reminder_time < now())
+                .where(~blocked_between(user.id, other_user.id))
+                .where(HostRequest.end_time < now() - reminder_time)
             )
 
             # hosts needing to write a ref
@@ -293,7 +494,8 @@ def process_send_reference_reminders(payload):
                 .where(Reference.id == None)
                 .where(HostRequest.can_write_reference)
                 .where(HostRequest.host_sent_reference_reminders < reminder_no)
-                .where(HostRequest.end_time + reminder_time < now())
+                .where(~blocked_between(user.id, other_user.id))
+                .where(HostRequest.end_time < now() - reminder_time)
             )
 
             union = union_all(q1, q2).subquery()
@@ -305,62 +507,247 @@ def process_send_reference_reminders(payload):
             )
             reference_reminders = session.execute(union).all()
 
-            for surfed, host_request, user, other_user in reference_reminders:
-                # checked in sql
-                assert user.is_visible
-                if not are_blocked(session, user.id, other_user.id):
-                    send_reference_reminder_email(user, other_user, host_request, surfed, reminder_text)
-                    if surfed:
-                        host_request.surfer_sent_reference_reminders = reminder_no
-                    else:
-                        host_request.host_sent_reference_reminders = reminder_no
-                    session.commit()
+            surfer_ids = [host_request.conversation_id for surfed, host_request, _, _ in reference_reminders if surfed]
+            host_ids = [
+                host_request.conversation_id for surfed, host_request, _, _ in reference_reminders if not surfed
+            ]
+
+            queue_jobs_in_session(
+                session,
+                [
+                    reference_reminder_email_job(user, other_user, host_request, surfed, reminder_text)
+                    for surfed, host_request, user, other_user in reference_reminders
+                ],
+            )
+
+            # one statement marks this reminder as sent for every request in the pass
+            session.execute(
+                update(HostRequest)
+                .where(HostRequest.conversation_id.in_(surfer_ids + host_ids))
+                .values(
+                    surfer_sent_reference_reminders=case(
+                        [(HostRequest.conversation_id.in_(surfer_ids), reminder_no)],
+                        else_=HostRequest.surfer_sent_reference_reminders,
+                    ),
+                    host_sent_reference_reminders=case(
+                        [(HostRequest.conversation_id.in_(host_ids), reminder_no)],
+                        else_=HostRequest.host_sent_reference_reminders,
+                    ),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            # the emails and flags of a pass are committed together, so a failed run can't send duplicates
+            session.commit()
+
+            logger.info(f"Queued {len(reference_reminders)} reference reminder emails for reminder {reminder_no}")
+            job_rows_counter.labels("send_reference_reminders", f"reminder_{reminder_no}").inc(len(reference_reminders))
+
+
+def _add_batch_to_email_list(http_session, batch):
+    """
+    Sends one batch of (user_id, email, name) tuples to Mailchimp, returns the ids of the users that were added
+    """
+    base_url = config.config["MAILCHIMP_BASE_URL"] or f"https://{config.config['MAILCHIMP_DC']}.api.mailchimp.com/3.0"
+    body = {
+        "members": [
+            {
+                "email_address": email_address,
+                "status_if_new": "subscribed",
+                "merge_fields": {
+                    "FNAME": name,
+                },
+            }
+            for _, email_address, name in batch
+        ],
+        # members who are already on the list come back in updated_members instead of as errors, their status is left
+        # alone since there is no "status", so anyone who unsubscribed stays unsubscribed
+        "update_existing": True,
+    }
+
+    r = http_session.post(
+        f"{base_url}/lists/{config.config['MAILCHIMP_LIST_ID']}",
+        auth=("apikey", config.config["MAILCHIMP_API_KEY"]),
+        json=body,
+        timeout=60,
+    )
+    r.raise_for_status()
+    res = r.json()
+
+    for error in res.get("errors", []):
+        logger.warning(f"Failed to add {error.get('email_address')} to mailing list: {error.get('error')}")
+
+    added_emails = {member["email_address"].lower() for member in res["new_members"] + res["updated_members"]}
+    return [user_id for user_id, email_address, _ in batch if email_address.lower() in added_emails]
 
 
 def process_add_users_to_email_list(payload):
+    """
+    Adds all users not yet on the mailing list to it.
+
+    Users are paged through by id, MAILCHIMP_CONCURRENCY batches of MAILCHIMP_BATCH_SIZE at a time, and each batch is
+    sent to Mailchimp on its own thread. Users are marked as added one by one from Mailchimp's response, so if a member
+    or a whole batch fails only those users are tried again on the next run.
+    """
     if not config.config["MAILCHIMP_ENABLED"]:
         logger.info(f"Not adding users to mailing list")
         return
 
     logger.info(f"Adding users to mailing list")
 
+    concurrency = config.config["MAILCHIMP_CONCURRENCY"]
+    last_user_id = 0
+    failed_batches = 0
+
+    # requests.Session isn't thread-safe, so each worker thread gets its own, which it reuses for all its batches
+    thread_local = threading.local()
+    http_sessions = []
+
+    def add_batch(batch):
+        if not hasattr(thread_local, "http_session"):
+            thread_local.http_session = requests.Session()
+            http_sessions.append(thread_local.http_session)
+        return _add_batch_to_email_list(thread_local.http_session, batch)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            with session_scope() as session:
+                users = session.execute(
+                    select(User.id, User.email, User.name)
+                    .where(User.is_visible)
+                    .where(User.added_to_mailing_list == False)
+                    .where(User.id > last_user_id)
+                    .order_by(User.id)
+                    .limit(MAILCHIMP_BATCH_SIZE * concurrency)
+                ).all()
+
+            if not users:
+                break
+
+            last_user_id = users[-1].id
+            batches = [users[i : i + MAILCHIMP_BATCH_SIZE] for i in range(0, len(users), MAILCHIMP_BATCH_SIZE)]
+
+            added_user_ids = []
+            for batch, future in [(batch, executor.submit(add_batch, batch)) for batch in batches]:
+                try:
+                    added_user_ids += future.result()
+                except Exception as e:
+                    logger.exception(f"Failed to add batch of {len(batch)} users to mailing list", exc_info=e)
+                    failed_batches += 1
+
+            with session_scope() as session:
+                session.execute(
+                    update(User)
+                    .where(User.id.in_(added_user_ids))
+                    .values(added_to_mailing_list=True)
+                    .execution_options(synchronize_session=False)
+                )
+
+            logger.info(f"Added {len(added_user_ids)} of {len(users)} users to mailing list")
+            job_rows_counter.labels("add_users_to_email_list", "added").inc(len(added_user_ids))
+            job_rows_counter.labels("add_users_to_email_list", "failed").inc(len(users) - len(added_user_ids))
+
+    for http_session in http_sessions:
+        http_session.close()
+
+    if failed_batches:
+        raise Exception(f"Failed to send {failed_batches} batches of users to mailing list")
+
+
+def process_enforce_community_membership(payload):
+    enforce_community_memberships()
+
+
+def process_update_user_ranking_features(payload):
+    """
+    Recomputes the features used to rank user search results
+    """
+    logger.info(f"Updating user ranking features")
+    num_references = (
+        select(Reference.to_user_id.label("user_id"), func.count().label("num_references"))
+        .join(User, User.id == Reference.from_user_id)
+        .where(~User.is_deleted)
+        .group_by(Reference.to_user_id)
+        .subquery()
+    )
+    user_num_references = func.coalesce(num_references.c.num_references, 0)
+    inactive_for = func.extract("epoch", func.now() - User.last_active)
+    score = (
+        USER_RANKING_ACTIVITY_WEIGHT * 1.0 / (1 + inactive_for / USER_RANKING_ACTIVITY_HALF_LIFE.total_seconds())
+        + USER_RANKING_HOSTING_WEIGHT
+        * case(
+            [(User.hosting_status == HostingStatus.can_host, 1.0), (User.hosting_status == HostingStatus.maybe, 0.5)],
+            else_=0.0,
+        )
+        + USER_RANKING_REFERENCES_WEIGHT
+        * func.least(user_num_references, USER_RANKING_MAX_REFERENCES)
+        / float(USER_RANKING_MAX_REFERENCES)
+    )
     with session_scope() as session:
-        users = (
-            session.execute(select(User).where(User.is_visible).where(User.added_to_mailing_list == False).limit(100))
+        insert_statement = insert(UserRankingFeatures).from_select(
+            ["user_id", "num_references", "score"],
+            select(User.id, user_num_references, score).outerjoin(num_references, num_references.c.user_id == User.id),
+        )
+        session.execute(
+            insert_statement.on_conflict_do_update(
+                index_elements=[UserRankingFeatures.user_id],
+                set_={
+                    "num_references": insert_statement.excluded.num_references,
+                    "score": insert_statement.excluded.score,
+                    "updated": func.now(),
+                },
+            )
+        )
+
+
+def process_check_thread_counts(payload):
+    """
+    Recounts comments and replies, and fixes any comment or thread whose maintained counter has drifted
+    """
+    logger.info(f"Checking thread counts")
+    with session_scope() as session:
+        num_replies = (
+            select(Comment.id, func.count(Reply.id).label("num_replies"))
+            .outerjoin(Reply, Reply.comment_id == Comment.id)
+            .group_by(Comment.id)
+            .subquery()
+        )
+        fixed_comment_ids = (
+            session.execute(
+                update(Comment)
+                .where(Comment.id == num_replies.c.id)
+                .where(Comment.num_replies != num_replies.c.num_replies)
+                .values(num_replies=num_replies.c.num_replies)
+                .returning(Comment.id)
+                .execution_options(synchronize_session=False)
+            )
             .scalars()
             .all()
         )
 
-        if not users:
-            logger.info(f"No users to add to mailing list")
-            return
-
-        auth = ("apikey", config.config["MAILCHIMP_API_KEY"])
-
-        body = {
-            "members": [
-                {
-                    "email_address": user.email,
-                    "status_if_new": "subscribed",
-                    "status": "subscribed",
-                    "merge_fields": {
-                        "FNAME": user.name,
-                    },
-                }
-                for user in users
-            ]
-        }
-
-        dc = config.config["MAILCHIMP_DC"]
-        list_id = config.config["MAILCHIMP_LIST_ID"]
-        r = requests.post(f"https://{dc}.api.mailchimp.com/3.0/lists/{list_id}", auth=auth, json=body)
-        if r.status_code == 200:
-            for user in users:
-                user.added_to_mailing_list = True
-            session.commit()
-        else:
-            raise Exception("Failed to add users to mailing list")
-
+        # the comment counts are correct by now
+        num_responses = (
+            select(
+                Thread.id,
+                (func.count(Comment.id) + func.coalesce(func.sum(Comment.num_replies), 0)).label("num_responses"),
+            )
+            .outerjoin(Comment, Comment.thread_id == Thread.id)
+            .group_by(Thread.id)
+            .subquery()
+        )
+        fixed_thread_ids = (
+            session.execute(
+                update(Thread)
+                .where(Thread.id == num_responses.c.id)
+                .where(Thread.num_responses != num_responses.c.num_responses)
+                .values(num_responses=num_responses.c.num_responses)
+                .returning(Thread.id)
+                .execution_options(synchronize_session=False)
+            )
+            .scalars()
+            .all()
+        )
 
-def process_enforce_community_membership(payload):
-    enforce_community_memberships()
+    if fixed_comment_ids or fixed_thread_ids:
+        logger.warning(
+            f"Fixed reply counts of comments {fixed_comment_ids} and response counts of threads {fixed_thread_ids}"
+        )
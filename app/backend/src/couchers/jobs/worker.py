@@ -6,7 +6,7 @@ import traceback
 from datetime import timedelta
 from multiprocessing import Process
 from sched import scheduler
-from time import monotonic, sleep
+from time import monotonic, perf_counter_ns, sleep
 
 import sentry_sdk
 from google.protobuf import empty_pb2
@@ -14,7 +14,7 @@ from google.protobuf import empty_pb2
 from couchers.db import get_engine, session_scope
 from couchers.jobs.definitions import JOBS, SCHEDULE
 from couchers.jobs.enqueue import queue_job
-from couchers.metrics import create_prometheus_server, job_process_registry, jobs_counter
+from couchers.metrics import create_prometheus_server, job_process_registry, jobs_counter, jobs_duration_histogram
 from couchers.models import BackgroundJob, BackgroundJobState
 from couchers.sql import couchers_select as select
 
@@ -51,6 +51,7 @@ def process_job():
 
         message_type, func = JOBS[job.job_type]
 
+        start = perf_counter_ns()
         try:
             ret = func(message_type.FromString(job.payload))
             job.state = BackgroundJobState.completed
@@ -75,6 +76,8 @@ def process_job():
             jobs_counter.labels(job.job_type.name, job.state.name, str(job.try_count), type(e).__name__).inc()
             job.failure_info = traceback.format_exc()
 
+        jobs_duration_histogram.labels(job.job_type.name, job.state.name).observe((perf_counter_ns() - start) / 1e6)
+
         # exiting ctx manager commits and releases the row lock
     return True
 
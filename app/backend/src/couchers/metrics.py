@@ -1,6 +1,8 @@
+import os
 import threading
+from pathlib import Path
 
-from prometheus_client import Counter, Histogram, exposition
+from prometheus_client import Counter, Histogram, exposition, multiprocess
 from prometheus_client.registry import CollectorRegistry
 
 JOB_LABEL = "job"
@@ -9,8 +11,12 @@ STATUS_LABEL = "status"
 METHOD_LABEL = "method"
 CODE_LABEL = "code"
 EXCEPTION_LABEL = "exception"
+STEP_LABEL = "step"
 
 main_process_registry = CollectorRegistry()
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    # every process writes its metrics to files in this directory, and the main process serves them all added up
+    multiprocess.MultiProcessCollector(main_process_registry)
 job_process_registry = CollectorRegistry()
 jobs_counter = Counter(
     "jobs",
@@ -18,6 +24,19 @@ jobs_counter = Counter(
     labelnames=(JOB_LABEL, STATUS_LABEL, ATTEMPT_LABEL, EXCEPTION_LABEL),
     registry=job_process_registry,
 )
+jobs_duration_histogram = Histogram(
+    "jobs_duration",
+    "Durations of processing jobs",
+    labelnames=(JOB_LABEL, STATUS_LABEL),
+    buckets=(10, 50, 100, 500, 1000, 5000, 10000, 60000, 300000, 1800000),
+    registry=job_process_registry,
+)
+job_rows_counter = Counter(
+    "job_rows",
+    "Number of rows handled by batched jobs",
+    labelnames=(JOB_LABEL, STEP_LABEL),
+    registry=job_process_registry,
+)
 
 servicer_duration_histogram = Histogram(
     "servicer_duration",
@@ -25,6 +44,24 @@ servicer_duration_histogram = Histogram(
     labelnames=(METHOD_LABEL, CODE_LABEL, EXCEPTION_LABEL),
     buckets=(1, 5, 20, 50, 100, 200, 500, 1000, 5000, 10000),
 )
+servicer_queries_histogram = Histogram(
+    "servicer_queries",
+    "Number of database queries run by gRPC calls",
+    labelnames=(METHOD_LABEL,),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+servicer_db_duration_histogram = Histogram(
+    "servicer_db_duration",
+    "Time gRPC calls spent waiting on the database",
+    labelnames=(METHOD_LABEL,),
+    buckets=(1, 5, 20, 50, 100, 200, 500, 1000, 5000, 10000),
+)
+servicer_rows_histogram = Histogram(
+    "servicer_rows",
+    "Number of rows returned by the database to gRPC calls",
+    labelnames=(METHOD_LABEL,),
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000),
+)
 
 
 def create_prometheus_server(registry, port):
@@ -37,3 +74,13 @@ def create_prometheus_server(registry, port):
     t.daemon = True
     t.start()
     return httpd
+
+
+def clear_multiprocess_metrics():
+    """
+    Removes metrics left over in PROMETHEUS_MULTIPROC_DIR from a previous run, needs to be called before starting any
+    other processes
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        for path in Path(os.environ["PROMETHEUS_MULTIPROC_DIR"]).glob("*.db"):
+            path.unlink()
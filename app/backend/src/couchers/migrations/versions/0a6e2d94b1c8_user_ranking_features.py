@@ -0,0 +1,32 @@
+"""Add user ranking features for ordering user search by relevance
+
+Revision ID: 0a6e2d94b1c8
+Revises: f3a0c6d28e54
+Create Date: 2021-10-25 09:31:52.604117
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0a6e2d94b1c8"
+down_revision = "f3a0c6d28e54"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TYPE backgroundjobtype ADD VALUE 'update_user_ranking_features'")
+    op.create_table(
+        "user_ranking_features",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("num_references", sa.Integer(), nullable=False),
+        sa.Column("score", sa.Float(), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], name=op.f("fk_user_ranking_features_user_id_users")),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_user_ranking_features")),
+    )
+
+
+def downgrade():
+    raise Exception("Can't downgrade")
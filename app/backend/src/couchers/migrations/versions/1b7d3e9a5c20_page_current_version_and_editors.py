@@ -0,0 +1,86 @@
+"""Add current version pointer, created time and editors table for pages
+
+Revision ID: 1b7d3e9a5c20
+Revises: 0a6e2d94b1c8
+Create Date: 2021-10-26 14:03:19.552107
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "1b7d3e9a5c20"
+down_revision = "0a6e2d94b1c8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("pages", sa.Column("current_version_id", sa.BigInteger(), nullable=True))
+    op.add_column(
+        "pages", sa.Column("created", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False)
+    )
+    op.create_unique_constraint(op.f("uq_pages_current_version_id"), "pages", ["current_version_id"])
+    op.create_foreign_key(
+        op.f("fk_pages_current_version_id_page_versions"), "pages", "page_versions", ["current_version_id"], ["id"]
+    )
+    op.create_table(
+        "page_editors",
+        sa.Column("page_id", sa.BigInteger(), nullable=False),
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("first_version_id", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["first_version_id"], ["page_versions.id"], name=op.f("fk_page_editors_first_version_id_page_versions")
+        ),
+        sa.ForeignKeyConstraint(["page_id"], ["pages.id"], name=op.f("fk_page_editors_page_id_pages")),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], name=op.f("fk_page_editors_user_id_users")),
+        sa.PrimaryKeyConstraint("page_id", "user_id", name=op.f("pk_page_editors")),
+    )
+    op.execute(
+        """
+CREATE FUNCTION page_versions_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE pages SET current_version_id = NEW.id
+    WHERE id = NEW.page_id AND (current_version_id IS NULL OR current_version_id < NEW.id);
+    INSERT INTO page_editors (page_id, user_id, first_version_id)
+    VALUES (NEW.page_id, NEW.editor_user_id, NEW.id)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER page_versions_update_pages
+AFTER INSERT ON page_versions
+FOR EACH ROW EXECUTE PROCEDURE page_versions_inserted();
+"""
+    )
+    op.execute(
+        """
+        UPDATE pages
+        SET current_version_id = versions.current_version_id, created = versions.created
+        FROM (
+            SELECT page_id, max(id) AS current_version_id, min(created) AS created
+            FROM page_versions
+            GROUP BY page_id
+        ) AS versions
+        WHERE pages.id = versions.page_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO page_editors (page_id, user_id, first_version_id)
+        SELECT page_id, editor_user_id, min(id)
+        FROM page_versions
+        GROUP BY page_id, editor_user_id
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER page_versions_update_pages ON page_versions")
+    op.execute("DROP FUNCTION page_versions_inserted()")
+    op.drop_table("page_editors")
+    op.drop_constraint(op.f("fk_pages_current_version_id_page_versions"), "pages", type_="foreignkey")
+    op.drop_constraint(op.f("uq_pages_current_version_id"), "pages", type_="unique")
+    op.drop_column("pages", "created")
+    op.drop_column("pages", "current_version_id")
@@ -0,0 +1,43 @@
+"""Add maintained response counters to threads and comments
+
+Revision ID: 2c8e4f1a7b39
+Revises: 1b7d3e9a5c20
+Create Date: 2021-10-27 11:26:40.918263
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2c8e4f1a7b39"
+down_revision = "1b7d3e9a5c20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TYPE backgroundjobtype ADD VALUE 'check_thread_counts'")
+    op.add_column("threads", sa.Column("num_responses", sa.Integer(), server_default=sa.text("0"), nullable=False))
+    op.add_column("comments", sa.Column("num_replies", sa.Integer(), server_default=sa.text("0"), nullable=False))
+    op.execute(
+        """
+        UPDATE comments
+        SET num_replies = counts.num_replies
+        FROM (SELECT comment_id, count(*) AS num_replies FROM replies GROUP BY comment_id) AS counts
+        WHERE comments.id = counts.comment_id
+        """
+    )
+    op.execute(
+        """
+        UPDATE threads
+        SET num_responses = counts.num_responses
+        FROM (
+            SELECT thread_id, count(*) + sum(num_replies) AS num_responses FROM comments GROUP BY thread_id
+        ) AS counts
+        WHERE threads.id = counts.thread_id
+        """
+    )
+
+
+def downgrade():
+    raise Exception("Can't downgrade")
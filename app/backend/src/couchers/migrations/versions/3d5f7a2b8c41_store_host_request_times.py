@@ -0,0 +1,61 @@
+"""Store host request start and end times instead of computing them per query
+
+Revision ID: 3d5f7a2b8c41
+Revises: 2c8e4f1a7b39
+Create Date: 2021-10-28 09:47:05.271634
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3d5f7a2b8c41"
+down_revision = "2c8e4f1a7b39"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("host_requests", sa.Column("start_time", sa.DateTime(timezone=True), nullable=True))
+    op.add_column("host_requests", sa.Column("end_time", sa.DateTime(timezone=True), nullable=True))
+    op.add_column("host_requests", sa.Column("end_time_to_write_reference", sa.DateTime(timezone=True), nullable=True))
+    op.execute(
+        """
+CREATE FUNCTION host_requests_set_times() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.start_time := timezone('Etc/UTC', NEW.from_date::timestamp);
+    NEW.end_time := timezone('Etc/UTC', NEW.to_date::timestamp) + interval '1 days';
+    NEW.end_time_to_write_reference := timezone('Etc/UTC', NEW.to_date::timestamp) + interval '15 days';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER host_requests_set_times
+BEFORE INSERT OR UPDATE ON host_requests
+FOR EACH ROW EXECUTE PROCEDURE host_requests_set_times();
+"""
+    )
+    # fires the trigger for every row
+    op.execute("UPDATE host_requests SET from_date = from_date")
+    op.alter_column("host_requests", "start_time", nullable=False)
+    op.alter_column("host_requests", "end_time", nullable=False)
+    op.alter_column("host_requests", "end_time_to_write_reference", nullable=False)
+    op.create_index(op.f("ix_host_requests_start_time"), "host_requests", ["start_time"], unique=False)
+    op.create_index(op.f("ix_host_requests_end_time"), "host_requests", ["end_time"], unique=False)
+    op.create_index(
+        op.f("ix_host_requests_end_time_to_write_reference"),
+        "host_requests",
+        ["end_time_to_write_reference"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_host_requests_end_time_to_write_reference"), table_name="host_requests")
+    op.drop_index(op.f("ix_host_requests_end_time"), table_name="host_requests")
+    op.drop_index(op.f("ix_host_requests_start_time"), table_name="host_requests")
+    op.execute("DROP TRIGGER host_requests_set_times ON host_requests")
+    op.execute("DROP FUNCTION host_requests_set_times()")
+    op.drop_column("host_requests", "end_time_to_write_reference")
+    op.drop_column("host_requests", "end_time")
+    op.drop_column("host_requests", "start_time")
@@ -0,0 +1,28 @@
+"""Add database query stats to API call logs
+
+Revision ID: 4e8b1c6d2f93
+Revises: 3d5f7a2b8c41
+Create Date: 2021-10-30 11:21:48.703529
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4e8b1c6d2f93"
+down_revision = "3d5f7a2b8c41"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # adding the columns to the partitioned table adds them to all its partitions
+    op.add_column("api_calls", sa.Column("query_count", sa.Integer(), nullable=True), schema="logging")
+    op.add_column("api_calls", sa.Column("query_duration", sa.Float(), nullable=True), schema="logging")
+    op.add_column("api_calls", sa.Column("query_rows", sa.Integer(), nullable=True), schema="logging")
+
+
+def downgrade():
+    op.drop_column("api_calls", "query_rows", schema="logging")
+    op.drop_column("api_calls", "query_duration", schema="logging")
+    op.drop_column("api_calls", "query_count", schema="logging")
@@ -0,0 +1,28 @@
+"""Index user ranking features by score so relevance search can walk it
+
+Revision ID: 7b2d9e4f1a06
+Revises: 4e8b1c6d2f93
+Create Date: 2021-10-31 10:12:37.418205
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7b2d9e4f1a06"
+down_revision = "4e8b1c6d2f93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_user_ranking_features_score_user_id",
+        "user_ranking_features",
+        [sa.text("score DESC"), sa.text("user_id DESC")],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_user_ranking_features_score_user_id", table_name="user_ranking_features")
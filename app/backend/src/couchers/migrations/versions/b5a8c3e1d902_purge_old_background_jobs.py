@@ -0,0 +1,30 @@
+"""Purge old background jobs
+
+Revision ID: b5a8c3e1d902
+Revises: 1c809d111871
+Create Date: 2021-10-20 10:12:47.129031
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b5a8c3e1d902"
+down_revision = "1c809d111871"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TYPE backgroundjobtype ADD VALUE 'purge_background_jobs'")
+    op.create_index(
+        "ix_background_jobs_lookup",
+        "background_jobs",
+        ["next_attempt_after"],
+        unique=False,
+        postgresql_where=sa.text("state = 'pending' OR state = 'error'"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_background_jobs_lookup", table_name="background_jobs")
@@ -0,0 +1,93 @@
+"""Partition api_calls by day, add hourly rollups
+
+Revision ID: c81f5e2a4b37
+Revises: b5a8c3e1d902
+Create Date: 2021-10-21 14:38:02.557120
+
+"""
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sa
+from alembic import op
+
+from couchers.constants import API_CALLS_PARTITIONS_AHEAD
+
+# revision identifiers, used by Alembic.
+revision = "c81f5e2a4b37"
+down_revision = "b5a8c3e1d902"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TYPE backgroundjobtype ADD VALUE 'maintain_api_call_logs'")
+
+    # move the old table out of the way
+    op.execute("ALTER TABLE logging.api_calls RENAME TO api_calls_unpartitioned")
+    op.execute(
+        "ALTER TABLE logging.api_calls_unpartitioned RENAME CONSTRAINT pk_api_calls TO pk_api_calls_unpartitioned"
+    )
+    op.execute("ALTER SEQUENCE logging.api_calls_id_seq RENAME TO api_calls_unpartitioned_id_seq")
+
+    op.create_table(
+        "api_calls",
+        sa.Column("id", sa.BigInteger(), autoincrement=True, nullable=False),
+        sa.Column("is_api_key", sa.Boolean(), server_default=sa.text("false"), nullable=False),
+        sa.Column("version", sa.String(), nullable=False),
+        sa.Column("time", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.Column("method", sa.String(), nullable=False),
+        sa.Column("status_code", sa.String(), nullable=True),
+        sa.Column("duration", sa.Float(), nullable=False),
+        sa.Column("user_id", sa.BigInteger(), nullable=True),
+        sa.Column("request", sa.LargeBinary(), nullable=True),
+        sa.Column("response", sa.LargeBinary(), nullable=True),
+        sa.Column("traceback", sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint("id", "time", name=op.f("pk_api_calls")),
+        schema="logging",
+        postgresql_partition_by="RANGE (time)",
+    )
+    op.execute("CREATE TABLE logging.api_calls_default PARTITION OF logging.api_calls DEFAULT")
+
+    # create daily partitions for the existing logs so they don't all end up in the default partition, and for the
+    # coming days like the maintain_api_call_logs job does, otherwise new calls would land in the default partition
+    # and block creating today's partition
+    conn = op.get_bind()
+    days = set(
+        conn.execute(
+            sa.text("SELECT DISTINCT (time AT TIME ZONE 'Etc/UTC')::date FROM logging.api_calls_unpartitioned")
+        ).scalars()
+    )
+    today = datetime.now(timezone.utc).date()
+    days.update(today + timedelta(days=days_ahead) for days_ahead in range(API_CALLS_PARTITIONS_AHEAD + 1))
+    for day in sorted(days):
+        op.execute(
+            f"CREATE TABLE logging.api_calls_p{day:%Y%m%d} PARTITION OF logging.api_calls "
+            f"FOR VALUES FROM ('{day.isoformat()} 00:00+00') TO ('{(day + timedelta(days=1)).isoformat()} 00:00+00')"
+        )
+
+    op.execute(
+        """
+        INSERT INTO logging.api_calls (id, is_api_key, version, time, method, status_code, duration, user_id, request, response, traceback)
+        SELECT id, is_api_key, version, time, method, status_code, duration, user_id, request, response, traceback
+        FROM logging.api_calls_unpartitioned
+        """
+    )
+    op.execute("SELECT setval('logging.api_calls_id_seq', max(id)) FROM logging.api_calls HAVING max(id) IS NOT NULL")
+    op.execute("DROP TABLE logging.api_calls_unpartitioned")
+
+    op.create_table(
+        "api_call_rollups",
+        sa.Column("hour", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("method", sa.String(), nullable=False),
+        sa.Column("count", sa.BigInteger(), nullable=False),
+        sa.Column("error_count", sa.BigInteger(), nullable=False),
+        sa.Column("duration_p50", sa.Float(), nullable=False),
+        sa.Column("duration_p95", sa.Float(), nullable=False),
+        sa.Column("duration_p99", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("hour", "method", name=op.f("pk_api_call_rollups")),
+        schema="logging",
+    )
+
+
+def downgrade():
+    raise Exception("Can't downgrade")
@@ -0,0 +1,73 @@
+"""Add symmetric friendships table maintained by trigger
+
+Revision ID: d4e7a1b9c2f0
+Revises: c81f5e2a4b37
+Create Date: 2021-10-22 10:12:44.301853
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d4e7a1b9c2f0"
+down_revision = "c81f5e2a4b37"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "friendships",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("friend_id", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(["friend_id"], ["users.id"], name=op.f("fk_friendships_friend_id_users")),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], name=op.f("fk_friendships_user_id_users")),
+        sa.PrimaryKeyConstraint("user_id", "friend_id", name=op.f("pk_friendships")),
+    )
+    op.execute(
+        """
+CREATE FUNCTION refresh_friendship(a BIGINT, b BIGINT) RETURNS VOID AS $$
+BEGIN
+    DELETE FROM friendships WHERE (user_id = a AND friend_id = b) OR (user_id = b AND friend_id = a);
+    IF EXISTS (
+        SELECT 1 FROM friend_relationships
+        WHERE status = 'accepted'
+        AND ((from_user_id = a AND to_user_id = b) OR (from_user_id = b AND to_user_id = a))
+    ) THEN
+        INSERT INTO friendships (user_id, friend_id) VALUES (a, b), (b, a) ON CONFLICT DO NOTHING;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION friend_relationships_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM refresh_friendship(OLD.from_user_id, OLD.to_user_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM refresh_friendship(NEW.from_user_id, NEW.to_user_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER friend_relationships_update_friendships
+AFTER INSERT OR UPDATE OR DELETE ON friend_relationships
+FOR EACH ROW EXECUTE PROCEDURE friend_relationships_changed();
+"""
+    )
+    op.execute(
+        """
+        INSERT INTO friendships (user_id, friend_id)
+        SELECT from_user_id, to_user_id FROM friend_relationships WHERE status = 'accepted'
+        UNION
+        SELECT to_user_id, from_user_id FROM friend_relationships WHERE status = 'accepted'
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER friend_relationships_update_friendships ON friend_relationships")
+    op.execute("DROP FUNCTION friend_relationships_changed()")
+    op.execute("DROP FUNCTION refresh_friendship(BIGINT, BIGINT)")
+    op.drop_table("friendships")
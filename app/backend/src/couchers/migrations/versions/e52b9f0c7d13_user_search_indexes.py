@@ -0,0 +1,52 @@
+"""Add indexes for user search filters and trigram text matching
+
+Revision ID: e52b9f0c7d13
+Revises: d4e7a1b9c2f0
+Create Date: 2021-10-23 16:05:31.948210
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e52b9f0c7d13"
+down_revision = "d4e7a1b9c2f0"
+branch_labels = None
+depends_on = None
+
+text_columns = [
+    "name",
+    "username",
+    "city",
+    "hometown",
+    "about_me",
+    "my_travels",
+    "things_i_like",
+    "about_place",
+    "additional_information",
+]
+
+
+def upgrade():
+    op.create_index(op.f("ix_users_birthdate"), "users", ["birthdate"], unique=False)
+    op.create_index(
+        "ix_language_abilities_language_code_user_id",
+        "language_abilities",
+        ["language_code", "user_id"],
+        unique=False,
+    )
+    for column in text_columns:
+        op.create_index(
+            f"ix_users_{column}_trgm",
+            "users",
+            [column],
+            unique=False,
+            postgresql_using="gin",
+            postgresql_ops={column: "gin_trgm_ops"},
+        )
+
+
+def downgrade():
+    for column in text_columns:
+        op.drop_index(f"ix_users_{column}_trgm", table_name="users")
+    op.drop_index("ix_language_abilities_language_code_user_id", table_name="language_abilities")
+    op.drop_index(op.f("ix_users_birthdate"), table_name="users")
@@ -0,0 +1,25 @@
+"""Add geography index for distance searches on users
+
+Revision ID: f3a0c6d28e54
+Revises: e52b9f0c7d13
+Create Date: 2021-10-24 11:47:09.120384
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f3a0c6d28e54"
+down_revision = "e52b9f0c7d13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_users_geom_geography", "users", [sa.text("geography(geom)")], postgresql_using="gist")
+    op.create_index(op.f("ix_users_geom_radius"), "users", ["geom_radius"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_users_geom_radius"), table_name="users")
+    op.drop_index("ix_users_geom_geography", table_name="users")
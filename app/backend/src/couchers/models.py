@@ -5,6 +5,7 @@ from datetime import date
 from geoalchemy2.types import Geometry
 from sqlalchemy import (
     ARRAY,
+    DDL,
     BigInteger,
     Boolean,
     CheckConstraint,
@@ -12,13 +13,14 @@ from sqlalchemy import (
     Date,
     DateTime,
     Enum,
+    FetchedValue,
     Float,
     ForeignKey,
     Index,
     Integer,
 )
 from sqlalchemy import LargeBinary as Binary
-from sqlalchemy import MetaData, Sequence, String, UniqueConstraint
+from sqlalchemy import MetaData, Sequence, String, UniqueConstraint, event
 from sqlalchemy.dialects.postgresql import TSTZRANGE, ExcludeConstraint
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -27,7 +29,7 @@ from sqlalchemy.sql import func, text
 
 from couchers.config import config
 from couchers.constants import EMAIL_REGEX, GUIDELINES_VERSION, PHONE_VERIFICATION_LIFETIME, TOS_VERSION
-from couchers.utils import date_in_timezone, get_coordinates, last_active_coarsen, now
+from couchers.utils import get_coordinates, last_active_coarsen, now
 
 meta = MetaData(
     naming_convention={
@@ -83,6 +85,20 @@ class TimezoneArea(Base):
     geom = Column(Geometry(geometry_type="MULTIPOLYGON", srid=4326), nullable=False)
 
 
+# free text columns matched by UserSearch, each has a trigram index
+USER_SEARCH_TEXT_COLUMNS = [
+    "name",
+    "username",
+    "city",
+    "hometown",
+    "about_me",
+    "my_travels",
+    "things_i_like",
+    "about_place",
+    "additional_information",
+]
+
+
 class User(Base):
     """
     Basic user and profile details
@@ -105,7 +121,7 @@ class User(Base):
     # by GPS, it has the WGS84 geoid with lat/lon
     geom = Column(Geometry(geometry_type="POINT", srid=4326), nullable=True)
     # their display location (displayed to other users), in meters
-    geom_radius = Column(Float, nullable=True)
+    geom_radius = Column(Float, nullable=True, index=True)
     # the display address (text) shown on their profile
     city = Column(String, nullable=False)
     hometown = Column(String, nullable=True)
@@ -132,7 +148,7 @@ class User(Base):
     name = Column(String, nullable=False)
     gender = Column(String, nullable=False)
     pronouns = Column(String, nullable=True)
-    birthdate = Column(Date, nullable=False)  # in the timezone of birthplace
+    birthdate = Column(Date, nullable=False, index=True)  # in the timezone of birthplace
 
     # name as on official docs for verification, etc. not needed until verification
     full_name = Column(String, nullable=True)
@@ -279,6 +295,13 @@ class User(Base):
             f"email ~ '{EMAIL_REGEX}'",
             name="valid_email",
         ),
+        # Spherical distance searches go through the geography of the location
+        Index("ix_users_geom_geography", func.geography(geom), postgresql_using="gist"),
+        # Trigram indexes for the substring (ILIKE '%...%') matching in user search
+        *(
+            Index(f"ix_users_{column}_trgm", column, postgresql_using="gin", postgresql_ops={column: "gin_trgm_ops"})
+            for column in USER_SEARCH_TEXT_COLUMNS
+        ),
     )
 
     @property
@@ -419,6 +442,8 @@ class LanguageAbility(Base):
     __table_args__ = (
         # Users can only have one language ability per language
         UniqueConstraint("user_id", "language_code"),
+        # For finding users who speak a given language
+        Index("ix_language_abilities_language_code_user_id", "language_code", "user_id"),
     )
 
     id = Column(BigInteger, primary_key=True)
@@ -486,6 +511,80 @@ class FriendRelationship(Base):
     to_user = relationship("User", backref="friends_to", foreign_keys="FriendRelationship.to_user_id")
 
 
+class Friendship(Base):
+    """
+    Symmetric table of accepted friendships, with one row in each direction per pair of friends, so that a user's
+    friends can be read straight off the primary key.
+
+    This is maintained by a trigger on friend_relationships, so don't write to it directly.
+    """
+
+    __tablename__ = "friendships"
+
+    user_id = Column(ForeignKey("users.id"), primary_key=True)
+    friend_id = Column(ForeignKey("users.id"), primary_key=True)
+
+
+event.listen(
+    FriendRelationship.__table__,
+    "after_create",
+    DDL(
+        """
+CREATE FUNCTION refresh_friendship(a BIGINT, b BIGINT) RETURNS VOID AS $$
+BEGIN
+    DELETE FROM friendships WHERE (user_id = a AND friend_id = b) OR (user_id = b AND friend_id = a);
+    IF EXISTS (
+        SELECT 1 FROM friend_relationships
+        WHERE status = 'accepted'
+        AND ((from_user_id = a AND to_user_id = b) OR (from_user_id = b AND to_user_id = a))
+    ) THEN
+        INSERT INTO friendships (user_id, friend_id) VALUES (a, b), (b, a) ON CONFLICT DO NOTHING;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION friend_relationships_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM refresh_friendship(OLD.from_user_id, OLD.to_user_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM refresh_friendship(NEW.from_user_id, NEW.to_user_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER friend_relationships_update_friendships
+AFTER INSERT OR UPDATE OR DELETE ON friend_relationships
+FOR EACH ROW EXECUTE PROCEDURE friend_relationships_changed();
+"""
+    ),
+)
+
+
+class UserRankingFeatures(Base):
+    """
+    Precomputed per-user inputs for ranking user search results, refreshed periodically by the
+    update_user_ranking_features background job
+    """
+
+    __tablename__ = "user_ranking_features"
+
+    user_id = Column(ForeignKey("users.id"), primary_key=True)
+
+    num_references = Column(Integer, nullable=False)
+    # the part of the relevance score that doesn't depend on the search, between 0 and 1
+    score = Column(Float, nullable=False)
+
+    updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        # for walking user search results in order of relevance, see Search.UserSearch
+        Index("ix_user_ranking_features_score_user_id", score.desc(), user_id.desc()),
+    )
+
+
 class ContributeOption(enum.Enum):
     yes = enum.auto()
     maybe = enum.auto()
@@ -928,19 +1027,13 @@ class HostRequest(Base):
     surfer_user_id = Column(ForeignKey("users.id"), nullable=False, index=True)
     host_user_id = Column(ForeignKey("users.id"), nullable=False, index=True)
 
-    # TODO: proper timezone handling
+    # TODO: proper timezone handling (this is also hardcoded in the host_requests_set_times trigger)
     timezone = "Etc/UTC"
 
     # dates in the timezone above
     from_date = Column(Date, nullable=False)
     to_date = Column(Date, nullable=False)
 
-    # timezone aware start and end times of the request, can be compared to now()
-    start_time = column_property(date_in_timezone(from_date, timezone))
-    end_time = column_property(date_in_timezone(to_date, timezone) + text("interval '1 days'"))
-    # notice 1 day for midnight at the *end of the day*, then 14 days to write a ref
-    end_time_to_write_reference = column_property(date_in_timezone(to_date, timezone) + text("interval '15 days'"))
-
     status = Column(Enum(HostRequestStatus), nullable=False)
 
     host_last_seen_message_id = Column(BigInteger, nullable=False, default=0)
@@ -950,6 +1043,31 @@ class HostRequest(Base):
     host_sent_reference_reminders = Column(BigInteger, nullable=False, server_default=text("0"))
     surfer_sent_reference_reminders = Column(BigInteger, nullable=False, server_default=text("0"))
 
+    # timezone aware start and end times of the request, can be compared to now(). these are computed from the dates by
+    # a trigger (see below) whenever they're set
+    start_time = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        index=True,
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+    )
+    end_time = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        index=True,
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+    )
+    # notice 1 day for midnight at the *end of the day*, then 14 days to write a ref
+    end_time_to_write_reference = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        index=True,
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+    )
+
     surfer = relationship("User", backref="host_requests_sent", foreign_keys="HostRequest.surfer_user_id")
     host = relationship("User", backref="host_requests_received", foreign_keys="HostRequest.host_user_id")
     conversation = relationship("Conversation")
@@ -976,6 +1094,28 @@ class HostRequest(Base):
         )
 
 
+event.listen(
+    HostRequest.__table__,
+    "after_create",
+    DDL(
+        """
+CREATE FUNCTION host_requests_set_times() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.start_time := timezone('Etc/UTC', NEW.from_date::timestamp);
+    NEW.end_time := timezone('Etc/UTC', NEW.to_date::timestamp) + interval '1 days';
+    NEW.end_time_to_write_reference := timezone('Etc/UTC', NEW.to_date::timestamp) + interval '15 days';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER host_requests_set_times
+BEFORE INSERT OR UPDATE ON host_requests
+FOR EACH ROW EXECUTE PROCEDURE host_requests_set_times();
+"""
+    ),
+)
+
+
 class ReferenceType(enum.Enum):
     friend = enum.auto()
     surfed = enum.auto()  # The "from" user surfed with the "to" user
@@ -1284,6 +1424,11 @@ class Page(Base):
 
     thread_id = Column(ForeignKey("threads.id"), nullable=False, unique=True)
 
+    # the latest version, maintained by a trigger on page_versions. only null between creating a page and its first
+    # version
+    current_version_id = Column(ForeignKey("page_versions.id", use_alter=True), nullable=True, unique=True)
+    created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
     parent_node = relationship("Node", backref="child_pages", remote_side="Node.id", foreign_keys="Page.parent_node_id")
 
     thread = relationship("Thread", backref="page", uselist=False)
@@ -1293,7 +1438,9 @@ class Page(Base):
         "Cluster", backref=backref("owned_pages", lazy="dynamic"), uselist=False, foreign_keys="Page.owner_cluster_id"
     )
 
-    editors = relationship("User", secondary="page_versions", viewonly=True)
+    current_version = relationship("PageVersion", foreign_keys="Page.current_version_id", viewonly=True)
+
+    editors = relationship("User", secondary="page_editors", order_by="PageEditor.first_version_id", viewonly=True)
 
     __table_args__ = (
         # Only one of owner_user and owner_cluster should be set
@@ -1341,7 +1488,7 @@ class PageVersion(Base):
 
     slug = column_property(func.slugify(title))
 
-    page = relationship("Page", backref="versions", order_by="PageVersion.id")
+    page = relationship("Page", backref="versions", order_by="PageVersion.id", foreign_keys="PageVersion.page_id")
     editor_user = relationship("User", backref="edited_pages")
     photo = relationship("Upload")
 
@@ -1365,6 +1512,44 @@ class PageVersion(Base):
         return f"PageVersion({self.id=}, {self.page_id=})"
 
 
+class PageEditor(Base):
+    """
+    Everyone who has edited a page, with the first version they made.
+
+    This is maintained by a trigger on page_versions, so don't write to it directly.
+    """
+
+    __tablename__ = "page_editors"
+
+    page_id = Column(ForeignKey("pages.id"), primary_key=True)
+    user_id = Column(ForeignKey("users.id"), primary_key=True)
+    first_version_id = Column(ForeignKey("page_versions.id"), nullable=False)
+
+
+event.listen(
+    PageVersion.__table__,
+    "after_create",
+    DDL(
+        """
+CREATE FUNCTION page_versions_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE pages SET current_version_id = NEW.id
+    WHERE id = NEW.page_id AND (current_version_id IS NULL OR current_version_id < NEW.id);
+    INSERT INTO page_editors (page_id, user_id, first_version_id)
+    VALUES (NEW.page_id, NEW.editor_user_id, NEW.id)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER page_versions_update_pages
+AFTER INSERT ON page_versions
+FOR EACH ROW EXECUTE PROCEDURE page_versions_inserted();
+"""
+    ),
+)
+
+
 class ClusterEventAssociation(Base):
     """
     events related to clusters
@@ -1653,6 +1838,9 @@ class Thread(Base):
     created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     deleted = Column(DateTime(timezone=True), nullable=True)
 
+    # total number of comments and replies, kept up to date by PostReply
+    num_responses = Column(Integer, nullable=False, server_default=text("0"))
+
 
 class Comment(Base):
     """
@@ -1669,6 +1857,9 @@ class Comment(Base):
     created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     deleted = Column(DateTime(timezone=True), nullable=True)
 
+    # kept up to date by PostReply
+    num_replies = Column(Integer, nullable=False, server_default=text("0"))
+
     thread = relationship("Thread", backref="comments")
 
 
@@ -1709,6 +1900,14 @@ class BackgroundJobType(enum.Enum):
     enforce_community_membership = enum.auto()
     # payload: google.protobuf.Empty
     send_reference_reminders = enum.auto()
+    # payload: google.protobuf.Empty
+    purge_background_jobs = enum.auto()
+    # payload: google.protobuf.Empty
+    maintain_api_call_logs = enum.auto()
+    # payload: google.protobuf.Empty
+    update_user_ranking_features = enum.auto()
+    # payload: google.protobuf.Empty
+    check_thread_counts = enum.auto()
 
 
 class BackgroundJobState(enum.Enum):
@@ -1752,6 +1951,16 @@ class BackgroundJob(Base):
     # if the job failed, we write that info here
     failure_info = Column(String, nullable=True)
 
+    __table_args__ = (
+        # used by the worker to find jobs to attempt; finished jobs are left out so that claiming a job stays cheap no
+        # matter how many completed jobs are sitting in the table
+        Index(
+            "ix_background_jobs_lookup",
+            next_attempt_after,
+            postgresql_where=((state == BackgroundJobState.pending) | (state == BackgroundJobState.error)),
+        ),
+    )
+
     @hybrid_property
     def ready_for_retry(self):
         return (
@@ -1814,12 +2023,17 @@ class UserBlock(Base):
 class APICall(Base):
     """
     API call logs
+
+    This table is partitioned by day on `time`. Partitions are created ahead of time and dropped after the retention
+    period by the maintain_api_call_logs background job, anything that doesn't fit in a daily partition ends up in the
+    default partition.
     """
 
     __tablename__ = "api_calls"
-    __table_args__ = {"schema": "logging"}
+    __table_args__ = {"schema": "logging", "postgresql_partition_by": "RANGE (time)"}
 
-    id = Column(BigInteger, primary_key=True)
+    # the partition key must be part of the primary key
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
 
     # whether the call was made using an api key or session cookies
     is_api_key = Column(Boolean, nullable=False, server_default=text("false"))
@@ -1829,7 +2043,7 @@ class APICall(Base):
     version = Column(String, nullable=False, default=config["VERSION"])
 
     # approximate time of the call
-    time = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    time = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
 
     # the method call name, e.g. "/org.couchers.api.core.API/ListFriends"
     method = Column(String, nullable=False)
@@ -1851,3 +2065,38 @@ class APICall(Base):
 
     # the exception traceback, if any
     traceback = Column(String, nullable=True)
+
+    # number of database queries, time spent on them in ms, and rows they returned
+    query_count = Column(Integer, nullable=True)
+    query_duration = Column(Float, nullable=True)
+    query_rows = Column(Integer, nullable=True)
+
+
+event.listen(
+    APICall.__table__,
+    "after_create",
+    DDL("CREATE TABLE logging.api_calls_default PARTITION OF logging.api_calls DEFAULT"),
+)
+
+
+class APICallRollup(Base):
+    """
+    Hourly aggregates of API call logs, computed before the raw logs are dropped so we can still look at long-term
+    performance trends
+    """
+
+    __tablename__ = "api_call_rollups"
+    __table_args__ = {"schema": "logging"}
+
+    # start of the hour
+    hour = Column(DateTime(timezone=True), primary_key=True)
+    method = Column(String, primary_key=True)
+
+    count = Column(BigInteger, nullable=False)
+    # number of calls that ended with a gRPC error
+    error_count = Column(BigInteger, nullable=False)
+
+    # handler duration percentiles, in ms
+    duration_p50 = Column(Float, nullable=False)
+    duration_p95 = Column(Float, nullable=False)
+    duration_p99 = Column(Float, nullable=False)
@@ -1,9 +1,25 @@
+import asyncio
+import logging
+import os
+import threading
 from concurrent import futures
+from multiprocessing import Process
+from multiprocessing.connection import wait
 
 import grpc
 
 from couchers import config
-from couchers.interceptors import AuthValidatorInterceptor, ErrorSanitizationInterceptor, TracingInterceptor
+from couchers.db import dispose_engines
+from couchers.interceptors import (
+    AioAuthValidatorInterceptor,
+    AioErrorSanitizationInterceptor,
+    AioReadOnlyInterceptor,
+    AioTracingInterceptor,
+    AuthValidatorInterceptor,
+    ErrorSanitizationInterceptor,
+    ReadOnlyInterceptor,
+    TracingInterceptor,
+)
 from couchers.servicers.account import Account
 from couchers.servicers.admin import Admin
 from couchers.servicers.api import API
@@ -15,7 +31,7 @@ from couchers.servicers.conversations import Conversations
 from couchers.servicers.discussions import Discussions
 from couchers.servicers.donations import Donations, Stripe
 from couchers.servicers.events import Events
-from couchers.servicers.gis import GIS
+from couchers.servicers.gis import GIS, AsyncGIS
 from couchers.servicers.groups import Groups
 from couchers.servicers.jail import Jail
 from couchers.servicers.media import Media, get_media_auth_interceptor
@@ -52,18 +68,10 @@ from proto import (
     threads_pb2_grpc,
 )
 
+logger = logging.getLogger(__name__)
 
-def create_main_server(port, threads=64):
-    server = grpc.server(
-        futures.ThreadPoolExecutor(threads),
-        interceptors=[
-            ErrorSanitizationInterceptor(),
-            TracingInterceptor(),
-            AuthValidatorInterceptor(),
-        ],
-    )
-    server.add_insecure_port(f"[::]:{port}")
 
+def _add_main_servicers(server, gis_servicer):
     account_pb2_grpc.add_AccountServicer_to_server(Account(), server)
     admin_pb2_grpc.add_AdminServicer_to_server(Admin(), server)
     api_pb2_grpc.add_APIServicer_to_server(API(), server)
@@ -75,7 +83,7 @@ def create_main_server(port, threads=64):
     discussions_pb2_grpc.add_DiscussionsServicer_to_server(Discussions(), server)
     donations_pb2_grpc.add_DonationsServicer_to_server(Donations(), server)
     events_pb2_grpc.add_EventsServicer_to_server(Events(), server)
-    gis_pb2_grpc.add_GISServicer_to_server(GIS(), server)
+    gis_pb2_grpc.add_GISServicer_to_server(gis_servicer, server)
     groups_pb2_grpc.add_GroupsServicer_to_server(Groups(), server)
     jail_pb2_grpc.add_JailServicer_to_server(Jail(), server)
     pages_pb2_grpc.add_PagesServicer_to_server(Pages(), server)
@@ -86,9 +94,110 @@ def create_main_server(port, threads=64):
     search_pb2_grpc.add_SearchServicer_to_server(Search(), server)
     stripe_pb2_grpc.add_StripeServicer_to_server(Stripe(), server)
     threads_pb2_grpc.add_ThreadsServicer_to_server(Threads(), server)
+
+
+def create_main_server(port, threads=64):
+    server = grpc.server(
+        futures.ThreadPoolExecutor(threads),
+        # lets several API processes listen on the same port, see start_main_server_processes
+        options=[("grpc.so_reuseport", 1)],
+        interceptors=[
+            ErrorSanitizationInterceptor(),
+            TracingInterceptor(),
+            AuthValidatorInterceptor(),
+            ReadOnlyInterceptor(),
+        ],
+    )
+    server.add_insecure_port(f"[::]:{port}")
+    _add_main_servicers(server, GIS())
     return server
 
 
+def create_main_aio_server(port, threads=64):
+    """
+    The main server on grpc.aio. Servicers with async methods run on the event loop, and the rest run on a pool of
+    `threads` threads like on the sync server.
+
+    Has to be called with the event loop running.
+    """
+    server = grpc.aio.server(
+        futures.ThreadPoolExecutor(threads),
+        options=[("grpc.so_reuseport", 1)],
+        interceptors=[
+            AioErrorSanitizationInterceptor(),
+            AioTracingInterceptor(),
+            AioAuthValidatorInterceptor(),
+            AioReadOnlyInterceptor(),
+        ],
+    )
+    server.add_insecure_port(f"[::]:{port}")
+    _add_main_servicers(server, AsyncGIS())
+    return server
+
+
+async def _serve_main_aio(port, started=None):
+    server = create_main_aio_server(port)
+    await server.start()
+    if started:
+        started.set()
+    await server.wait_for_termination()
+
+
+def start_main_aio_server(port):
+    """
+    Runs the grpc.aio main server on its own event loop in a background thread, returns once it's serving
+    """
+    started = threading.Event()
+    thread = threading.Thread(target=asyncio.run, args=(_serve_main_aio(port, started),), daemon=True)
+    thread.start()
+    started.wait()
+    return thread
+
+
+def _serve_main_in_process(port):
+    # the connection pools were copied from the parent by fork(), each process needs its own
+    dispose_engines()
+    logger.info(f"API process {os.getpid()} serving on {port}")
+    if config.config["GRPC_SERVER_MODE"] == "aio":
+        asyncio.run(_serve_main_aio(port))
+    else:
+        server = create_main_server(port)
+        server.start()
+        server.wait_for_termination()
+
+
+def start_main_server_processes(port, num_processes):
+    """
+    Forks `num_processes` processes that each run the main server on `port`, the kernel spreads incoming connections
+    between them with SO_REUSEPORT.
+
+    gRPC doesn't survive fork(), so this has to be called before any other gRPC server or channel is created.
+    """
+    processes = [
+        Process(target=_serve_main_in_process, args=(port,), name=f"api-{i}", daemon=True) for i in range(num_processes)
+    ]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def wait_for_main_server_processes(processes):
+    """
+    Blocks until any of the API processes exits, then stops the others.
+
+    Dead processes aren't restarted: by now the parent has gRPC servers and channels of its own, so it can't fork safely
+    any more. Instead the caller should exit, and whatever runs the app restarts the whole thing.
+    """
+    wait([process.sentinel for process in processes])
+    for process in processes:
+        if not process.is_alive():
+            logger.error(f"API process {process.pid} exited with code {process.exitcode}")
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
 def create_media_server(port, threads=8):
     media_server = grpc.server(
         futures.ThreadPoolExecutor(threads),
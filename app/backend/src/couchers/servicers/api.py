@@ -5,14 +5,15 @@ from urllib.parse import urlencode
 import grpc
 from google.protobuf import empty_pb2
 from sqlalchemy.orm import aliased
-from sqlalchemy.sql import and_, delete, func, intersect, or_, union
+from sqlalchemy.sql import and_, delete, func, or_
 
 from couchers import errors, urls
 from couchers.config import config
 from couchers.crypto import generate_hash_signature, random_hex
-from couchers.db import session_scope
+from couchers.db import get_friend_ids, invalidate_friend_ids, session_scope
 from couchers.models import (
     FriendRelationship,
+    Friendship,
     FriendStatus,
     GroupChatSubscription,
     HostingStatus,
@@ -468,25 +469,16 @@ class API(api_pb2_grpc.APIServicer):
 
     def ListFriends(self, request, context):
         with session_scope() as session:
-            rels = (
+            friend_ids = (
                 session.execute(
-                    select(FriendRelationship)
-                    .where_users_column_visible(context, FriendRelationship.from_user_id)
-                    .where_users_column_visible(context, FriendRelationship.to_user_id)
-                    .where(
-                        or_(
-                            FriendRelationship.from_user_id == context.user_id,
-                            FriendRelationship.to_user_id == context.user_id,
-                        )
-                    )
-                    .where(FriendRelationship.status == FriendStatus.accepted)
+                    select(Friendship.friend_id)
+                    .where_users_column_visible(context, Friendship.friend_id)
+                    .where(Friendship.user_id == context.user_id)
                 )
                 .scalars()
                 .all()
             )
-            return api_pb2.ListFriendsRes(
-                user_ids=[rel.from_user.id if rel.from_user.id != context.user_id else rel.to_user.id for rel in rels],
-            )
+            return api_pb2.ListFriendsRes(user_ids=friend_ids)
 
     def ListMutualFriends(self, request, context):
         if context.user_id == request.user_id:
@@ -500,38 +492,13 @@ class API(api_pb2_grpc.APIServicer):
             if not user:
                 context.abort(grpc.StatusCode.NOT_FOUND, errors.USER_NOT_FOUND)
 
-            q1 = (
-                select(FriendRelationship.from_user_id.label("user_id"))
-                .where(FriendRelationship.to_user_id == context.user_id)
-                .where(FriendRelationship.from_user_id != request.user_id)
-                .where(FriendRelationship.status == FriendStatus.accepted)
-            )
-
-            q2 = (
-                select(FriendRelationship.to_user_id.label("user_id"))
-                .where(FriendRelationship.from_user_id == context.user_id)
-                .where(FriendRelationship.to_user_id != request.user_id)
-                .where(FriendRelationship.status == FriendStatus.accepted)
-            )
-
-            q3 = (
-                select(FriendRelationship.from_user_id.label("user_id"))
-                .where(FriendRelationship.to_user_id == request.user_id)
-                .where(FriendRelationship.from_user_id != context.user_id)
-                .where(FriendRelationship.status == FriendStatus.accepted)
-            )
-
-            q4 = (
-                select(FriendRelationship.to_user_id.label("user_id"))
-                .where(FriendRelationship.from_user_id == request.user_id)
-                .where(FriendRelationship.to_user_id != context.user_id)
-                .where(FriendRelationship.status == FriendStatus.accepted)
-            )
-
-            mutual = select(intersect(union(q1, q2), union(q3, q4)).subquery())
+            mutual = set(get_friend_ids(session, context.user_id)).intersection(get_friend_ids(session, user.id))
+            mutual -= {context.user_id, user.id}
 
             mutual_friends = (
                 session.execute(select(User).where_users_visible(context).where(User.id.in_(mutual))).scalars().all()
+                if mutual
+                else []
             )
 
             return api_pb2.ListMutualFriendsRes(
@@ -659,6 +626,9 @@ class API(api_pb2_grpc.APIServicer):
 
             session.commit()
 
+            if friend_request.status == FriendStatus.accepted:
+                invalidate_friend_ids(friend_request.from_user_id, friend_request.to_user_id)
+
             return empty_pb2.Empty()
 
     def CancelFriendRequest(self, request, context):
@@ -729,6 +699,9 @@ def user_model_to_pb(db_user, session, context):
     pending_friend_request = None
     if db_user.id == context.user_id:
         friends_status = api_pb2.User.FriendshipStatus.NA
+    elif db_user.id in get_friend_ids(session, context.user_id):
+        # friendships are never removed, so this is always right, but the cache may not have new friends yet
+        friends_status = api_pb2.User.FriendshipStatus.FRIENDS
     else:
         friend_relationship = session.execute(
             select(FriendRelationship)
@@ -1,26 +1,30 @@
 import grpc
 from google.protobuf import empty_pb2
-from sqlalchemy.sql import union
+from sqlalchemy.sql import and_, or_
 
 from couchers import errors
 from couchers.db import session_scope
 from couchers.models import User, UserBlock
 from couchers.sql import couchers_select as select
+from couchers.sql import invalidate_hidden_user_ids
 from proto import blocking_pb2, blocking_pb2_grpc
 
 
-def are_blocked(session, user1_id, user2_id):
-    blocked_users = (
-        select(UserBlock.blocked_user_id)
-        .where(UserBlock.blocking_user_id == user1_id)
-        .where(UserBlock.blocked_user_id == user2_id)
-    )
-    blocking_users = (
-        select(UserBlock.blocking_user_id)
-        .where(UserBlock.blocking_user_id == user2_id)
-        .where(UserBlock.blocked_user_id == user1_id)
+def blocked_between(user1_id, user2_id):
+    """
+    SQL expression that is true if either user has blocked the other, the ids may be columns so this can be used as an
+    anti-join in a larger query
+    """
+    return (
+        select(UserBlock.id)
+        .where(
+            or_(
+                and_(UserBlock.blocking_user_id == user1_id, UserBlock.blocked_user_id == user2_id),
+                and_(UserBlock.blocking_user_id == user2_id, UserBlock.blocked_user_id == user1_id),
+            )
+        )
+        .exists()
     )
-    return session.execute(select(union(blocked_users, blocking_users).subquery())).first() is not None
 
 
 class Blocking(blocking_pb2_grpc.BlockingServicer):
@@ -49,6 +53,7 @@ class Blocking(blocking_pb2_grpc.BlockingServicer):
                 )
                 session.add(user_block)
                 session.commit()
+                invalidate_hidden_user_ids(context)
 
         return empty_pb2.Empty()
 
@@ -71,6 +76,7 @@ class Blocking(blocking_pb2_grpc.BlockingServicer):
 
             session.delete(user_block)
             session.commit()
+            invalidate_hidden_user_ids(context)
 
         return empty_pb2.Empty()
 
@@ -29,7 +29,7 @@ def discussion_to_pb(discussion: Discussion, context):
         owner_group_id=owner_group_id,
         title=discussion.title,
         content=discussion.content,
-        thread=thread_to_pb(discussion.thread_id),
+        thread=thread_to_pb(discussion.thread),
         can_moderate=can_moderate,
     )
 
@@ -156,7 +156,7 @@ def event_to_pb(session, occurrence: EventOccurrence, context):
         owner_user_id=event.owner_user_id,
         owner_community_id=owner_community_id,
         owner_group_id=owner_group_id,
-        thread=thread_to_pb(event.thread_id),
+        thread=thread_to_pb(event.thread),
         can_edit=_is_event_owner(event, context.user_id),
         can_moderate=can_moderate,
     )
@@ -4,7 +4,7 @@ import logging
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.sql import func
 
-from couchers.db import session_scope
+from couchers.db import async_session_scope, session_scope
 from couchers.models import Node, Page, PageType, PageVersion, User
 from couchers.sql import couchers_select as select
 from proto import gis_pb2_grpc
@@ -26,8 +26,7 @@ def _build_geojson_select(statement):
     )
 
 
-def _statement_to_geojson_response(session, statement):
-    json_dict = session.execute(select(_build_geojson_select(statement))).scalar_one_or_none()
+def _geojson_response(json_dict):
     return httpbody_pb2.HttpBody(
         content_type="application/json",
         # json.dumps escapes non-ascii characters
@@ -35,52 +34,66 @@ def _statement_to_geojson_response(session, statement):
     )
 
 
+def _statement_to_geojson_response(session, statement):
+    return _geojson_response(session.execute(select(_build_geojson_select(statement))).scalar_one_or_none())
+
+
+async def _statement_to_geojson_response_async(session, statement):
+    return _geojson_response((await session.execute(select(_build_geojson_select(statement)))).scalar_one_or_none())
+
+
+def _users_statement(context):
+    return select(User.username, User.id, User.geom).where_users_visible(context).where(User.geom != None)
+
+
+def _communities_statement():
+    return select(Node).where(Node.geom != None)
+
+
+def _pages_statement(page_type):
+    return (
+        select(Page.id, PageVersion.slug.label("slug"), PageVersion.geom)
+        .join(PageVersion, PageVersion.id == Page.current_version_id)
+        .where(Page.type == page_type)
+        .where(PageVersion.geom != None)
+    )
+
+
 class GIS(gis_pb2_grpc.GISServicer):
     def GetUsers(self, request, context):
         with session_scope() as session:
-            statement = select(User.username, User.id, User.geom).where_users_visible(context).where(User.geom != None)
-
-            return _statement_to_geojson_response(session, statement)
+            return _statement_to_geojson_response(session, _users_statement(context))
 
     def GetCommunities(self, request, context):
         with session_scope() as session:
-            statement = select(Node).where(Node.geom != None)
-
-            return _statement_to_geojson_response(session, statement)
+            return _statement_to_geojson_response(session, _communities_statement())
 
     def GetPlaces(self, request, context):
         with session_scope() as session:
-            # need to do a subquery here so we get pages without a geom, not just versions without geom
-            latest_pages = (
-                select(func.max(PageVersion.id).label("id"))
-                .join(Page, Page.id == PageVersion.page_id)
-                .where(Page.type == PageType.place)
-                .group_by(PageVersion.page_id)
-                .subquery()
-            )
-
-            statement = (
-                select(PageVersion.page_id.label("id"), PageVersion.slug.label("slug"), PageVersion.geom)
-                .join(latest_pages, latest_pages.c.id == PageVersion.id)
-                .where(PageVersion.geom != None)
-            )
-
-            return _statement_to_geojson_response(session, statement)
+            return _statement_to_geojson_response(session, _pages_statement(PageType.place))
 
     def GetGuides(self, request, context):
         with session_scope() as session:
-            latest_pages = (
-                select(func.max(PageVersion.id).label("id"))
-                .join(Page, Page.id == PageVersion.page_id)
-                .where(Page.type == PageType.guide)
-                .group_by(PageVersion.page_id)
-                .subquery()
-            )
-
-            statement = (
-                select(PageVersion.page_id.label("id"), PageVersion.slug.label("slug"), PageVersion.geom)
-                .join(latest_pages, latest_pages.c.id == PageVersion.id)
-                .where(PageVersion.geom != None)
-            )
-
-            return _statement_to_geojson_response(session, statement)
+            return _statement_to_geojson_response(session, _pages_statement(PageType.guide))
+
+
+class AsyncGIS(gis_pb2_grpc.GISServicer):
+    """
+    GIS on asyncio database sessions, served by the grpc.aio server so these big queries don't each hold a thread
+    """
+
+    async def GetUsers(self, request, context):
+        async with async_session_scope() as session:
+            return await _statement_to_geojson_response_async(session, _users_statement(context))
+
+    async def GetCommunities(self, request, context):
+        async with async_session_scope() as session:
+            return await _statement_to_geojson_response_async(session, _communities_statement())
+
+    async def GetPlaces(self, request, context):
+        async with async_session_scope() as session:
+            return await _statement_to_geojson_response_async(session, _pages_statement(PageType.place))
+
+    async def GetGuides(self, request, context):
+        async with async_session_scope() as session:
+            return await _statement_to_geojson_response_async(session, _pages_statement(PageType.guide))
@@ -1,11 +1,12 @@
 import grpc
+from sqlalchemy.orm import object_session
 
 from couchers import errors
 from couchers.db import can_moderate_at, can_moderate_node, get_parent_node_at_location, session_scope
-from couchers.models import Cluster, Node, Page, PageType, PageVersion, Thread, Upload, User
+from couchers.models import Cluster, Node, Page, PageEditor, PageType, PageVersion, Thread, Upload, User
 from couchers.servicers.threads import thread_to_pb
 from couchers.sql import couchers_select as select
-from couchers.utils import Timestamp_from_datetime, create_coordinate, remove_duplicates_retain_order
+from couchers.utils import Timestamp_from_datetime, create_coordinate
 from proto import pages_pb2, pages_pb2_grpc
 
 MAX_PAGINATION_LENGTH = 25
@@ -39,7 +40,7 @@ def _can_moderate_page(page: Page, user_id):
     """
     # checks if either the page is in the exclusive moderation area of a node
     with session_scope() as session:
-        latest_version = page.versions[-1]
+        latest_version = page.current_version
 
         # if the page has a location, we firstly check if we are the moderator of any node that contains this page
         if latest_version.geom is not None and can_moderate_at(session, user_id, latest_version.geom):
@@ -54,8 +55,14 @@ def _can_moderate_page(page: Page, user_id):
 
 
 def page_to_pb(page: Page, context):
-    first_version = page.versions[0]
-    current_version = page.versions[-1]
+    current_version = page.current_version
+
+    editor_user_ids = (
+        object_session(page)
+        .execute(select(PageEditor.user_id).where(PageEditor.page_id == page.id).order_by(PageEditor.first_version_id))
+        .scalars()
+        .all()
+    )
 
     owner_community_id = None
     owner_group_id = None
@@ -69,14 +76,14 @@ def page_to_pb(page: Page, context):
         page_id=page.id,
         type=pagetype2api[page.type],
         slug=current_version.slug,
-        created=Timestamp_from_datetime(first_version.created),
+        created=Timestamp_from_datetime(page.created),
         last_edited=Timestamp_from_datetime(current_version.created),
         last_editor_user_id=current_version.editor_user_id,
         creator_user_id=page.creator_user_id,
         owner_user_id=page.owner_user_id,
         owner_community_id=owner_community_id,
         owner_group_id=owner_group_id,
-        thread=thread_to_pb(page.thread_id),
+        thread=thread_to_pb(page.thread),
         title=current_version.title,
         content=current_version.content,
         photo_url=current_version.photo.full_url if current_version.photo_key else None,
@@ -87,7 +94,7 @@ def page_to_pb(page: Page, context):
         )
         if current_version.coordinates
         else None,
-        editor_user_ids=remove_duplicates_retain_order([version.editor_user_id for version in page.versions]),
+        editor_user_ids=editor_user_ids,
         can_edit=_is_page_owner(page, context.user_id),
         can_moderate=_can_moderate_page(page, context.user_id),
     )
@@ -210,7 +217,7 @@ class Pages(pages_pb2_grpc.PagesServicer):
             if not _is_page_owner(page, context.user_id) and not _can_moderate_page(page, context.user_id):
                 context.abort(grpc.StatusCode.PERMISSION_DENIED, errors.PAGE_UPDATE_PERMISSION_DENIED)
 
-            current_version = page.versions[-1]
+            current_version = page.current_version
 
             page_version = PageVersion(
                 page=page,
@@ -2,11 +2,28 @@
 See //docs/search.md for overview.
 """
 import grpc
-from sqlalchemy.sql import func, or_
+from dateutil.relativedelta import relativedelta
+from sqlalchemy.sql import func, literal, or_, tuple_
 
 from couchers import errors
+from couchers.constants import USER_RANKING_DISTANCE_SCALE, USER_RANKING_DISTANCE_WEIGHT
 from couchers.db import session_scope
-from couchers.models import Cluster, Event, EventOccurrence, Node, Page, PageType, PageVersion, Reference, User
+from couchers.models import (
+    USER_SEARCH_TEXT_COLUMNS,
+    Cluster,
+    Event,
+    EventOccurrence,
+    Friendship,
+    HostingStatus,
+    LanguageAbility,
+    Node,
+    Page,
+    PageType,
+    PageVersion,
+    Reference,
+    User,
+    UserRankingFeatures,
+)
 from couchers.servicers.api import (
     hostingstatus2sql,
     parkingdetails2sql,
@@ -19,7 +36,7 @@ from couchers.servicers.events import event_to_pb
 from couchers.servicers.groups import group_to_pb
 from couchers.servicers.pages import page_to_pb
 from couchers.sql import couchers_select as select
-from couchers.utils import create_coordinate, last_active_coarsen, to_aware_datetime
+from couchers.utils import create_coordinate, last_active_coarsen, to_aware_datetime, today
 from proto import search_pb2, search_pb2_grpc
 
 # searches are a bit expensive, we'd rather send back a bunch of results at once than lots of small pages
@@ -194,24 +211,16 @@ def _search_pages(session, search_statement, title_only, next_rank, page_size, c
     if not include_places and not include_guides:
         return []
 
-    latest_pages = (
-        select(func.max(PageVersion.id).label("id"))
-        .join(Page, Page.id == PageVersion.page_id)
+    pages = execute_search_statement(
+        session,
+        select(Page, rank, snippet)
+        .join(PageVersion, PageVersion.id == Page.current_version_id)
         .where(
             or_(
                 (Page.type == PageType.place) if include_places else False,
                 (Page.type == PageType.guide) if include_guides else False,
             )
-        )
-        .group_by(PageVersion.page_id)
-        .subquery()
-    )
-
-    pages = execute_search_statement(
-        session,
-        select(Page, rank, snippet)
-        .join(PageVersion, PageVersion.page_id == Page.id)
-        .join(latest_pages, latest_pages.c.id == PageVersion.id),
+        ),
     )
 
     return [
@@ -271,20 +280,12 @@ def _search_clusters(
         [PageVersion.content],
     )
 
-    latest_pages = (
-        select(func.max(PageVersion.id).label("id"))
-        .join(Page, Page.id == PageVersion.page_id)
-        .where(Page.type == PageType.main_page)
-        .group_by(PageVersion.page_id)
-        .subquery()
-    )
-
     clusters = execute_search_statement(
         session,
         select(Cluster, rank, snippet)
         .join(Page, Page.owner_cluster_id == Cluster.id)
-        .join(PageVersion, PageVersion.page_id == Page.id)
-        .join(latest_pages, latest_pages.c.id == PageVersion.id)
+        .join(PageVersion, PageVersion.id == Page.current_version_id)
+        .where(Page.type == PageType.main_page)
         .where(Cluster.is_official_cluster if include_communities and not include_groups else True)
         .where(~Cluster.is_official_cluster if not include_communities and include_groups else True),
     )
@@ -364,17 +365,13 @@ class Search(search_pb2_grpc.SearchServicer):
                         )
                     )
                 else:
+                    # these are all backed by trigram indexes
                     statement = statement.where(
                         or_(
-                            User.name.ilike(f"%{request.query.value}%"),
-                            User.username.ilike(f"%{request.query.value}%"),
-                            User.city.ilike(f"%{request.query.value}%"),
-                            User.hometown.ilike(f"%{request.query.value}%"),
-                            User.about_me.ilike(f"%{request.query.value}%"),
-                            User.my_travels.ilike(f"%{request.query.value}%"),
-                            User.things_i_like.ilike(f"%{request.query.value}%"),
-                            User.about_place.ilike(f"%{request.query.value}%"),
-                            User.additional_information.ilike(f"%{request.query.value}%"),
+                            *(
+                                getattr(User, column).ilike(f"%{request.query.value}%")
+                                for column in USER_SEARCH_TEXT_COLUMNS
+                            )
                         )
                     )
 
@@ -431,14 +428,20 @@ class Search(search_pb2_grpc.SearchServicer):
             if request.HasField("camping_ok"):
                 statement = statement.where(User.camping_ok == request.camping_ok.value)
 
+            search_point = None
             if request.HasField("search_in_area"):
-                # EPSG4326 measures distance in decimal degress
                 # we want to check whether two circles overlap, so check if the distance between their centers is less
-                # than the sum of their radii, divided by 111111 m ~= 1 degree (at the equator)
-                search_point = create_coordinate(request.search_in_area.lat, request.search_in_area.lng)
+                # than the sum of their radii. that distance depends on each user's radius, which the index can't use,
+                # so first narrow it down with a constant bound, the largest radius anyone has
+                search_point = func.geography(create_coordinate(request.search_in_area.lat, request.search_in_area.lng))
+                max_geom_radius = session.execute(select(func.max(User.geom_radius))).scalar_one() or 0
                 statement = statement.where(
                     func.ST_DWithin(
-                        User.geom, search_point, (User.geom_radius + request.search_in_area.radius) / 111111
+                        func.geography(User.geom), search_point, request.search_in_area.radius + max_geom_radius
+                    )
+                ).where(
+                    func.ST_DWithin(
+                        func.geography(User.geom), search_point, User.geom_radius + request.search_in_area.radius
                     )
                 )
             if request.HasField("search_in_community_id"):
@@ -453,13 +456,107 @@ class Search(search_pb2_grpc.SearchServicer):
             if request.only_with_references:
                 statement = statement.join(Reference, Reference.to_user_id == User.id)
 
-            # TODO:
-            # google.protobuf.StringValue language = 11;
-            # bool friends_only = 13;
-            # google.protobuf.UInt32Value age_min = 14;
-            # google.protobuf.UInt32Value age_max = 15;
+            if request.HasField("language"):
+                statement = statement.where(
+                    User.id.in_(
+                        select(LanguageAbility.user_id).where(LanguageAbility.language_code == request.language.value)
+                    )
+                )
+
+            if request.friends_only:
+                statement = statement.where(
+                    User.id.in_(select(Friendship.friend_id).where(Friendship.user_id == context.user_id))
+                )
+
+            # ages are turned into a range on birthdate so they can use its index
+            if request.HasField("age_min"):
+                statement = statement.where(User.birthdate <= today() - relativedelta(years=request.age_min.value))
+            if request.HasField("age_max"):
+                statement = statement.where(User.birthdate > today() - relativedelta(years=request.age_max.value + 1))
 
             page_size = min(MAX_PAGINATION_LENGTH, request.page_size or MAX_PAGINATION_LENGTH)
+
+            if request.order_by_relevance and search_point is None:
+                # the score is just the precomputed one, so walk the (score, user_id) index instead of sorting all
+                # matching users. Users that haven't had their features computed yet come after everyone else, by id,
+                # and their page tokens have no score
+                results = []
+                last_score, last_user_id = request.page_token.split(",") if request.page_token else ("", "")
+                if not request.page_token or last_score:
+                    ranked_statement = statement.join(
+                        UserRankingFeatures, UserRankingFeatures.user_id == User.id
+                    ).add_columns(UserRankingFeatures.score)
+                    if request.page_token:
+                        ranked_statement = ranked_statement.where(
+                            tuple_(UserRankingFeatures.score, UserRankingFeatures.user_id)
+                            < tuple_(literal(float(last_score)), literal(int(last_user_id)))
+                        )
+                    ranked_statement = ranked_statement.order_by(
+                        UserRankingFeatures.score.desc(), UserRankingFeatures.user_id.desc()
+                    ).limit(page_size + 1)
+                    results += session.execute(ranked_statement).all()
+
+                if len(results) <= page_size:
+                    unranked_statement = (
+                        statement.outerjoin(UserRankingFeatures, UserRankingFeatures.user_id == User.id)
+                        .where(UserRankingFeatures.user_id == None)
+                        .add_columns(UserRankingFeatures.score)
+                    )
+                    if request.page_token and not last_score:
+                        unranked_statement = unranked_statement.where(User.id < int(last_user_id))
+                    unranked_statement = unranked_statement.order_by(User.id.desc()).limit(page_size + 1 - len(results))
+                    results += session.execute(unranked_statement).all()
+
+                next_page_token = None
+                if len(results) > page_size:
+                    last = results[page_size - 1]
+                    next_page_token = f"{'' if last.score is None else repr(last.score)},{last.User.id}"
+
+                return search_pb2.UserSearchRes(
+                    results=[
+                        search_pb2.Result(
+                            rank=user_score or 0,
+                            user=user_model_to_pb(user, session, context),
+                        )
+                        for user, user_score in results[:page_size]
+                    ],
+                    next_page_token=next_page_token,
+                )
+
+            if request.order_by_relevance:
+                # the distance term depends on the search, so this sorts all matching users. Users that haven't had
+                # their features computed yet just get a score of zero
+                score = func.coalesce(UserRankingFeatures.score, 0)
+                distance = func.ST_Distance(func.geography(User.geom), search_point)
+                score = score + USER_RANKING_DISTANCE_WEIGHT / (1 + distance / USER_RANKING_DISTANCE_SCALE)
+                statement = statement.outerjoin(UserRankingFeatures, UserRankingFeatures.user_id == User.id)
+                statement = statement.add_columns(score.label("score"))
+
+                if request.page_token:
+                    # keyset pagination on (score, id), so deep pages don't need to skip over earlier ones
+                    last_score, last_user_id = request.page_token.split(",")
+                    statement = statement.where(
+                        tuple_(score, User.id) < tuple_(literal(float(last_score)), literal(int(last_user_id)))
+                    )
+
+                statement = statement.order_by(score.desc(), User.id.desc()).limit(page_size + 1)
+                results = session.execute(statement).all()
+
+                return search_pb2.UserSearchRes(
+                    results=[
+                        search_pb2.Result(
+                            rank=user_score,
+                            user=user_model_to_pb(user, session, context),
+                        )
+                        for user, user_score in results[:page_size]
+                    ],
+                    next_page_token=(
+                        f"{results[page_size - 1].score!r},{results[page_size - 1].User.id}"
+                        if len(results) > page_size
+                        else None
+                    ),
+                )
+
             next_user_id = int(request.page_token) if request.page_token else 0
 
             statement = statement.where(User.id >= next_user_id).order_by(User.id).limit(page_size + 1)
@@ -475,3 +572,42 @@ class Search(search_pb2_grpc.SearchServicer):
                 ],
                 next_page_token=str(users[-1].id) if len(users) > page_size else None,
             )
+
+    def NearestHosts(self, request, context):
+        with session_scope() as session:
+            point = func.geography(create_coordinate(request.lat, request.lng))
+            # spherical distance in m, ordering by this does a nearest neighbour search on the geography index
+            distance = func.geography(User.geom).op("<->")(point)
+
+            statement = (
+                select(User, distance.label("distance"))
+                .where_users_visible(context)
+                .where(User.hosting_status == HostingStatus.can_host)
+                .where(User.geom != None)
+            )
+
+            if request.page_token:
+                # keyset pagination on (distance, id), so pages stay consistent and don't need an offset
+                last_distance, last_user_id = request.page_token.split(",")
+                statement = statement.where(
+                    tuple_(distance, User.id) > tuple_(literal(float(last_distance)), literal(int(last_user_id)))
+                )
+
+            page_size = min(MAX_PAGINATION_LENGTH, request.page_size or MAX_PAGINATION_LENGTH)
+            statement = statement.order_by(distance, User.id).limit(page_size + 1)
+            results = session.execute(statement).all()
+
+            return search_pb2.NearestHostsRes(
+                hosts=[
+                    search_pb2.NearestHost(
+                        user=user_model_to_pb(user, session, context),
+                        distance=user_distance,
+                    )
+                    for user, user_distance in results[:page_size]
+                ],
+                next_page_token=(
+                    f"{results[page_size - 1].distance!r},{results[page_size - 1].User.id}"
+                    if len(results) > page_size
+                    else None
+                ),
+            )
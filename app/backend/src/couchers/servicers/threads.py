@@ -2,7 +2,7 @@ import logging
 
 import grpc
 import sqlalchemy.exc
-from sqlalchemy.sql import func
+from sqlalchemy.sql import update
 
 from couchers import errors
 from couchers.db import session_scope
@@ -27,28 +27,10 @@ def unpack_thread_id(thread_id: int) -> (int, int):
     return divmod(thread_id, 10)
 
 
-def total_num_responses(database_id):
-    """Return the total number of comments and replies to the thread with
-    database id database_id.
-    """
-    with session_scope() as session:
-        return (
-            session.execute(
-                select(func.count()).select_from(Comment).where(Comment.thread_id == database_id)
-            ).scalar_one()
-            + session.execute(
-                select(func.count())
-                .select_from(Reply)
-                .join(Comment, Comment.id == Reply.comment_id)
-                .where(Comment.thread_id == database_id)
-            ).scalar_one()
-        )
-
-
-def thread_to_pb(database_id):
+def thread_to_pb(thread: Thread):
     return threads_pb2.Thread(
-        thread_id=pack_thread_id(database_id, 0),
-        num_responses=total_num_responses(database_id),
+        thread_id=pack_thread_id(thread.id, 0),
+        num_responses=thread.num_responses,
     )
 
 
@@ -63,24 +45,26 @@ class Threads(threads_pb2_grpc.ThreadsServicer):
                 if not session.execute(select(Thread).where(Thread.id == database_id)).scalar_one_or_none():
                     context.abort(grpc.StatusCode.NOT_FOUND, errors.THREAD_NOT_FOUND)
 
-                res = session.execute(
-                    select(Comment, func.count(Reply.id))
-                    .outerjoin(Reply, Reply.comment_id == Comment.id)
-                    .where(Comment.thread_id == database_id)
-                    .where(Comment.id < page_start)
-                    .group_by(Comment.id)
-                    .order_by(Comment.created.desc())
-                    .limit(page_size + 1)
-                ).all()
+                res = (
+                    session.execute(
+                        select(Comment)
+                        .where(Comment.thread_id == database_id)
+                        .where(Comment.id < page_start)
+                        .order_by(Comment.created.desc())
+                        .limit(page_size + 1)
+                    )
+                    .scalars()
+                    .all()
+                )
                 replies = [
                     threads_pb2.Reply(
                         thread_id=pack_thread_id(r.id, 1),
                         content=r.content,
                         author_user_id=r.author_user_id,
                         created_time=Timestamp_from_datetime(r.created),
-                        num_replies=n,
+                        num_replies=r.num_replies,
                     )
-                    for r, n in res[:page_size]
+                    for r in res[:page_size]
                 ]
 
             elif depth == 1:
@@ -135,4 +119,22 @@ class Threads(threads_pb2_grpc.ThreadsServicer):
             except sqlalchemy.exc.IntegrityError:
                 context.abort(grpc.StatusCode.NOT_FOUND, errors.THREAD_NOT_FOUND)
 
+            # bump the counters in the same transaction, as single UPDATEs so concurrent replies don't race
+            if depth == 0:
+                thread_id = database_id
+            else:
+                session.execute(
+                    update(Comment)
+                    .where(Comment.id == database_id)
+                    .values(num_replies=Comment.num_replies + 1)
+                    .execution_options(synchronize_session=False)
+                )
+                thread_id = select(Comment.thread_id).where(Comment.id == database_id).scalar_subquery()
+            session.execute(
+                update(Thread)
+                .where(Thread.id == thread_id)
+                .values(num_responses=Thread.num_responses + 1)
+                .execution_options(synchronize_session=False)
+            )
+
             return threads_pb2.PostReplyRes(thread_id=pack_thread_id(object_to_add.id, depth + 1))
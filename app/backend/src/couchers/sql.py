@@ -1,4 +1,6 @@
-from sqlalchemy.orm import aliased
+from sqlalchemy import BigInteger, all_, event, literal
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.sql import Select, union
 
 from couchers.models import User, UserBlock
@@ -16,6 +18,27 @@ def _relevant_user_blocks(user_id):
     return couchers_select(union(blocked_users, blocking_users).subquery())
 
 
+def _cache_hidden_user_ids_on_first_use(orm_execute_state):
+    """
+    The first time a query filtered with where_users_visible runs in a request, looks up the users hidden from the
+    calling user in that query's session and caches them on the context, so the following queries can use the set
+    """
+    context = orm_execute_state.execution_options.get("hidden_users_context")
+    if context is not None and getattr(context, "_hidden_user_ids", None) is None:
+        res = orm_execute_state.session.execute(_relevant_user_blocks(context.user_id))
+        context._hidden_user_ids = frozenset(res.scalars().all())
+
+
+event.listen(Session, "do_orm_execute", _cache_hidden_user_ids_on_first_use)
+
+
+def invalidate_hidden_user_ids(context):
+    """
+    Drops the cached set of hidden users for this request, needs to be called when blocks change
+    """
+    context._hidden_user_ids = None
+
+
 """
 This method construct provided directly by the developers
 They intend to implement a better option in the near future
@@ -61,17 +84,33 @@ class CouchersSelect(Select):
 
         Filters the given table, assuming it's already joined/selected from
         """
-        hidden_users = _relevant_user_blocks(context.user_id)
-        return self.where(table.is_visible).where(~table.id.in_(hidden_users))
+        return self.where(table.is_visible)._where_not_hidden(context, table.id)
 
     def where_users_column_visible(self, context, column):
         """
         Filters the given column, not yet joined/selected from
         """
-        hidden_users = _relevant_user_blocks(context.user_id)
         aliased_user = aliased(User)
         return (
             self.join(aliased_user, aliased_user.id == column)
             .where(aliased_user.is_visible)
-            .where(~aliased_user.id.in_(hidden_users))
+            ._where_not_hidden(context, column)
         )
+
+    def _where_not_hidden(self, context, column):
+        """
+        Filters out the users hidden from the calling user due to blocking.
+
+        Until the hidden users have been looked up for this request, the block list is checked within the query itself,
+        which also sees blocks written earlier in the same transaction. Running such a query then looks them up and
+        caches them on the context, see _cache_hidden_user_ids_on_first_use.
+        """
+        hidden_user_ids = getattr(context, "_hidden_user_ids", None)
+        if hidden_user_ids is None:
+            return self.where(~column.in_(_relevant_user_blocks(context.user_id))).execution_options(
+                hidden_users_context=context
+            )
+        if not hidden_user_ids:
+            return self
+        # bound as a single array parameter, so the query text is the same whatever the number of blocks
+        return self.where(column != all_(literal(sorted(hidden_user_ids), ARRAY(BigInteger))))
@@ -229,10 +229,13 @@ def send_friend_reference_email(reference):
     )
 
 
-def send_reference_reminder_email(user, other_user, host_request, surfed, time_left_text):
+def reference_reminder_email_job(user, other_user, host_request, surfed, time_left_text):
+    """
+    Renders a reminder to write a reference into an email job, to be queued in bulk with queue_jobs_in_session
+    """
     logger.info(f"Sending host reference email to {user=}, they have {time_left_text} left to write a ref")
 
-    email.enqueue_email_from_template(
+    return email.email_job_from_template(
         user.email,
         "reference_reminder",
         template_args={
@@ -298,16 +301,31 @@ def send_email_changed_confirmation_to_new_email(user):
     )
 
 
+def _onboarding_email_template_args(user):
+    return {
+        "user": user,
+        "app_link": urls.app_link(),
+        "profile_link": urls.profile_link(),
+        "edit_profile_link": urls.edit_profile_link(),
+    }
+
+
 def send_onboarding_email(user, email_number):
     email.enqueue_email_from_template(
         user.email,
         f"onboarding{email_number}",
-        template_args={
-            "user": user,
-            "app_link": urls.app_link(),
-            "profile_link": urls.profile_link(),
-            "edit_profile_link": urls.edit_profile_link(),
-        },
+        template_args=_onboarding_email_template_args(user),
+    )
+
+
+def onboarding_email_job(user, email_number):
+    """
+    Renders an onboarding email into an email job, to be queued in bulk with queue_jobs_in_session
+    """
+    return email.email_job_from_template(
+        user.email,
+        f"onboarding{email_number}",
+        template_args=_onboarding_email_template_args(user),
     )
 
 
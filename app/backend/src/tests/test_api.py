@@ -6,7 +6,7 @@ from google.protobuf import empty_pb2, wrappers_pb2
 
 from couchers import errors
 from couchers.db import session_scope
-from couchers.models import FriendRelationship, FriendStatus
+from couchers.models import FriendRelationship, Friendship, FriendStatus
 from couchers.sql import couchers_select as select
 from couchers.utils import create_coordinate, to_aware_datetime
 from proto import api_pb2, jail_pb2
@@ -688,6 +688,38 @@ def test_mutual_friends_self(db):
         assert len(res.mutual_friends) == 0
 
 
+def test_friendships_table(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+
+    def friendships():
+        with session_scope() as session:
+            return set(session.execute(select(Friendship.user_id, Friendship.friend_id)).all())
+
+    with api_session(token1) as api:
+        api.SendFriendRequest(api_pb2.SendFriendRequestReq(user_id=user2.id))
+        api.SendFriendRequest(api_pb2.SendFriendRequestReq(user_id=user3.id))
+
+    # pending requests aren't friendships
+    assert friendships() == set()
+
+    with api_session(token2) as api:
+        fr_id = api.ListFriendRequests(empty_pb2.Empty()).received[0].friend_request_id
+        api.RespondFriendRequest(api_pb2.RespondFriendRequestReq(friend_request_id=fr_id, accept=True))
+
+    with api_session(token3) as api:
+        fr_id = api.ListFriendRequests(empty_pb2.Empty()).received[0].friend_request_id
+        api.RespondFriendRequest(api_pb2.RespondFriendRequestReq(friend_request_id=fr_id, accept=False))
+
+    # one row in each direction
+    assert friendships() == {(user1.id, user2.id), (user2.id, user1.id)}
+
+    with api_session(token1) as api:
+        assert api.GetUser(api_pb2.GetUserReq(user=user2.username)).friends == api_pb2.User.FriendshipStatus.FRIENDS
+        assert api.GetUser(api_pb2.GetUserReq(user=user3.username)).friends == api_pb2.User.FriendshipStatus.NOT_FRIENDS
+
+
 def test_CancelFriendRequest(db):
     user1, token1 = generate_user()
     user2, token2 = generate_user()
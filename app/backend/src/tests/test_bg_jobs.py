@@ -1,4 +1,8 @@
+import json
+import threading
+from base64 import b64encode
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
 
 import pytest
@@ -12,9 +16,12 @@ from couchers.crypto import urlsafe_secure_token
 from couchers.db import session_scope
 from couchers.email import queue_email
 from couchers.email.dev import print_dev_email
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import queue_job, queue_jobs, queue_jobs_in_session
 from couchers.jobs.handlers import (
+    _api_calls_partition_days,
     process_add_users_to_email_list,
+    process_maintain_api_call_logs,
+    process_purge_background_jobs,
     process_send_message_notifications,
     process_send_onboarding_emails,
     process_send_reference_reminders,
@@ -22,7 +29,17 @@ from couchers.jobs.handlers import (
 )
 from couchers.jobs.worker import _run_job_and_schedule, process_job, run_scheduler, service_jobs
 from couchers.metrics import create_prometheus_server, job_process_registry
-from couchers.models import BackgroundJob, BackgroundJobState, BackgroundJobType, Email, LoginToken
+from couchers.models import (
+    APICall,
+    APICallRollup,
+    BackgroundJob,
+    BackgroundJobState,
+    BackgroundJobType,
+    Email,
+    HostRequest,
+    LoginToken,
+    User,
+)
 from couchers.sql import couchers_select as select
 from couchers.tasks import send_login_email
 from couchers.utils import now, today
@@ -158,6 +175,86 @@ def test_purge_login_tokens(db):
         )
 
 
+def test_purge_background_jobs(db):
+    with session_scope() as session:
+        for state, age in [
+            (BackgroundJobState.completed, timedelta(days=1)),
+            (BackgroundJobState.completed, timedelta(days=8)),
+            (BackgroundJobState.failed, timedelta(days=8)),
+            (BackgroundJobState.failed, timedelta(days=91)),
+            (BackgroundJobState.error, timedelta(days=91)),
+            (BackgroundJobState.pending, timedelta(days=91)),
+        ]:
+            session.add(
+                BackgroundJob(
+                    job_type=BackgroundJobType.send_email,
+                    state=state,
+                    queued=now() - age,
+                    payload=b"",
+                )
+            )
+
+    process_purge_background_jobs(empty_pb2.Empty())
+
+    with session_scope() as session:
+        remaining = session.execute(select(BackgroundJob.state).order_by(BackgroundJob.id)).scalars().all()
+        assert remaining == [
+            BackgroundJobState.completed,
+            BackgroundJobState.failed,
+            BackgroundJobState.error,
+            BackgroundJobState.pending,
+        ]
+
+
+def test_maintain_api_call_logs(db):
+    def add_call(time, duration, status_code=None):
+        session.add(
+            APICall(
+                time=time,
+                method="/org.couchers.api.core.API/Ping",
+                status_code=status_code,
+                duration=duration,
+                version="testing_version",
+            )
+        )
+
+    old_hour = (now() - timedelta(days=40)).replace(minute=0, second=0, microsecond=0)
+
+    with session_scope() as session:
+        for i in range(100):
+            add_call(old_hour + timedelta(seconds=i), float(i), "NOT_FOUND" if i < 10 else None)
+        add_call(now(), 5.0)
+
+    process_maintain_api_call_logs(empty_pb2.Empty())
+
+    with session_scope() as session:
+        # the old calls are rolled up and dropped, recent ones stay
+        assert session.execute(select(func.count()).select_from(APICall)).scalar_one() == 1
+        rollup = session.execute(select(APICallRollup)).scalar_one()
+        assert rollup.hour == old_hour
+        assert rollup.method == "/org.couchers.api.core.API/Ping"
+        assert rollup.count == 100
+        assert rollup.error_count == 10
+        assert 49 <= rollup.duration_p50 <= 50
+        assert 94 <= rollup.duration_p95 <= 95
+        assert 98 <= rollup.duration_p99 <= 99
+
+        # partitions for the coming week were created
+        partition_days = set(_api_calls_partition_days(session))
+        for days_ahead in range(1, 8):
+            assert today() + timedelta(days=days_ahead) in partition_days
+
+    # new calls go into the daily partitions, and running it again is harmless
+    with session_scope() as session:
+        add_call(now() + timedelta(days=1), 5.0)
+
+    process_maintain_api_call_logs(empty_pb2.Empty())
+
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(APICall)).scalar_one() == 2
+        assert session.execute(select(func.count()).select_from(APICallRollup)).scalar_one() == 1
+
+
 def test_enforce_community_memberships(db):
     queue_job(BackgroundJobType.enforce_community_membership, empty_pb2.Empty())
     process_job()
@@ -181,6 +278,62 @@ def test_enforce_community_memberships(db):
         )
 
 
+def test_queue_jobs(db):
+    job_ids = queue_jobs(
+        [
+            (BackgroundJobType.purge_login_tokens, empty_pb2.Empty()),
+            (BackgroundJobType.enforce_community_membership, empty_pb2.Empty(), 2),
+        ]
+    )
+    assert len(job_ids) == 2
+
+    with session_scope() as session:
+        jobs = session.execute(select(BackgroundJob).order_by(BackgroundJob.id)).scalars().all()
+        assert [job.id for job in jobs] == job_ids
+        assert [job.job_type for job in jobs] == [
+            BackgroundJobType.purge_login_tokens,
+            BackgroundJobType.enforce_community_membership,
+        ]
+        assert [job.max_tries for job in jobs] == [5, 2]
+        assert all(job.state == BackgroundJobState.pending for job in jobs)
+
+    assert queue_jobs([]) == []
+
+    while process_job():
+        pass
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.state == BackgroundJobState.completed)
+            ).scalar_one()
+            == 2
+        )
+
+
+def test_queue_jobs_in_session_is_atomic(db):
+    class RollMeBack(Exception):
+        pass
+
+    with pytest.raises(RollMeBack):
+        with session_scope() as session:
+            queue_jobs_in_session(session, [(BackgroundJobType.purge_login_tokens, empty_pb2.Empty())] * 3)
+            queue_email("sender_name", "sender_email", "recipient", "subject", "plain", "html", session=session)
+            raise RollMeBack()
+
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(BackgroundJob)).scalar_one() == 0
+
+    with session_scope() as session:
+        queue_jobs_in_session(session, [(BackgroundJobType.purge_login_tokens, empty_pb2.Empty())] * 3)
+        queue_email("sender_name", "sender_email", "recipient", "subject", "plain", "html", session=session)
+
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(BackgroundJob)).scalar_one() == 4
+
+
 def test_service_jobs(db):
     queue_email("sender_name", "sender_email", "recipient", "subject", "plain", "html")
 
@@ -652,6 +805,30 @@ def test_process_send_onboarding_emails(db):
         )
 
 
+def test_process_send_onboarding_emails_in_chunks(db):
+    users = [generate_user(onboarding_emails_sent=0, last_onboarding_email_sent=None)[0] for _ in range(5)]
+
+    new_config = config.copy()
+    new_config["ONBOARDING_EMAILS_CHUNK_SIZE"] = 2
+
+    with patch("couchers.config.config", new_config):
+        process_send_onboarding_emails(empty_pb2.Empty())
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.job_type == BackgroundJobType.send_email)
+            ).scalar_one()
+            == 5
+        )
+        for user in users:
+            db_user = session.execute(select(User).where(User.id == user.id)).scalar_one()
+            assert db_user.onboarding_emails_sent == 1
+            assert db_user.last_onboarding_email_sent is not None
+
+
 def test_process_send_reference_reminders(db):
     # need to test:
     # case 1: bidirectional (no emails)
@@ -733,53 +910,136 @@ def test_process_send_reference_reminders(db):
 
         assert emails == expected_emails
 
+    # the reminder flags were set in bulk, so a second run doesn't send anything new
+    process_send_reference_reminders(empty_pb2.Empty())
+
+    while process_job():
+        pass
+
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(Email)).scalar_one() == len(expected_emails)
+        assert (
+            session.execute(select(HostRequest).where(HostRequest.conversation_id == hr4)).scalar_one()
+        ).host_sent_reference_reminders == 1
+        assert (
+            session.execute(select(HostRequest).where(HostRequest.conversation_id == hr5)).scalar_one()
+        ).host_sent_reference_reminders == 0
+
+
+@pytest.fixture
+def mailchimp_stand_in():
+    """
+    A local HTTP server that answers like Mailchimp's batch subscribe endpoint, members whose email starts with "fail"
+    are rejected
+    """
+    requests_received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            requests_received.append((self.path, self.headers["Authorization"], body))
+            members = [member for member in body["members"] if not member["email_address"].startswith("fail")]
+            errors = [
+                {"email_address": member["email_address"], "error": "Invalid", "error_code": "ERROR_GENERIC"}
+                for member in body["members"]
+                if member["email_address"].startswith("fail")
+            ]
+            res = json.dumps({"new_members": members, "updated_members": [], "errors": errors}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(res)))
+            self.end_headers()
+            self.wfile.write(res)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/3.0", requests_received
+    server.shutdown()
+    server.server_close()
+
+
+def test_process_add_users_to_email_list(db, mailchimp_stand_in):
+    base_url, requests_received = mailchimp_stand_in
 
-def test_process_add_users_to_email_list(db):
     new_config = config.copy()
     new_config["MAILCHIMP_ENABLED"] = True
     new_config["MAILCHIMP_API_KEY"] = "dummy_api_key"
     new_config["MAILCHIMP_DC"] = "dc99"
     new_config["MAILCHIMP_LIST_ID"] = "dummy_list_id"
+    new_config["MAILCHIMP_BASE_URL"] = base_url
 
     with patch("couchers.config.config", new_config):
-        with patch("couchers.jobs.handlers.requests.post") as mock:
-            process_add_users_to_email_list(empty_pb2.Empty())
-        mock.assert_not_called()
+        process_add_users_to_email_list(empty_pb2.Empty())
+        assert requests_received == []
 
         generate_user(added_to_mailing_list=False, email="testing1@couchers.invalid", name="Tester1")
         generate_user(added_to_mailing_list=True, email="testing2@couchers.invalid", name="Tester2")
         generate_user(added_to_mailing_list=False, email="testing3@couchers.invalid", name="Tester3 von test")
 
-        with patch("couchers.jobs.handlers.requests.post") as mock:
-            ret = mock.return_value
-            ret.status_code = 200
-            process_add_users_to_email_list(empty_pb2.Empty())
-
-        mock.assert_called_once_with(
-            "https://dc99.api.mailchimp.com/3.0/lists/dummy_list_id",
-            auth=("apikey", "dummy_api_key"),
-            json={
-                "members": [
-                    {
-                        "email_address": "testing1@couchers.invalid",
-                        "status_if_new": "subscribed",
-                        "status": "subscribed",
-                        "merge_fields": {
-                            "FNAME": "Tester1",
-                        },
+        process_add_users_to_email_list(empty_pb2.Empty())
+
+        assert len(requests_received) == 1
+        path, authorization, body = requests_received[0]
+        assert path == "/3.0/lists/dummy_list_id"
+        assert authorization == "Basic " + b64encode(b"apikey:dummy_api_key").decode()
+        assert body == {
+            "members": [
+                {
+                    "email_address": "testing1@couchers.invalid",
+                    "status_if_new": "subscribed",
+                    "merge_fields": {
+                        "FNAME": "Tester1",
                     },
-                    {
-                        "email_address": "testing3@couchers.invalid",
-                        "status_if_new": "subscribed",
-                        "status": "subscribed",
-                        "merge_fields": {
-                            "FNAME": "Tester3 von test",
-                        },
+                },
+                {
+                    "email_address": "testing3@couchers.invalid",
+                    "status_if_new": "subscribed",
+                    "merge_fields": {
+                        "FNAME": "Tester3 von test",
                     },
+                },
+            ],
+            "update_existing": True,
+        }
+
+        requests_received.clear()
+        process_add_users_to_email_list(empty_pb2.Empty())
+        assert requests_received == []
+
+
+def test_process_add_users_to_email_list_in_batches(db, mailchimp_stand_in):
+    base_url, requests_received = mailchimp_stand_in
+
+    new_config = config.copy()
+    new_config["MAILCHIMP_ENABLED"] = True
+    new_config["MAILCHIMP_BASE_URL"] = base_url
+    new_config["MAILCHIMP_CONCURRENCY"] = 2
+
+    for i in range(5):
+        generate_user(added_to_mailing_list=False, email=f"ok{i}@couchers.invalid")
+    failing_user, _ = generate_user(added_to_mailing_list=False, email="fail@couchers.invalid")
+
+    with patch("couchers.config.config", new_config):
+        with patch("couchers.jobs.handlers.MAILCHIMP_BATCH_SIZE", 2):
+            process_add_users_to_email_list(empty_pb2.Empty())
+
+            # 6 users in batches of 2
+            assert len(requests_received) == 3
+
+            with session_scope() as session:
+                assert session.execute(select(User.id).where(User.added_to_mailing_list == False)).scalars().all() == [
+                    failing_user.id
                 ]
-            },
-        )
 
-        with patch("couchers.jobs.handlers.requests.post") as mock:
+            # only the rejected member is sent again
+            requests_received.clear()
             process_add_users_to_email_list(empty_pb2.Empty())
-        mock.assert_not_called()
+
+            assert len(requests_received) == 1
+            assert [member["email_address"] for member in requests_received[0][2]["members"]] == [
+                "fail@couchers.invalid"
+            ]
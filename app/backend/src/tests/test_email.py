@@ -257,7 +257,7 @@ def test_email_patching_fails(db):
 
         patched_msg = random_hex(64)
 
-        def mock_queue_email(sender_name, sender_email, recipient, subject, plain, html):
+        def mock_queue_email(sender_name, sender_email, recipient, subject, plain, html, session=None):
             raise Exception(patched_msg)
 
         with pytest.raises(Exception) as e:
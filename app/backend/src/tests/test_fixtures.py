@@ -12,8 +12,8 @@ from sqlalchemy.sql import or_, text
 from couchers.config import config
 from couchers.constants import GUIDELINES_VERSION, TOS_VERSION
 from couchers.crypto import random_hex
-from couchers.db import get_engine, session_scope
-from couchers.interceptors import AuthValidatorInterceptor, _try_get_and_update_user_details
+from couchers.db import clear_friend_ids_cache, get_engine, invalidate_friend_ids, session_scope
+from couchers.interceptors import AuthValidatorInterceptor, ReadOnlyInterceptor, _try_get_and_update_user_details
 from couchers.models import (
     Base,
     FriendRelationship,
@@ -199,6 +199,8 @@ def db():
     """
 
     recreate_database()
+    # user ids start over in the new database, so cached friend lists are meaningless
+    clear_friend_ids_cache()
 
 
 def generate_user(*, make_invisible=False, **kwargs):
@@ -297,6 +299,7 @@ def make_friends(user1, user2):
             status=FriendStatus.accepted,
         )
         session.add(friend_relationship)
+    invalidate_friend_ids(user1.id, user2.id)
 
 
 def make_user_block(user1, user2):
@@ -432,7 +435,7 @@ def real_api_session(token):
     Create an API for testing, using TCP sockets, uses the token for auth
     """
     with futures.ThreadPoolExecutor(1) as executor:
-        server = grpc.server(executor, interceptors=[AuthValidatorInterceptor()])
+        server = grpc.server(executor, interceptors=[AuthValidatorInterceptor(), ReadOnlyInterceptor()])
         port = server.add_secure_port("localhost:0", grpc.local_server_credentials())
         api_pb2_grpc.add_APIServicer_to_server(API(), server)
         server.start()
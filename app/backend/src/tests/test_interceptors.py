@@ -1,15 +1,29 @@
 from concurrent import futures
 from contextlib import contextmanager
+from unittest.mock import Mock, patch
 
 import grpc
 import pytest
 from google.protobuf import empty_pb2
+from sqlalchemy.sql import func
 
 from couchers import errors
+from couchers.config import config
 from couchers.crypto import random_hex
 from couchers.db import session_scope
-from couchers.interceptors import AuthValidatorInterceptor, ErrorSanitizationInterceptor, TracingInterceptor
-from couchers.metrics import CODE_LABEL, EXCEPTION_LABEL, METHOD_LABEL, servicer_duration_histogram
+from couchers.interceptors import (
+    AuthValidatorInterceptor,
+    ErrorSanitizationInterceptor,
+    ReadOnlyInterceptor,
+    TracingInterceptor,
+)
+from couchers.metrics import (
+    CODE_LABEL,
+    EXCEPTION_LABEL,
+    METHOD_LABEL,
+    servicer_duration_histogram,
+    servicer_queries_histogram,
+)
 from couchers.models import APICall, UserSession
 from couchers.servicers.account import Account
 from couchers.sql import couchers_select as select
@@ -213,6 +227,101 @@ def test_tracing_interceptor_sensitive(db):
     _check_histogram_labels("/testing.Test/TestRpc", "", "", 1)
 
 
+def test_tracing_interceptor_sensitive_nested(db):
+    def TestRpc(request, context):
+        return auth_pb2.SignupFlowRes(flow_token="secret flow token", need_basic=True)
+
+    with interceptor_dummy_api(
+        TestRpc,
+        interceptors=[TracingInterceptor()],
+        request_type=auth_pb2.SignupFlowReq,
+        response_type=auth_pb2.SignupFlowRes,
+    ) as call_rpc:
+        res = call_rpc(
+            auth_pb2.SignupFlowReq(
+                email_token="secret email token",
+                account=auth_pb2.SignupAccount(password="should be removed", username="not removed"),
+            )
+        )
+        # the response sent to the client is untouched
+        assert res.flow_token == "secret flow token"
+
+    with session_scope() as session:
+        trace = session.execute(select(APICall)).scalar_one()
+        req = auth_pb2.SignupFlowReq.FromString(trace.request)
+        assert not req.email_token
+        assert not req.account.password
+        assert req.account.username == "not removed"
+        res = auth_pb2.SignupFlowRes.FromString(trace.response)
+        assert not res.flow_token
+        assert res.need_basic
+
+
+def test_tracing_interceptor_size_cap_and_sampling(db):
+    def TestRpc(request, context):
+        return auth_pb2.AuthReq(user="x" * 1000)
+
+    with interceptor_dummy_api(
+        TestRpc,
+        interceptors=[TracingInterceptor()],
+        request_type=auth_pb2.SignupAccount,
+        response_type=auth_pb2.AuthReq,
+    ) as call_rpc:
+        config["API_CALLS_LOG_MAX_BYTES"] = 100
+        call_rpc(auth_pb2.SignupAccount(username="small"))
+        config["API_CALLS_LOG_SAMPLE_RATE"] = 0.0
+        call_rpc(auth_pb2.SignupAccount(username="small"))
+
+    with session_scope() as session:
+        big, unsampled = session.execute(select(APICall).order_by(APICall.id)).scalars().all()
+        # the request fits, but the response is too big
+        assert auth_pb2.SignupAccount.FromString(big.request).username == "small"
+        assert not big.response
+        # call is still recorded, just without bodies
+        assert unsampled.method == "/testing.Test/TestRpc"
+        assert not unsampled.request
+        assert not unsampled.response
+
+    _check_histogram_labels("/testing.Test/TestRpc", "", "", 2)
+
+
+def test_tracing_interceptor_query_stats(db, caplog):
+    def TestRpc(request, context):
+        with session_scope() as session:
+            session.execute(select(func.generate_series(1, 5))).all()
+            session.execute(select(func.now())).all()
+        return empty_pb2.Empty()
+
+    with interceptor_dummy_api(TestRpc, interceptors=[TracingInterceptor()]) as call_rpc:
+        call_rpc(empty_pb2.Empty())
+        config["API_CALLS_LOG_QUERIES_THRESHOLD"] = 1
+        call_rpc(empty_pb2.Empty())
+
+    with session_scope() as session:
+        first, second = session.execute(select(APICall).order_by(APICall.id)).scalars().all()
+        # writing the log itself doesn't count
+        assert first.query_count == 2
+        assert first.query_rows == 6
+        assert first.query_duration > 0
+        assert second.query_count == 2
+
+    # only the second call was over the threshold
+    logged = [r.getMessage() for r in caplog.records if "/testing.Test/TestRpc ran 2 queries" in r.getMessage()]
+    assert len(logged) == 1
+    assert "generate_series" in logged[0]
+
+    metrics = servicer_queries_histogram.collect()
+    queries_histogram = [m for m in metrics if m.name == "servicer_queries"][0]
+    queries_sum = [
+        s
+        for s in queries_histogram.samples
+        if s.name == "servicer_queries_sum" and s.labels[METHOD_LABEL] == "/testing.Test/TestRpc"
+    ][0]
+    assert queries_sum.value == 4
+    servicer_queries_histogram.clear()
+    _check_histogram_labels("/testing.Test/TestRpc", "", "", 2)
+
+
 def test_tracing_interceptor_exception(db):
     def TestRpc(request, context):
         raise Exception("Some error message")
@@ -349,6 +458,37 @@ def test_auth_interceptor(db):
         assert e.value.details() == "Unauthorized"
 
 
+def test_read_only_interceptor(db):
+    transaction_read_only = []
+
+    def TestRpc(request, context):
+        with session_scope() as session:
+            transaction_read_only.append(
+                session.execute(select(func.current_setting("transaction_read_only"))).scalar_one()
+            )
+        return empty_pb2.Empty()
+
+    # GetUser is marked read_only
+    with interceptor_dummy_api(
+        TestRpc,
+        interceptors=[ReadOnlyInterceptor()],
+        service_name="org.couchers.api.core.API",
+        method_name="GetUser",
+    ) as call_rpc:
+        call_rpc(empty_pb2.Empty())
+
+    # UpdateProfile is not
+    with interceptor_dummy_api(
+        TestRpc,
+        interceptors=[ReadOnlyInterceptor()],
+        service_name="org.couchers.api.core.API",
+        method_name="UpdateProfile",
+    ) as call_rpc:
+        call_rpc(empty_pb2.Empty())
+
+    assert transaction_read_only == ["on", "off"]
+
+
 def test_tracing_interceptor_auth_cookies(db):
     user, token = generate_user()
 
@@ -498,3 +638,41 @@ def test_auth_levels(db):
             call_rpc(empty_pb2.Empty())
         assert e.value.code() == grpc.StatusCode.INTERNAL
         assert e.value.details() == "Internal authentication error."
+
+
+def test_auth_interceptor_uses_precomputed_auth_levels():
+    # the auth levels are worked out once when the interceptor is created, see benchmarks.py for the per-call cost
+    interceptor = AuthValidatorInterceptor()
+    handler = grpc.unary_unary_rpc_method_handler(lambda request, context: empty_pb2.Empty())
+
+    class HandlerCallDetails:
+        invocation_metadata = (("user-agent", "grpc-python"), ("x-forwarded-for", "127.0.0.1"))
+
+        def __init__(self, method):
+            self.method = method
+
+    with patch("couchers.descriptor_pool.get_descriptor_pool") as get_descriptor_pool_mock:
+        with patch("couchers.interceptors.get_service_descriptors") as get_service_descriptors_mock:
+            open_handler = interceptor.intercept_service(
+                lambda handler_call_details: handler,
+                HandlerCallDetails("/org.couchers.resources.Resources/GetTermsOfService"),
+            )
+            unknown_handler = interceptor.intercept_service(
+                lambda handler_call_details: handler,
+                HandlerCallDetails("/org.couchers.resources.Resources/DoesNotExist"),
+            )
+    get_descriptor_pool_mock.assert_not_called()
+    get_service_descriptors_mock.assert_not_called()
+
+    # the open method goes through to the servicer, without a user
+    context = Mock()
+    assert open_handler.unary_unary(empty_pb2.Empty(), context) == empty_pb2.Empty()
+    assert context.user_id is None
+    context.abort.assert_not_called()
+
+    # the unknown one is answered straight away
+    context = Mock()
+    unknown_handler.unary_unary(empty_pb2.Empty(), context)
+    context.abort.assert_called_once_with(
+        grpc.StatusCode.UNIMPLEMENTED, "API call does not exist. Please refresh and try again."
+    )
@@ -5,7 +5,19 @@ from google.protobuf import wrappers_pb2
 from couchers import errors
 from couchers.crypto import random_hex
 from couchers.db import session_scope
-from couchers.models import Cluster, ClusterRole, ClusterSubscription, Node, Page, PageType, PageVersion, Thread, Upload
+from couchers.models import (
+    Cluster,
+    ClusterRole,
+    ClusterSubscription,
+    Node,
+    Page,
+    PageEditor,
+    PageType,
+    PageVersion,
+    Thread,
+    Upload,
+)
+from couchers.sql import couchers_select as select
 from couchers.utils import create_polygon_lat_lng, now, to_aware_datetime, to_multi
 from proto import pages_pb2
 from tests.test_communities import create_community
@@ -513,6 +525,55 @@ def test_owner_not_moderator(db):
         assert res.thread.num_responses == 0
 
 
+def test_page_current_version_and_editors(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    with session_scope() as session:
+        create_community(session, 0, 2, "Root node", [user1], [], None)
+
+    with pages_session(token2) as api:
+        page_id = api.CreatePlace(
+            pages_pb2.CreatePlaceReq(
+                title="dummy title",
+                content="dummy content",
+                address="dummy address",
+                location=pages_pb2.Coordinate(lat=1, lng=1),
+            )
+        ).page_id
+
+    # user1 is a moderator
+    with pages_session(token1) as api:
+        res = api.UpdatePage(pages_pb2.UpdatePageReq(page_id=page_id, title=wrappers_pb2.StringValue(value="title 2")))
+        assert res.editor_user_ids == [user2.id, user1.id]
+
+    with pages_session(token2) as api:
+        res = api.UpdatePage(pages_pb2.UpdatePageReq(page_id=page_id, title=wrappers_pb2.StringValue(value="title 3")))
+        assert res.title == "title 3"
+        assert res.last_editor_user_id == user2.id
+        assert res.editor_user_ids == [user2.id, user1.id]
+
+    with session_scope() as session:
+        page = session.execute(select(Page).where(Page.id == page_id)).scalar_one()
+        versions = (
+            session.execute(select(PageVersion).where(PageVersion.page_id == page_id).order_by(PageVersion.id))
+            .scalars()
+            .all()
+        )
+        assert len(versions) == 3
+        assert page.current_version_id == versions[-1].id
+        assert page.current_version.title == "title 3"
+        assert page.created == versions[0].created
+        assert to_aware_datetime(res.created) == page.created
+        assert to_aware_datetime(res.last_edited) == versions[-1].created
+
+        editors = session.execute(select(PageEditor).where(PageEditor.page_id == page_id)).scalars().all()
+        assert {(editor.user_id, editor.first_version_id) for editor in editors} == {
+            (user2.id, versions[0].id),
+            (user1.id, versions[1].id),
+        }
+        assert [user.id for user in page.editors] == [user2.id, user1.id]
+
+
 def test_update_page_errors(db):
     user, token = generate_user()
     with session_scope() as session:
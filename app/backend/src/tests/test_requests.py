@@ -1,12 +1,13 @@
-from datetime import timedelta
+from datetime import date, datetime, timedelta
 
 import grpc
 import pytest
 
 from couchers import errors
 from couchers.db import session_scope
-from couchers.models import Message, MessageType
-from couchers.utils import today
+from couchers.models import HostRequest, Message, MessageType
+from couchers.sql import couchers_select as select
+from couchers.utils import today, utc
 from proto import api_pb2, conversations_pb2, requests_pb2
 from tests.test_fixtures import api_session, db, generate_user, requests_session, testconfig  # noqa
 
@@ -326,6 +327,43 @@ def test_ListHostRequests_active_filter(db):
         assert len(res.host_requests) == 0
 
 
+def test_host_request_times_stored(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    today_plus_2 = today() + timedelta(days=2)
+    today_plus_3 = today() + timedelta(days=3)
+
+    with requests_session(token1) as api:
+        request_id = api.CreateHostRequest(
+            requests_pb2.CreateHostRequestReq(
+                host_user_id=user2.id,
+                from_date=today_plus_2.isoformat(),
+                to_date=today_plus_3.isoformat(),
+                text="Test request",
+            )
+        ).host_request_id
+
+    def midnight(date_):
+        return datetime(date_.year, date_.month, date_.day, tzinfo=utc)
+
+    with session_scope() as session:
+        host_request = session.execute(
+            select(HostRequest).where(HostRequest.conversation_id == request_id)
+        ).scalar_one()
+        assert host_request.start_time == midnight(today_plus_2)
+        assert host_request.end_time == midnight(today_plus_3) + timedelta(days=1)
+        assert host_request.end_time_to_write_reference == midnight(today_plus_3) + timedelta(days=15)
+
+        # kept up to date when the dates change
+        host_request.from_date = date(2020, 1, 1)
+        host_request.to_date = date(2020, 1, 5)
+        session.flush()
+        assert host_request.start_time == datetime(2020, 1, 1, tzinfo=utc)
+        assert host_request.end_time == datetime(2020, 1, 6, tzinfo=utc)
+        assert host_request.end_time_to_write_reference == datetime(2020, 1, 20, tzinfo=utc)
+        assert not host_request.can_write_reference
+
+
 def test_RespondHostRequests(db):
     user1, token1 = generate_user()
     user2, token2 = generate_user()
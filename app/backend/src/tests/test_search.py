@@ -1,9 +1,16 @@
+from datetime import timedelta
+
 import pytest
+from dateutil.relativedelta import relativedelta
+from google.protobuf import empty_pb2, wrappers_pb2
 
-from couchers.utils import create_coordinate
+from couchers.db import session_scope
+from couchers.jobs.handlers import process_update_user_ranking_features
+from couchers.models import HostingStatus, LanguageAbility, LanguageFluency
+from couchers.utils import create_coordinate, now, today
 from proto import search_pb2
 from tests.test_communities import testing_communities  # noqa
-from tests.test_fixtures import db, generate_user, search_session, testconfig  # noqa
+from tests.test_fixtures import db, generate_user, make_friends, search_session, testconfig  # noqa
 
 
 @pytest.fixture(autouse=True)
@@ -73,3 +80,76 @@ def test_regression_search_in_area(db):
             )
         )
         assert [result.user.user_id for result in res.results] == [user3.id, user4.id]
+
+
+def test_UserSearch_language_friends_age(db):
+    user1, token1 = generate_user(birthdate=today() - relativedelta(years=20))
+    user2, token2 = generate_user(birthdate=today() - relativedelta(years=30))
+    user3, token3 = generate_user(birthdate=today() - relativedelta(years=40, days=-1))
+    user4, token4 = generate_user(birthdate=today() - relativedelta(years=60))
+
+    make_friends(user1, user2)
+    make_friends(user3, user1)
+
+    with session_scope() as session:
+        session.add(LanguageAbility(user_id=user2.id, language_code="deu", fluency=LanguageFluency.beginner))
+        session.add(LanguageAbility(user_id=user4.id, language_code="deu", fluency=LanguageFluency.fluent))
+
+    def search(**kwargs):
+        with search_session(token1) as api:
+            res = api.UserSearch(search_pb2.UserSearchReq(**kwargs))
+        return [result.user.user_id for result in res.results]
+
+    assert search(language=wrappers_pb2.StringValue(value="deu")) == [user2.id, user4.id]
+    assert search(friends_only=True) == [user2.id, user3.id]
+    # age bounds are inclusive, user3 is 39 until tomorrow
+    assert search(age_min=wrappers_pb2.UInt32Value(value=30)) == [user2.id, user3.id, user4.id]
+    assert search(age_max=wrappers_pb2.UInt32Value(value=39)) == [user1.id, user2.id, user3.id]
+    assert search(age_min=wrappers_pb2.UInt32Value(value=31), age_max=wrappers_pb2.UInt32Value(value=39)) == [user3.id]
+    assert search(friends_only=True, language=wrappers_pb2.StringValue(value="deu")) == [user2.id]
+
+
+def test_NearestHosts(db):
+    # roughly 11 km apart, on a line going north from (0, 0)
+    user1, token1 = generate_user(geom=create_coordinate(0.3, 0), hosting_status=HostingStatus.can_host)
+    user2, token2 = generate_user(geom=create_coordinate(0.1, 0), hosting_status=HostingStatus.can_host)
+    user3, token3 = generate_user(geom=create_coordinate(0.2, 0), hosting_status=HostingStatus.cant_host)
+    user4, token4 = generate_user(geom=create_coordinate(-0.2, 0), hosting_status=HostingStatus.can_host)
+    user5, token5 = generate_user(geom=create_coordinate(10, 10), hosting_status=HostingStatus.can_host)
+
+    with search_session(token3) as api:
+        res = api.NearestHosts(search_pb2.NearestHostsReq(lat=0, lng=0, page_size=2))
+        assert [host.user.user_id for host in res.hosts] == [user2.id, user4.id]
+        assert 11000 < res.hosts[0].distance < 11200
+        assert 22000 < res.hosts[1].distance < 22400
+
+        res = api.NearestHosts(search_pb2.NearestHostsReq(lat=0, lng=0, page_size=2, page_token=res.next_page_token))
+        assert [host.user.user_id for host in res.hosts] == [user1.id, user5.id]
+        assert not res.next_page_token
+
+
+def test_UserSearch_order_by_relevance(db):
+    user1, token1 = generate_user(hosting_status=HostingStatus.can_host)
+    user2, token2 = generate_user(hosting_status=HostingStatus.maybe)
+    user3, token3 = generate_user(hosting_status=HostingStatus.cant_host, last_active=now() - timedelta(days=30))
+    user5, token5 = generate_user()
+
+    process_update_user_ranking_features(empty_pb2.Empty())
+
+    # no ranking features yet, these come last
+    user4, token4 = generate_user(hosting_status=HostingStatus.can_host)
+    user6, token6 = generate_user()
+    user7, token7 = generate_user()
+
+    user_ids = []
+    page_token = None
+    with search_session(token5) as api:
+        while True:
+            res = api.UserSearch(search_pb2.UserSearchReq(order_by_relevance=True, page_size=3, page_token=page_token))
+            assert len(res.results) <= 3
+            user_ids += [result.user.user_id for result in res.results]
+            page_token = res.next_page_token
+            if not page_token:
+                break
+
+    assert user_ids == [user1.id, user2.id, user5.id, user3.id, user7.id, user6.id, user4.id]
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import socket
+from concurrent import futures
+from time import monotonic, sleep
+
+import grpc
+import pytest
+from google.protobuf import empty_pb2
+
+from couchers.db import session_scope
+from couchers.interceptors import (
+    AioAuthValidatorInterceptor,
+    AioErrorSanitizationInterceptor,
+    AioReadOnlyInterceptor,
+    AioTracingInterceptor,
+    AuthValidatorInterceptor,
+    ErrorSanitizationInterceptor,
+    ReadOnlyInterceptor,
+    TracingInterceptor,
+)
+from couchers.models import APICall
+from couchers.server import start_main_server_processes, wait_for_main_server_processes
+from couchers.servicers.api import API
+from couchers.servicers.gis import GIS, AsyncGIS
+from couchers.sql import couchers_select as select
+from proto import api_pb2, api_pb2_grpc, gis_pb2_grpc
+from tests.test_fixtures import db, generate_user, testconfig  # noqa
+
+
+@pytest.fixture(autouse=True)
+def _(testconfig):
+    pass
+
+
+def create_aio_test_server(threads=4):
+    """
+    A grpc.aio server with the API and async GIS servicers, returns (server, port), the server isn't started yet
+    """
+    server = grpc.aio.server(
+        futures.ThreadPoolExecutor(threads),
+        interceptors=[
+            AioErrorSanitizationInterceptor(),
+            AioTracingInterceptor(),
+            AioAuthValidatorInterceptor(),
+            AioReadOnlyInterceptor(),
+        ],
+    )
+    api_pb2_grpc.add_APIServicer_to_server(API(), server)
+    gis_pb2_grpc.add_GISServicer_to_server(AsyncGIS(), server)
+    port = server.add_secure_port("localhost:0", grpc.local_server_credentials())
+    return server, port
+
+
+def create_sync_test_server(threads=4):
+    """
+    A threaded server with the GIS servicer for comparing with create_aio_test_server, returns (server, port)
+    """
+    server = grpc.server(
+        futures.ThreadPoolExecutor(threads),
+        interceptors=[
+            ErrorSanitizationInterceptor(),
+            TracingInterceptor(),
+            AuthValidatorInterceptor(),
+            ReadOnlyInterceptor(),
+        ],
+    )
+    gis_pb2_grpc.add_GISServicer_to_server(GIS(), server)
+    port = server.add_secure_port("localhost:0", grpc.local_server_credentials())
+    return server, port
+
+
+def test_aio_server(db):
+    user, token = generate_user()
+    metadata = (("cookie", f"couchers-sesh={token}"),)
+
+    async def run():
+        server, port = create_aio_test_server()
+        await server.start()
+        try:
+            async with grpc.aio.secure_channel(f"localhost:{port}", grpc.local_channel_credentials()) as channel:
+                gis = gis_pb2_grpc.GISStub(channel)
+                api = api_pb2_grpc.APIStub(channel)
+
+                # async servicer on the event loop
+                users_res = await gis.GetUsers(empty_pb2.Empty(), metadata=metadata)
+                # sync servicer on the thread pool
+                user_res = await api.GetUser(api_pb2.GetUserReq(user=user.username), metadata=metadata)
+
+                with pytest.raises(grpc.aio.AioRpcError) as e:
+                    await gis.GetUsers(empty_pb2.Empty())
+                assert e.value.code() == grpc.StatusCode.UNAUTHENTICATED
+
+                with pytest.raises(grpc.aio.AioRpcError) as e:
+                    await api.GetUser(api_pb2.GetUserReq(user="nonexistent"), metadata=metadata)
+                assert e.value.code() == grpc.StatusCode.NOT_FOUND
+        finally:
+            await server.stop(None)
+        return users_res, user_res
+
+    users_res, user_res = asyncio.run(run())
+
+    assert json.loads(users_res.data)["type"] == "FeatureCollection"
+    assert user.username in users_res.data.decode()
+    assert user_res.username == user.username
+
+    with session_scope() as session:
+        calls = session.execute(select(APICall.method, APICall.status_code, APICall.user_id)).all()
+        assert ("/org.couchers.json.GIS/GetUsers", None, user.id) in calls
+        assert ("/org.couchers.api.core.API/GetUser", None, user.id) in calls
+        assert ("/org.couchers.api.core.API/GetUser", "NOT_FOUND", user.id) in calls
+
+
+def test_main_server_processes():
+    with socket.socket(socket.AF_INET6) as sock:
+        sock.bind(("::", 0))
+        port = sock.getsockname()[1]
+
+    processes = start_main_server_processes(port, num_processes=2)
+    try:
+        # wait for the servers to come up
+        deadline = monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("localhost", port)).close()
+                break
+            except ConnectionRefusedError:
+                assert monotonic() < deadline
+                sleep(0.1)
+        # both processes bind the same port, so neither failed to start
+        assert all(process.is_alive() for process in processes)
+
+        # when one dies, the others are stopped so that the app can exit and be restarted as a whole
+        processes[0].kill()
+        wait_for_main_server_processes(processes)
+        assert not any(process.is_alive() for process in processes)
+    finally:
+        for process in processes:
+            process.kill()
@@ -2,11 +2,15 @@ import string
 
 import grpc
 import pytest
+from google.protobuf import empty_pb2
+from sqlalchemy.sql import update
 
 from couchers import errors
 from couchers.db import session_scope
-from couchers.models import Thread
-from couchers.servicers.threads import pack_thread_id
+from couchers.jobs.handlers import process_check_thread_counts
+from couchers.models import Comment, Thread
+from couchers.servicers.threads import pack_thread_id, thread_to_pb
+from couchers.sql import couchers_select as select
 from proto import threads_pb2
 from tests.test_fixtures import db, generate_user, testconfig, threads_session  # noqa
 
@@ -72,6 +76,44 @@ def test_threads_basic(db):
         assert [reply.thread_id for reply in ret.replies] == dogs[::-1]
 
 
+def test_thread_counters(db):
+    user1, token1 = generate_user()
+
+    with session_scope() as session:
+        thread = Thread()
+        session.add(thread)
+        session.flush()
+        thread_id = thread.id
+        assert thread_to_pb(thread).num_responses == 0
+
+    with threads_session(token1) as api:
+        cat_id = api.PostReply(
+            threads_pb2.PostReplyReq(thread_id=pack_thread_id(thread_id, 0), content="cat")
+        ).thread_id
+        api.PostReply(threads_pb2.PostReplyReq(thread_id=pack_thread_id(thread_id, 0), content="dog"))
+        for animal in ["cheetah", "lynx"]:
+            api.PostReply(threads_pb2.PostReplyReq(thread_id=cat_id, content=animal))
+
+    def counts():
+        with session_scope() as session:
+            thread = session.execute(select(Thread).where(Thread.id == thread_id)).scalar_one()
+            comments = session.execute(select(Comment.content, Comment.num_replies)).all()
+            return thread_to_pb(thread).num_responses, dict(comments)
+
+    assert counts() == (4, {"cat": 2, "dog": 0})
+
+    # the consistency check leaves correct counts alone, and fixes broken ones
+    process_check_thread_counts(empty_pb2.Empty())
+    assert counts() == (4, {"cat": 2, "dog": 0})
+
+    with session_scope() as session:
+        session.execute(update(Comment).values(num_replies=7))
+        session.execute(update(Thread).values(num_responses=0))
+
+    process_check_thread_counts(empty_pb2.Empty())
+    assert counts() == (4, {"cat": 2, "dog": 0})
+
+
 def test_threads_errors(db):
     user1, token1 = generate_user()
     with threads_session(token1) as api:
@@ -2,6 +2,7 @@ from sqlalchemy.sql import func
 
 from couchers.models import FriendRelationship, User
 from couchers.sql import couchers_select as select
+from couchers.sql import invalidate_hidden_user_ids
 from tests.test_fixtures import (  # noqa
     db,
     generate_user,
@@ -75,3 +76,34 @@ def test_select_dot_where_users_column_visible(db):
             ).scalar_one()
             == 1
         )
+
+
+def test_hidden_users_cached_per_request(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+
+    context = _FakeContext(user1.id)
+
+    def count_visible():
+        with session_scope() as session:
+            return session.execute(select(func.count()).select_from(User).where_users_visible(context)).scalar_one()
+
+    # not looked up yet, so the block list is checked within the query
+    assert "user_blocks" in str(select(User).where_users_visible(context))
+    assert count_visible() == 3
+
+    # running that query looked them up, there are no blocks so no filter on block list at all
+    assert "user_blocks" not in str(select(User).where_users_visible(context))
+    assert "ALL" not in str(select(User).where_users_visible(context))
+
+    make_user_block(user1, user2)
+
+    # still using the cached set for this request
+    assert count_visible() == 3
+
+    # back to checking within the query, which sees the new block and looks them up again
+    invalidate_hidden_user_ids(context)
+    assert count_visible() == 2
+    assert "ALL" in str(select(User).where_users_visible(context))
+    assert count_visible() == 2
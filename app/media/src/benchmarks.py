@@ -0,0 +1,129 @@
+"""
+Benchmarks that are too slow or too noisy for the test suite. Run them with
+
+    python benchmarks.py [name ...]
+
+which runs all of them if no names are given.
+"""
+import io
+import os
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from PIL import Image
+
+from tests.test_server import (
+    DATADIR,
+    create_test_app,
+    create_upload_request,
+    generate_upload_path,
+    mock_main_server,
+    upload_image,
+)
+
+
+def upload_to_available():
+    with open(DATADIR / "5000x5000.jpg", "rb") as f:
+        data = f.read()
+
+    with TemporaryDirectory() as tmp_dir:
+        app, secret_key, bearer_token = create_test_app(Path(tmp_dir))
+        timings = []
+        with app.test_client() as client, mock_main_server(bearer_token, lambda x: True):
+            for _ in range(3):
+                key, request = create_upload_request()
+                upload_path = generate_upload_path(request, secret_key)
+
+                start = perf_counter()
+                rv = client.post(upload_path, data={"file": (io.BytesIO(data), "img.jpg")})
+                assert rv.status_code == 200
+                for size in ["thumbnail", "medium", "full"]:
+                    rv = client.get(f"/img/{size}/{key}.jpg")
+                    assert rv.status_code == 200
+                timings.append(perf_counter() - start)
+
+    print(f"Upload to all sizes available, 5000x5000 jpeg: best of 3 {min(timings) * 1000:.0f} ms")
+
+
+def _reset_peak_rss():
+    # writing 5 resets the peak resident set size (VmHWM) of the process, linux only
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def _peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+
+def upload_peak_rss():
+    with TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        app, secret_key, bearer_token = create_test_app(tmp_path / "uploads")
+
+        # a big noisy photo that doesn't compress well, so it gets streamed to disk rather than kept in memory
+        width, height = 6000, 4000
+        image_path = tmp_path / "big.jpg"
+        Image.frombytes("L", (width, height), os.urandom(width * height)).convert("RGB").save(image_path, quality=75)
+        size = image_path.stat().st_size
+
+        with app.test_client() as client, mock_main_server(bearer_token, lambda x: True):
+            key, request = create_upload_request()
+            upload_path = generate_upload_path(request, secret_key)
+
+            with open(image_path, "rb") as f:
+                _reset_peak_rss()
+                before = _peak_rss()
+                rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+                peak = _peak_rss()
+            assert rv.status_code == 200
+
+    # this includes the test client building the whole request body in memory
+    print(
+        f"Upload of {width}x{height} jpeg ({size / 2**20:.1f} MiB): "
+        f"peak RSS {peak / 2**20:.0f} MiB, {(peak - before) / 2**20:.0f} MiB above the baseline"
+    )
+
+
+def file_serving():
+    # with x-accel-redirect and x-sendfile the bytes are sent by the frontend server, so this is just the time spent in
+    # the app
+    with TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        width, height = 2000, 1500
+        image_path = tmp_path / "photo.jpg"
+        Image.frombytes("L", (width, height), os.urandom(width * height)).convert("RGB").save(image_path, quality=75)
+
+        for file_serving in ["send_file", "x-accel-redirect", "x-sendfile"]:
+            app, secret_key, bearer_token = create_test_app(tmp_path / file_serving, file_serving=file_serving)
+
+            with app.test_client() as client:
+                key = upload_image(client, secret_key, bearer_token, image_path)
+                size = (tmp_path / file_serving / "full" / f"{key}.jpg").stat().st_size
+
+                n = 200
+                start = perf_counter()
+                for _ in range(n):
+                    rv = client.get(f"/img/full/{key}.jpg")
+                    assert rv.status_code == 200
+                elapsed = perf_counter() - start
+
+            print(
+                f"Serving full size image ({size / 1024:.0f} KiB) with {file_serving}: "
+                f"{n / elapsed:.0f} req/s, {n * size / elapsed / 2**20:.0f} MiB/s of images"
+            )
+
+
+BENCHMARKS = {
+    "upload_to_available": upload_to_available,
+    "upload_peak_rss": upload_peak_rss,
+    "file_serving": file_serving,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,13 +1,19 @@
+import io
 import logging
 import os
+import secrets
+import tempfile
+import threading
 from base64 import urlsafe_b64decode
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from weakref import WeakValueDictionary
 
 import backoff
 import grpc
 import pyvips
-from flask import Flask, abort, request, send_file
+from flask import Flask, Request, Response, abort, request, send_file
 from werkzeug.utils import secure_filename
 
 from media.crypto import verify_hash_signature
@@ -15,6 +21,84 @@ from proto import media_pb2, media_pb2_grpc
 
 logger = logging.getLogger(__name__)
 
+# one lock per key, so two requests never generate or write the same image at once
+_key_locks = WeakValueDictionary()
+_key_locks_lock = threading.Lock()
+
+
+def _key_lock(key):
+    with _key_locks_lock:
+        lock = _key_locks.get(key)
+        if not lock:
+            lock = threading.Lock()
+            _key_locks[key] = lock
+        return lock
+
+
+# formats images are stored in, by file extension: (mimetype, save function). every image is stored as a jpeg, which is
+# what the urls point to, the others are served in its place to browsers that say they support them
+_FORMATS = {
+    "jpg": ("image/jpeg", lambda img, path: img.jpegsave(path, strip=True, interlace=True, Q=75)),
+    "webp": ("image/webp", lambda img, path: img.webpsave(path, strip=True, Q=75)),
+    "avif": ("image/avif", lambda img, path: img.heifsave(path, strip=True, Q=50, compression="av1")),
+}
+
+
+def _save_atomically(img, path, extension="jpg"):
+    """
+    Saves the image to a temporary file next to `path` and renames it into place, so nobody ever sees a half-written
+    image
+    """
+    tmp_path = f"{path}.{secrets.token_hex(8)}.tmp"
+    try:
+        # strip removes EXIF (e.g. GPS location) and other metadata
+        _FORMATS[extension][1](img, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# uploads up to this size are buffered in memory, larger ones are streamed to a temporary file on disk
+_UPLOAD_SPOOL_SIZE = 512 * 1024
+
+
+class _UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is None or total_content_length > _UPLOAD_SPOOL_SIZE:
+            # a named file, so vips can read it from disk bit by bit. it's deleted when the request is closed
+            return tempfile.NamedTemporaryFile("wb+", suffix=".upload")
+        return io.BytesIO()
+
+
+def _square_thumbnail(img, size):
+    """
+    Crops the image to a centered square and scales it to size x size
+    """
+    width = img.get("width")
+    height = img.get("height")
+
+    if width > height:
+        side = height
+        bar = (width - height) // 2
+        img = img.crop(bar, 0, width - 2 * bar, height)
+    else:
+        side = width
+        bar = (height - width) // 2
+        img = img.crop(0, bar, width, height - 2 * bar)
+
+    return img.resize(size / side)
+
+
+def _fit_within(img, size):
+    """
+    Scales the image down (never up) so it fits within size x size
+    """
+    scale = min(size / img.get("width"), size / img.get("height"))
+    if scale < 1:
+        img = img.resize(scale)
+    return img
+
 
 def create_app(
     media_server_secret_key: bytes,
@@ -24,14 +108,44 @@ def create_app(
     main_server_use_ssl: bool,
     media_upload_location: Path,
     thumbnail_size: int,
+    medium_size: int = 800,
+    enable_avif: bool = False,
+    max_upload_bytes: int = 32 * 1024 * 1024,
+    confirm_in_background: bool = False,
+    file_serving: str = "send_file",
+    accel_redirect_prefix: str = "/_uploads/",
 ):
+    """
+    `file_serving` picks who sends the bytes of images:
+    * "send_file": the app does, through the WSGI server's file wrapper (uwsgi uses sendfile() for it), with support for
+      range requests
+    * "x-accel-redirect": nginx does, the app only responds with an X-Accel-Redirect header pointing to
+      `accel_redirect_prefix` + the path under `media_upload_location`, which nginx needs to map there
+    * "x-sendfile": the frontend server does, the app only responds with an X-Sendfile header with the full path
+    """
+    if file_serving not in ["send_file", "x-accel-redirect", "x-sendfile"]:
+        raise ValueError(f"Unknown file serving mode {file_serving}")
+
+    # other formats to store alongside the jpegs, in order of preference when serving
+    alternative_formats = (["avif"] if enable_avif else []) + ["webp"]
+
+    # smaller versions of each image, generated from the full size one at upload time
+    renditions = {
+        "medium": lambda img: _fit_within(img, medium_size),
+        "thumbnail": lambda img: _square_thumbnail(img, thumbnail_size),
+    }
 
     # Create the directories
     media_upload_location.mkdir(exist_ok=True, parents=True)
     (media_upload_location / "full").mkdir(exist_ok=True, parents=True)
-    (media_upload_location / "thumbnail").mkdir(exist_ok=True, parents=True)
+    for rendition in renditions:
+        (media_upload_location / rendition).mkdir(exist_ok=True, parents=True)
 
     app = Flask(__name__)
+    app.request_class = _UploadRequest
+    app.config["USE_X_SENDFILE"] = file_serving == "x-sendfile"
+    # bigger requests are refused with a 413 before they are read
+    app.config["MAX_CONTENT_LENGTH"] = max_upload_bytes
 
     def get_path(filename, size="full"):
         return str(media_upload_location / size / filename)
@@ -39,22 +153,60 @@ def create_app(
     def _is_available(e):
         return e.code() != grpc.StatusCode.UNAVAILABLE
 
+    # the channel to the main server and the pool for background confirmations are created on first use and then kept
+    # around: uwsgi forks its workers after loading the app, and neither grpc channels nor threads survive a fork
+    media_stub = None
+    confirmation_executor = None
+    lazy_lock = threading.Lock()
+
+    def get_media_stub():
+        nonlocal media_stub
+        with lazy_lock:
+            if not media_stub:
+                # keepalive pings keep the connection from being silently dropped while idle
+                options = [
+                    ("grpc.keepalive_time_ms", 30_000),
+                    ("grpc.keepalive_timeout_ms", 10_000),
+                    ("grpc.keepalive_permit_without_calls", 1),
+                    ("grpc.http2.max_pings_without_data", 0),
+                ]
+                if main_server_use_ssl:
+                    channel = grpc.secure_channel(main_server_address, grpc.ssl_channel_credentials(), options)
+                else:
+                    logger.warning("Connecting to main server insecurely!")
+                    channel = grpc.insecure_channel(main_server_address, options)
+                media_stub = media_pb2_grpc.MediaStub(channel)
+            return media_stub
+
+    def get_confirmation_executor():
+        nonlocal confirmation_executor
+        with lazy_lock:
+            if not confirmation_executor:
+                confirmation_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="confirmation")
+            return confirmation_executor
+
     @backoff.on_exception(backoff.expo, grpc.RpcError, max_time=1, giveup=_is_available)
     def send_confirmation_to_main_server(key, filename):
         logger.warning(f"Notifying main server about new upload at {main_server_address}")
 
-        if main_server_use_ssl:
-            channel = grpc.secure_channel(main_server_address, grpc.ssl_channel_credentials())
-        else:
-            logger.warning("Connecting to main server insecurely!")
-            channel = grpc.insecure_channel(main_server_address)
-
-        media_stub = media_pb2_grpc.MediaStub(channel)
         req = media_pb2.UploadConfirmationReq(
             key=key,
             filename=filename,
         )
-        media_stub.UploadConfirmation(req, metadata=(("authorization", f"Bearer {media_server_bearer_token}"),))
+        get_media_stub().UploadConfirmation(req, metadata=(("authorization", f"Bearer {media_server_bearer_token}"),))
+
+    def confirm_or_delete(key, filename, written):
+        """
+        Lets the main server know the upload succeeded, or deletes the files
+        """
+        try:
+            send_confirmation_to_main_server(key, filename)
+        except Exception as e:
+            logger.exception(f"Confirming upload {key} failed, deleting it")
+            with _key_lock(key):
+                for written_path in written:
+                    os.remove(written_path)
+            raise e
 
     @app.route("/upload", methods=["POST"])
     def upload():
@@ -96,76 +248,92 @@ def create_app(
         if req.type != media_pb2.UploadRequest.UploadType.IMAGE:
             abort(500, "Unsupported upload type")
 
-        # handle image uploads
+        # handle image uploads. vips reads the file sequentially and shrinks on load, decoding straight to (close to) the
+        # target size, so memory use is bounded by the output size regardless of the input resolution. if it's larger
+        # than the allowed max values, it is resized to fit, it's also autorotated before the metadata is stripped
+        stream = request_file.stream
+        thumbnail_options = {"height": req.max_height, "size": "down"}
         try:
-            img = pyvips.Image.new_from_buffer(request_file.read(), options="")
+            if isinstance(stream, io.BytesIO):
+                img = pyvips.Image.thumbnail_buffer(stream.getvalue(), req.max_width, **thumbnail_options)
+            else:
+                stream.flush()
+                img = pyvips.Image.thumbnail(stream.name, req.max_width, **thumbnail_options)
+
+            # decode once, the renditions are all generated from this
+            img = img.copy_memory()
         except pyvips.Error:
             abort(400, "Invalid image")
 
-        width = img.get("width")
-        height = img.get("height")
-
-        # if it's larger than allowed max values, resize it
-        scale = min(req.max_width / width, req.max_height / height)
-        if scale < 1:
-            img = img.resize(scale)
-
-        #  autorotate before stripping the data from photo
-        img = img.autorot()
-
-        # strip removes EXIF (e.g. GPS location) and other metadata
-        img.jpegsave(path, strip=True, interlace=True, Q=75)
-
-        # let the main server know the upload succeeded, or delete the file
-        try:
-            send_confirmation_to_main_server(req.key, filename)
-            return {
-                "ok": True,
-                "key": req.key,
-                "filename": filename,
-                "full_url": f"{media_server_base_url}/img/full/{filename}",
-                "thumbnail_url": f"{media_server_base_url}/img/thumbnail/{filename}",
-            }
-        except Exception as e:
-            os.remove(path)
-            raise e
-
-    @app.route("/img/full/<key>.jpg")
-    def full(key):
-        path = get_path(key + ".jpg")
-        if not os.path.isfile(path):
+        with _key_lock(req.key):
+            # check again, someone might have used the same request in the meantime
+            if os.path.isfile(path):
+                abort(400, "Invalid request")
+
+            written = []
+            try:
+                # the full size jpeg goes last: once it exists, the upload is complete
+                for size, make_rendition in [*renditions.items(), ("full", None)]:
+                    sized_img = make_rendition(img) if make_rendition else img
+                    for extension in [*alternative_formats, "jpg"]:
+                        sized_path = get_path(f"{req.key}.{extension}", size=size)
+                        _save_atomically(sized_img, sized_path, extension)
+                        written.append(sized_path)
+            except Exception as e:
+                for written_path in written:
+                    os.remove(written_path)
+                raise e
+
+        if confirm_in_background:
+            # don't hold up this worker waiting for the main server. the uploader gets the urls right away, though the
+            # main server only accepts the key once the confirmation has gone through
+            get_confirmation_executor().submit(confirm_or_delete, req.key, filename, written)
+        else:
+            confirm_or_delete(req.key, filename, written)
+
+        return {
+            "ok": True,
+            "key": req.key,
+            "filename": filename,
+            "full_url": f"{media_server_base_url}/img/full/{filename}",
+            "medium_url": f"{media_server_base_url}/img/medium/{filename}",
+            "thumbnail_url": f"{media_server_base_url}/img/thumbnail/{filename}",
+        }
+
+    @app.route("/img/<size>/<key>.jpg")
+    def image(size, key):
+        if size != "full" and size not in renditions:
             abort(404, "Not found")
 
-        return send_file(path, mimetype="image/jpeg", conditional=True, max_age=43200)
-
-    @app.route("/img/thumbnail/<key>.jpg")
-    def thumbnail(key):
-        filename = key + ".jpg"
-        full_path = get_path(filename)
+        full_path = get_path(key + ".jpg")
         if not os.path.isfile(full_path):
             abort(404, "Not found")
 
-        thumbnail_path = get_path(filename, size="thumbnail")
-        if not os.path.isfile(thumbnail_path):
-            # generate the thumbnail...
-            img = pyvips.Image.new_from_file(full_path)
-
-            width = img.get("width")
-            height = img.get("height")
-
-            if width > height:
-                size = height
-                bar = (width - height) // 2
-                img = img.crop(bar, 0, width - 2 * bar, height)
-            else:
-                size = width
-                bar = (height - width) // 2
-                img = img.crop(0, bar, width, height - 2 * bar)
-
-            img = img.resize(thumbnail_size / size)
-            img.jpegsave(thumbnail_path, strip=True, interlace=True, Q=75)
+        # pick the preferred format the browser explicitly lists, wildcards don't count
+        accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+        extension = next((ext for ext in alternative_formats if _FORMATS[ext][0] in accepted), "jpg")
 
-        return send_file(thumbnail_path, mimetype="image/jpeg", conditional=True, max_age=43200)
+        path = get_path(f"{key}.{extension}", size=size)
+        if not os.path.isfile(path):
+            # images uploaded before all sizes and formats were generated at upload time don't have them yet
+            with _key_lock(key):
+                if not os.path.isfile(path):
+                    img = pyvips.Image.new_from_file(full_path)
+                    if size != "full":
+                        img = renditions[size](img)
+                    _save_atomically(img, path, extension)
+
+        mimetype = _FORMATS[extension][0]
+        if file_serving == "x-accel-redirect":
+            response = Response(mimetype=mimetype)
+            response.headers["X-Accel-Redirect"] = f"{accel_redirect_prefix}{size}/{key}.{extension}"
+            response.cache_control.public = True
+            response.cache_control.max_age = 43200
+        else:
+            response = send_file(path, mimetype=mimetype, conditional=True, max_age=43200)
+        # caches need to keep a copy per format
+        response.vary.add("Accept")
+        return response
 
     return app
 
@@ -190,6 +358,18 @@ def create_app_from_env():
 
     THUMBNAIL_SIZE = 200
 
+    # whether to also store and serve AVIF images, needs libvips built with libheif and an AV1 encoder, optional
+    MEDIA_SERVER_ENABLE_AVIF = os.environ.get("MEDIA_SERVER_ENABLE_AVIF", "0") == "1"
+
+    # uploads larger than this many bytes are refused, optional
+    MEDIA_SERVER_MAX_UPLOAD_BYTES = int(os.environ.get("MEDIA_SERVER_MAX_UPLOAD_BYTES", 32 * 1024 * 1024))
+
+    # whether to confirm uploads to the main server after responding to the uploader, optional
+    MEDIA_SERVER_CONFIRM_IN_BACKGROUND = os.environ.get("MEDIA_SERVER_CONFIRM_IN_BACKGROUND", "0") == "1"
+
+    # how to send images: "send_file", "x-accel-redirect" (behind nginx) or "x-sendfile", see create_app, optional
+    MEDIA_SERVER_FILE_SERVING = os.environ.get("MEDIA_SERVER_FILE_SERVING", "send_file")
+
     return create_app(
         MEDIA_SERVER_SECRET_KEY,
         MEDIA_SERVER_BEARER_TOKEN,
@@ -198,6 +378,10 @@ def create_app_from_env():
         MAIN_SERVER_USE_SSL,
         MEDIA_UPLOAD_LOCATION,
         THUMBNAIL_SIZE,
+        enable_avif=MEDIA_SERVER_ENABLE_AVIF,
+        max_upload_bytes=MEDIA_SERVER_MAX_UPLOAD_BYTES,
+        confirm_in_background=MEDIA_SERVER_CONFIRM_IN_BACKGROUND,
+        file_serving=MEDIA_SERVER_FILE_SERVING,
     )
 
 
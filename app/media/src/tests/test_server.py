@@ -1,11 +1,12 @@
 import io
 import json
-import os
+import threading
 from base64 import urlsafe_b64encode
 from concurrent import futures
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
+from time import sleep
 from urllib.parse import urlencode
 
 import grpc
@@ -57,20 +58,28 @@ def mock_main_server(*args, **kwargs):
         server.stop(None).wait()
 
 
-@pytest.fixture
-def client_with_secrets(tmp_path):
+def create_test_app(upload_location, **kwargs):
+    """
+    Creates an app with fresh secrets that stores uploads in upload_location, returns (app, secret_key, bearer_token)
+    """
     secret_key = random_bytes(32)
     bearer_token = random_bytes(32).hex()
-
     app = create_app(
         media_server_secret_key=secret_key,
         media_server_bearer_token=bearer_token,
         media_server_base_url="https://testing.couchers.invalid",
         main_server_address="localhost:8088",
         main_server_use_ssl=False,
-        media_upload_location=tmp_path,
+        media_upload_location=upload_location,
         thumbnail_size=200,
+        **kwargs,
     )
+    return app, secret_key, bearer_token
+
+
+@pytest.fixture
+def client_with_secrets(tmp_path):
+    app, secret_key, bearer_token = create_test_app(tmp_path)
 
     with app.test_client() as client:
         yield client, secret_key, bearer_token
@@ -545,3 +554,279 @@ def test_cache_headers(client_with_secrets):
     # Test with mismatching Etag
     rv = client.get(f"/img/full/{key}.jpg", headers=[("If-None-Match", "strunt")])
     assert rv.status_code == 200
+
+
+def test_medium_downscaling(client_with_secrets):
+    client, secret_key, bearer_token = client_with_secrets
+
+    key, request = create_upload_request()
+    upload_path = generate_upload_path(request, secret_key)
+
+    with mock_main_server(bearer_token, lambda x: True):
+        with open(DATADIR / "5000x1000.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+
+        jd = json.loads(rv.data)
+        assert jd["ok"]
+        assert jd["medium_url"] == f"https://testing.couchers.invalid/img/medium/{key}.jpg"
+
+        rv = client.get(f"/img/medium/{key}.jpg")
+        assert rv.status_code == 200
+
+        img = Image.open(io.BytesIO(rv.data))
+
+        assert img.width == 800
+        assert img.height == 160
+
+
+def test_renditions_generated_at_upload(client_with_secrets, tmp_path):
+    client, secret_key, bearer_token = client_with_secrets
+
+    key, request = create_upload_request()
+    upload_path = generate_upload_path(request, secret_key)
+
+    with mock_main_server(bearer_token, lambda x: True):
+        with open(DATADIR / "1000x5000.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+        assert rv.status_code == 200
+
+    for size in ["full", "medium", "thumbnail"]:
+        assert (tmp_path / size / f"{key}.jpg").is_file()
+    # no temporary files left behind
+    assert not list(tmp_path.glob("*/*.tmp"))
+
+    rv = client.get(f"/img/huge/{key}.jpg")
+    assert rv.status_code == 404
+
+
+def test_format_negotiation(client_with_secrets, tmp_path):
+    client, secret_key, bearer_token = client_with_secrets
+
+    key, request = create_upload_request()
+    upload_path = generate_upload_path(request, secret_key)
+
+    with mock_main_server(bearer_token, lambda x: True):
+        with open(DATADIR / "1000x5000.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+        assert rv.status_code == 200
+
+    for size in ["full", "medium", "thumbnail"]:
+        assert (tmp_path / size / f"{key}.webp").is_file()
+
+        # no accept header, or only wildcards: plain old jpeg
+        for headers in [{}, {"Accept": "image/*,*/*;q=0.8"}]:
+            rv = client.get(f"/img/{size}/{key}.jpg", headers=headers)
+            assert rv.status_code == 200
+            assert rv.mimetype == "image/jpeg"
+            assert "Accept" in rv.headers["Vary"]
+            assert Image.open(io.BytesIO(rv.data)).format == "JPEG"
+
+        rv = client.get(f"/img/{size}/{key}.jpg", headers={"Accept": "image/avif,image/webp,*/*"})
+        assert rv.status_code == 200
+        assert rv.mimetype == "image/webp"
+        assert "Accept" in rv.headers["Vary"]
+        assert Image.open(io.BytesIO(rv.data)).format == "WEBP"
+
+        rv = client.get(f"/img/{size}/{key}.jpg", headers={"Accept": "image/webp;q=0,*/*"})
+        assert rv.mimetype == "image/jpeg"
+
+
+def test_format_generated_for_old_uploads(client_with_secrets, tmp_path):
+    client, secret_key, bearer_token = client_with_secrets
+
+    key, request = create_upload_request()
+    upload_path = generate_upload_path(request, secret_key)
+
+    with mock_main_server(bearer_token, lambda x: True):
+        with open(DATADIR / "1000x5000.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+        assert rv.status_code == 200
+
+    # as if it had been uploaded before webp was stored
+    webp_path = tmp_path / "medium" / f"{key}.webp"
+    webp_path.unlink()
+
+    rv = client.get(f"/img/medium/{key}.jpg", headers={"Accept": "image/webp"})
+    assert rv.status_code == 200
+    assert rv.mimetype == "image/webp"
+    assert webp_path.is_file()
+    assert Image.open(io.BytesIO(rv.data)).size == (160, 800)
+
+
+def test_missing_rendition_generated_once(client_with_secrets, tmp_path):
+    client, secret_key, bearer_token = client_with_secrets
+
+    key, request = create_upload_request()
+    upload_path = generate_upload_path(request, secret_key)
+
+    with mock_main_server(bearer_token, lambda x: True):
+        with open(DATADIR / "5000x5000.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+        assert rv.status_code == 200
+
+    # like an image uploaded before thumbnails were generated at upload time
+    (tmp_path / "thumbnail" / f"{key}.jpg").unlink()
+
+    def get_thumbnail(_):
+        with client.application.test_client() as c:
+            rv = c.get(f"/img/thumbnail/{key}.jpg")
+            return rv.status_code, Image.open(io.BytesIO(rv.data)).size
+
+    with futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(get_thumbnail, range(8)))
+
+    assert results == [(200, (200, 200))] * 8
+    assert not list(tmp_path.glob("*/*.tmp"))
+
+
+def test_channel_reused(client_with_secrets, monkeypatch):
+    client, secret_key, bearer_token = client_with_secrets
+
+    channels = []
+    insecure_channel = grpc.insecure_channel
+
+    def counting_insecure_channel(*args, **kwargs):
+        channel = insecure_channel(*args, **kwargs)
+        channels.append(channel)
+        return channel
+
+    monkeypatch.setattr(grpc, "insecure_channel", counting_insecure_channel)
+
+    with mock_main_server(bearer_token, lambda x: True):
+        for _ in range(3):
+            key, request = create_upload_request()
+            upload_path = generate_upload_path(request, secret_key)
+            with open(DATADIR / "1x1.jpg", "rb") as f:
+                rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+            assert rv.status_code == 200
+
+    assert len(channels) == 1
+
+
+def test_confirm_in_background(tmp_path):
+    app, secret_key, bearer_token = create_test_app(tmp_path, confirm_in_background=True)
+
+    confirmed = {}
+    let_through = threading.Event()
+
+    def accept(req):
+        # the main server is slow to respond, and rejects one of the uploads
+        let_through.wait(5)
+        confirmed[req.key] = req.key != rejected_key
+        return confirmed[req.key]
+
+    accepted_key, accepted_request = create_upload_request()
+    rejected_key, rejected_request = create_upload_request()
+
+    with app.test_client() as client, mock_main_server(bearer_token, accept):
+        for request in [accepted_request, rejected_request]:
+            with open(DATADIR / "1x1.jpg", "rb") as f:
+                rv = client.post(generate_upload_path(request, secret_key), data={"file": (f, "img.jpg")})
+            # responds before the main server does
+            assert rv.status_code == 200
+            assert json.loads(rv.data)["ok"]
+        assert not confirmed
+        assert (tmp_path / "full" / f"{rejected_key}.jpg").is_file()
+
+        let_through.set()
+        for _ in range(50):
+            if len(confirmed) == 2 and not (tmp_path / "full" / f"{rejected_key}.jpg").exists():
+                break
+            sleep(0.1)
+
+    assert confirmed == {accepted_key: True, rejected_key: False}
+    assert (tmp_path / "full" / f"{accepted_key}.jpg").is_file()
+    assert not list(tmp_path.glob(f"*/{rejected_key}.*"))
+
+
+def test_upload_too_large(tmp_path):
+    app, secret_key, bearer_token = create_test_app(tmp_path, max_upload_bytes=100_000)
+
+    key, request = create_upload_request()
+    upload_path = generate_upload_path(request, secret_key)
+
+    with app.test_client() as client:
+        with open(DATADIR / "5000x5000.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+        assert rv.status_code == 413
+
+        with open(DATADIR / "1x1.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+        # gets through to confirming with the main server, which isn't running
+        assert rv.status_code != 413
+
+    assert not (tmp_path / "full" / f"{key}.jpg").exists()
+
+
+def test_range_requests(client_with_secrets):
+    client, secret_key, bearer_token = client_with_secrets
+
+    key, request = create_upload_request()
+    upload_path = generate_upload_path(request, secret_key)
+
+    with mock_main_server(bearer_token, lambda x: True):
+        with open(DATADIR / "5000x5000.jpg", "rb") as f:
+            rv = client.post(upload_path, data={"file": (f, "img.jpg")})
+        assert rv.status_code == 200
+
+    full = client.get(f"/img/full/{key}.jpg").data
+
+    rv = client.get(f"/img/full/{key}.jpg", headers={"Range": "bytes=100-199"})
+    assert rv.status_code == 206
+    assert rv.headers["Content-Range"] == f"bytes 100-199/{len(full)}"
+    assert rv.data == full[100:200]
+
+    rv = client.get(f"/img/full/{key}.jpg", headers={"Range": f"bytes={len(full) + 10}-"})
+    assert rv.status_code == 416
+
+
+def upload_image(client, secret_key, bearer_token, path):
+    """
+    Uploads the image at path through the app's client with a main server that accepts it, returns its key
+    """
+    key, request = create_upload_request()
+    with mock_main_server(bearer_token, lambda x: True):
+        with open(path, "rb") as f:
+            rv = client.post(generate_upload_path(request, secret_key), data={"file": (f, "img.jpg")})
+        assert rv.status_code == 200
+    return key
+
+
+def test_x_accel_redirect(tmp_path):
+    app, secret_key, bearer_token = create_test_app(tmp_path, file_serving="x-accel-redirect")
+
+    with app.test_client() as client:
+        key = upload_image(client, secret_key, bearer_token, DATADIR / "1000x5000.jpg")
+
+        rv = client.get(f"/img/medium/{key}.jpg")
+        assert rv.status_code == 200
+        assert rv.headers["X-Accel-Redirect"] == f"/_uploads/medium/{key}.jpg"
+        assert rv.mimetype == "image/jpeg"
+        assert rv.data == b""
+        assert "max-age=43200" in rv.headers["Cache-Control"]
+        assert "Accept" in rv.headers["Vary"]
+
+        rv = client.get(f"/img/thumbnail/{key}.jpg", headers={"Accept": "image/webp"})
+        assert rv.headers["X-Accel-Redirect"] == f"/_uploads/thumbnail/{key}.webp"
+        assert rv.mimetype == "image/webp"
+
+        rv = client.get(f"/img/full/{random_bytes(32).hex()}.jpg")
+        assert rv.status_code == 404
+        assert "X-Accel-Redirect" not in rv.headers
+
+
+def test_x_sendfile(tmp_path):
+    app, secret_key, bearer_token = create_test_app(tmp_path, file_serving="x-sendfile")
+
+    with app.test_client() as client:
+        key = upload_image(client, secret_key, bearer_token, DATADIR / "1000x5000.jpg")
+
+        rv = client.get(f"/img/full/{key}.jpg")
+        assert rv.status_code == 200
+        assert rv.headers["X-Sendfile"] == str(tmp_path / "full" / f"{key}.jpg")
+        assert rv.data == b""
+
+
+def test_unknown_file_serving(tmp_path):
+    with pytest.raises(ValueError):
+        create_test_app(tmp_path, file_serving="carrier-pigeon")